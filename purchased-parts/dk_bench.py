@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+DIGI-KEY PIPELINE BENCHMARKS (SYNTHETIC ARCHIVES + STORED BASELINE)
+
+Companion to dk_pipeline.py. Generates schema-faithful synthetic Digi-Key exports at
+any scale, times the pipeline's stages on them, and compares against a stored baseline
+so slowdowns are caught before they reach the real archive.
+
+───────────────────────────────────────────────────────────────────────────────
+GENERATOR:
+───────────────────────────────────────────────────────────────────────────────
+
+  python dk_bench.py generate --items 100000 --out /tmp/dk_synth
+
+writes the six inputs dk_pipeline.py discovers (base/delta invoices, base/delta
+products, full + mini CSV). Orders carry invoices/boxes/invoiceDetails like the real
+export; products carry productVariations, parameters and a nested category tree.
+  --items        total invoice line items across base + delta (10^3 .. 10^6)
+  --mcu-share    fraction of part numbers that are microcontrollers (default 0.15)
+  --delta-ratio  fraction of orders in the delta export (default 0.05)
+Output is deterministic for a given --seed. JSON is streamed, so 10^6 items fit in memory.
+
+───────────────────────────────────────────────────────────────────────────────
+BENCHMARKS:
+───────────────────────────────────────────────────────────────────────────────
+
+  python dk_bench.py run --sizes 1000,10000            # compare vs dk_bench_baseline.json
+  python dk_bench.py run --sizes 1000,10000 --update   # (re)record the baseline
+
+For each size: discover (cold, no key index), build_rows (build_frame, base + merged passes),
+assertions (A, B and C) and run_pipeline end to end: without the cache, with an empty
+cache (run_pipeline_cold) and with the cache a previous run left (run_pipeline_warm,
+the usual case for a daily run or a watch cycle). Each is timed as the best of
+--repeat runs, then run once more under tracemalloc for its peak allocation. A run
+fails (exit 1) if any wall time exceeds baseline * --tolerance (default 1.5) by more
+than timer noise (50 ms), and also if the baseline is missing, has no entry for one of the
+benchmarks or sizes run, or was recorded with other generator settings.
+Baselines are machine specific: re-record them when the benchmark machine changes.
+
+"""
+
+from __future__ import annotations
+import argparse, contextlib, io, itertools, json, platform, random, shutil, sys, tempfile, time, tracemalloc, zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import dk_pipeline as dk
+
+
+BASELINE_PATH = Path(__file__).with_name("dk_bench_baseline.json")
+BENCH_NAMES: List[str] = ["discover", "build_rows", "assertions", "run_pipeline",
+                          "run_pipeline_cold", "run_pipeline_warm"]
+# Slowdowns smaller than this (seconds) are timer noise, whatever the ratio.
+NOISE_FLOOR_S = 0.05
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Synthetic archive generator
+# ─────────────────────────────────────────────────────────────────────────────
+
+# (tier-1, tier-2, tier-3) category paths; is_mcu_product matches on "microcontroller".
+MCU_CATEGORY = ("Integrated Circuits (ICs)", "Embedded", "Microcontrollers")
+OTHER_CATEGORIES = [
+    ("Resistors", "Chip Resistor - Surface Mount", None),
+    ("Capacitors", "Ceramic Capacitors", None),
+    ("Connectors, Interconnects", "Rectangular Connectors", "Headers, Male Pins"),
+    ("Integrated Circuits (ICs)", "Power Management (PMIC)", "Voltage Regulators - Linear"),
+    ("Discrete Semiconductor Products", "Transistors", "FETs, MOSFETs - Single"),
+    ("Optoelectronics", "LED Indication - Discrete", None),
+    ("Crystals, Oscillators, Resonators", "Crystals", None),
+]
+MANUFACTURERS = ["STMicroelectronics", "Microchip Technology", "Texas Instruments", "Nexperia USA Inc.",
+                 "Yageo", "Murata Electronics", "Amphenol ICC (FCI)", "Raspberry Pi", "Espressif Systems"]
+MCU_CORES = ["ARM® Cortex®-M0+", "ARM® Cortex®-M4", "ARM® Cortex®-M33", "AVR", "PIC", "Xtensa® LX7"]
+PACKAGES = ["0402 (1005 Metric)", "0603 (1608 Metric)", "SOT-23-3", "8-SOIC (0.154\", 3.90mm Width)",
+            "48-LQFP", "64-LQFP", "QFN-32", "TO-220-3"]
+PACK_TYPES = ["Cut Tape (CT)", "Tape & Reel (TR)", "Bulk", "Tube", "Tray"]
+STATUSES = ["Active", "Active", "Active", "Not For New Designs", "Obsolete"]
+
+def _category_tree(names, rng: random.Random) -> dict:
+    node: dict = {}
+    for name in reversed([n for n in names if n]):
+        node = {"categoryId": rng.randint(1, 3000), "name": name,
+                "childCategories": [node] if node else []}
+    return node
+
+def _param(rng: random.Random, text: str, value: str) -> dict:
+    return {"parameterId": zlib.crc32(text.encode("utf-8")) % 2000, "parameterText": text,
+            "parameterType": "String", "valueId": str(rng.randint(1, 999999)), "valueText": value}
+
+def _gbp(value: float, places: int) -> str:
+    return f"£{value:,.{places}f}"
+
+def synth_part(i: int, mcu: bool, rng: random.Random) -> dict:
+    """One catalogue part: the product record plus the line-item fields an invoice copies from it."""
+    mfr = rng.choice(MANUFACTURERS)
+    mfr_pn = f"SYN{i:07d}{'M' if mcu else rng.choice('ABCDEFG')}"
+    params = [_param(rng, "Package / Case", rng.choice(PACKAGES)),
+              _param(rng, "Mounting Type", rng.choice(["Surface Mount", "Through Hole"])),
+              _param(rng, "Operating Temperature", rng.choice(["-40°C ~ 85°C (TA)", "-55°C ~ 125°C"]))]
+    if mcu:
+        params += [_param(rng, "Core Processor", rng.choice(MCU_CORES)),
+                   _param(rng, "Core Size", rng.choice(["8-Bit", "32-Bit", "32-Bit Single-Core"])),
+                   _param(rng, "Speed", f"{rng.choice([16, 48, 64, 133, 168, 240])}MHz"),
+                   _param(rng, "Program Memory Size", rng.choice(["32KB (32K x 8)", "256KB (256K x 8)", "1MB (1M x 8)"])),
+                   _param(rng, "Number of I/O", str(rng.randint(6, 100)))]
+    else:
+        params += [_param(rng, "Tolerance", rng.choice(["±1%", "±5%", "±10%"])),
+                   _param(rng, "Voltage - Rated", rng.choice(["6.3V", "16V", "50V"]))]
+    names = MCU_CATEGORY if mcu else rng.choice(OTHER_CATEGORIES)
+    variations = [{
+        "digiKeyProductNumber": f"{rng.randint(100, 999)}-{mfr_pn}-{suffix}",
+        "productId": 10_000_000 + 4 * i + k,
+        "packageType": {"id": k + 1, "name": pack},
+        "quantityAvailable": rng.randint(0, 100_000),
+        "priceBreaks": [],
+        "webDisplay": True,
+        "minimumOrderQuantity": 1,
+    } for k, (suffix, pack) in enumerate([("ND", rng.choice(PACK_TYPES)), ("CT-ND", "Cut Tape (CT)")][:rng.randint(1, 2)])]
+    unit_e5 = rng.randint(500, 2_000_000) if mcu else rng.randint(50, 200_000)
+    product = {
+        "manufacturerLeadWeeks": str(rng.randint(1, 52)),
+        "reachStatus": 2,
+        "rohsStatus": "Rohs3Compliant",
+        "manufacturer": {"name": mfr},
+        "category": _category_tree(names, rng),
+        "manufacturerProductNumber": mfr_pn,
+        "primaryDatasheet": {"url": f"https://example.invalid/{mfr_pn}.pdf", "title": f"{mfr_pn} Datasheet"},
+        "primaryPhoto": {"url": f"//example.invalid/{mfr_pn}.jpg"},
+        "productVariations": variations,
+        "description": {"catalog": f"{names[-1] or names[1]} {mfr_pn}".upper()},
+        "parameters": params,
+        "series": {"id": rng.randint(1, 5000), "name": rng.choice(["-", "STM32G4", "PIC18", "RC", "GRM"])},
+        "productStatus": {"status": rng.choice(STATUSES)},
+        "standardPackage": rng.choice([1, 100, 2500, 5000]),
+        "specialProductCode": "",
+    }
+    return {"product": product, "unit_e5": unit_e5, "mfr": mfr, "mfr_pn": mfr_pn,
+            "variations": [v["digiKeyProductNumber"] for v in variations],
+            "description": product["description"]["catalog"], "pack": variations[0]["packageType"]["name"]}
+
+def synth_order(seq: int, parts: List[dict], n_details: int, rng: random.Random) -> dict:
+    """One order with a single invoice and n_details line items drawn from parts."""
+    invoice_id = 100_000_000 + seq
+    day = pd.Timestamp("2022-01-01", tz="UTC") + pd.Timedelta(hours=7 * seq)
+    entered = day.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    shipped = (day + pd.Timedelta(hours=6)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    details = []
+    for det_id in range(1, n_details + 1):
+        part = rng.choice(parts)
+        qty = rng.choice([1, 2, 5, 10, 25, 100])
+        ext = round(part["unit_e5"] * qty / 1000)
+        details.append({
+            "detailId": det_id,
+            "quantityInitial": qty,
+            "digiKeyProductNumber": rng.choice(part["variations"]),
+            "customerReference": "",
+            "countryOfOrigin": rng.choice(["CN", "PH", "MY", "US", "TW"]),
+            "manufacturerProductNumber": part["mfr_pn"],
+            "description": part["description"],
+            "manufacturerName": part["mfr"],
+            "packType": part["pack"],
+            "quantityShipped": qty,
+            "quantityBackorder": 0,
+            "quantityCancelled": 0,
+            "invoiceId": invoice_id,
+            "unitPrice": part["unit_e5"],
+            "extendedPrice": ext,
+            "formattedUnitPrice": _gbp(part["unit_e5"] / 1e5, 5),
+            "formattedExtendedPrice": _gbp(ext / 100, 2),
+            "detailDisplayOrder": det_id,
+        })
+    return {
+        "customerId": 15_000_000,
+        "dateEntered": entered,
+        "salesOrders": [],
+        "invoices": [{"invoiceId": invoice_id, "dateShipped": shipped, "status": "Shipped",
+                      "detailCount": n_details, "dateEntered": entered, "currencyIso": "GBP"}],
+        "orderNumber": 9_910_000_000_000_000 + seq,
+        "boxes": [{"carrier": "Other", "dateShipped": shipped, "boxId": 1, "invoiceId": invoice_id}],
+        "invoiceDetails": details,
+        "currencyIso": "GBP",
+        "emailAddress": "synthetic@example.invalid",
+    }
+
+def generate_archive(out_dir: Path, n_items: int, mcu_share: float = 0.15, delta_ratio: float = 0.05,
+                     details_per_order: int = 12, items_per_part: int = 8, seed: int = 0,
+                     indent: Optional[int] = 2) -> Dict[str, int]:
+    """
+    Writes inv_base.json / inv_delta.json / prod_base.json / prod_delta.json and the
+    full.csv / mini.csv pair to out_dir. Delta orders are the newest delta_ratio of all
+    orders (plus the newest base order again, as overlapping real exports do); delta
+    products are the parts those orders introduce plus a few already in the base.
+    Returns the generated counts.
+    """
+    if not 0 < delta_ratio < 0.5:
+        raise ValueError(f"delta_ratio must be in (0, 0.5) so the delta is the smaller file; got {delta_ratio}")
+    if n_items < 2:
+        raise ValueError(f"n_items must be >= 2 (base + delta); got {n_items}")
+    if not 0 <= mcu_share <= 1:
+        raise ValueError(f"mcu_share must be in [0, 1]; got {mcu_share}")
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    n_orders = max(2, -(-n_items // details_per_order))
+    n_delta_orders = max(1, round(n_orders * delta_ratio))
+    n_base_orders = n_orders - n_delta_orders
+    n_parts = max(10, n_items // items_per_part)
+    n_delta_parts = max(1, round(n_parts * delta_ratio))
+    parts = [synth_part(i, rng.random() < mcu_share, rng) for i in range(n_parts)]
+    base_parts, delta_parts = parts[:n_parts - n_delta_parts], parts[n_parts - n_delta_parts:]
+    sizes = [n_items // n_orders + (i < n_items % n_orders) for i in range(n_orders)]
+
+    def orders(lo: int, hi: int, pool: List[dict]):
+        for seq in range(lo, hi):
+            yield synth_order(seq, pool, sizes[seq], random.Random(seed * 1_000_003 + seq))
+
+    dk.write_json_array(out_dir / "inv_base.json", orders(0, n_base_orders, base_parts), indent)
+    dk.write_json_array(out_dir / "inv_delta.json",
+                        itertools.chain(orders(n_base_orders - 1, n_base_orders, base_parts),
+                                        orders(n_base_orders, n_orders, parts)), indent)
+    dk.write_json_array(out_dir / "prod_base.json", (p["product"] for p in base_parts), indent)
+    overlap = base_parts[-max(1, len(delta_parts) // 10):]
+    dk.write_json_array(out_dir / "prod_delta.json", (p["product"] for p in overlap + delta_parts), indent)
+
+    # The CSV pair only has to be discoverable (mini: fewer columns, same row count).
+    base_items = sum(sizes[:n_base_orders])
+    with (out_dir / "full.csv").open("w", encoding="utf-8") as f:
+        f.write(",".join(dk.FUTURE_FULL_SCHEMA) + "\n")
+        f.write(("," * (len(dk.FUTURE_FULL_SCHEMA) - 1) + "\n") * base_items)
+    with (out_dir / "mini.csv").open("w", encoding="utf-8") as f:
+        f.write(",".join(dk.MINI_SCHEMA) + "\n")
+        f.write(("," * (len(dk.MINI_SCHEMA) - 1) + "\n") * base_items)
+
+    return {"items": n_items, "orders": n_orders, "delta_orders": n_delta_orders + 1,
+            "parts": n_parts, "delta_parts": len(overlap) + len(delta_parts)}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Benchmarks
+# ─────────────────────────────────────────────────────────────────────────────
+
+def measure(fn: Callable[[], object], repeat: int = 3) -> Dict[str, float]:
+    """Best-of-`repeat` wall time, then one extra run under tracemalloc for the peak allocation."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"wall_s": round(best, 4), "peak_mb": round(peak / (1 << 20), 1)}
+
+def bench_size(n_items: int, work_dir: Path, repeat: int = 3, **gen_kw) -> Dict[str, Dict[str, float]]:
+    in_dir = work_dir / f"in_{n_items}"
+    out_dir = work_dir / f"out_{n_items}"
+    generate_archive(in_dir, n_items, **gen_kw)
+
+    pairs = dk.discover_json_base_delta(in_dir, dk.DocRegistry())
+    (inv_base_p, inv_delta_p), (prod_base_p, prod_delta_p) = pairs["invoice"], pairs["product"]
+    reg = dk.DocRegistry()
+    invoices_base, invoices_delta = reg.doc(inv_base_p), reg.doc(inv_delta_p)
+    prod_by_dk = dk.build_prod_by_dk(reg.doc(prod_base_p), reg.doc(prod_delta_p))
+    delta_only_keys = set(reg.detail_keys(inv_delta_p) - reg.detail_keys(inv_base_p))
+
+    def build():
+        df_base = dk.build_frame(invoices_base, prod_by_dk)
+        df_merged = dk.build_frame(list(invoices_base) + list(invoices_delta), prod_by_dk,
+                                   new_detail_keys=delta_only_keys)
+        return df_base, df_merged
+
+    df_base, df_merged = build()
+
+    def assertions():
+        assert int(df_merged["_is_new"].sum()) == len(delta_only_keys)
+        dk.assert_old_rows_identical(df_base, df_merged, dk.FUTURE_FULL_SCHEMA)
+        dk.assert_new_mcu_rows(df_merged)
+
+    def end_to_end(use_cache: bool = False, fresh: bool = True):
+        if fresh:
+            shutil.rmtree(out_dir, ignore_errors=True)  # outputs and the cache dir inside OUT_DIR
+        with contextlib.redirect_stdout(io.StringIO()):
+            dk.run_pipeline(IN_DIR=in_dir, OUT_DIR=out_dir, use_cache=use_cache)
+
+    results = {
+        "discover": measure(lambda: dk.discover_json_base_delta(in_dir, dk.DocRegistry()), repeat),
+        "build_rows": measure(build, repeat),
+        "assertions": measure(assertions, repeat),
+        "run_pipeline": measure(end_to_end, repeat),
+        "run_pipeline_cold": measure(lambda: end_to_end(use_cache=True), repeat),
+    }
+    end_to_end(use_cache=True)  # leaves the warm cache the next bench reuses
+    results["run_pipeline_warm"] = measure(lambda: end_to_end(use_cache=True, fresh=False), repeat)
+    return results
+
+def environment() -> Dict[str, str]:
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "system": platform.system()}
+
+def compare(results: Dict[str, dict], baseline: dict, tolerance: float,
+            generator: Optional[Dict[str, object]] = None) -> List[str]:
+    """
+    Problems (as messages): wall times above baseline * tolerance, and anything the baseline
+    cannot vouch for, which would otherwise pass unchecked: a benchmark or size it has no
+    entry for, or (with `generator`) archives generated with other settings than it was.
+    """
+    problems = []
+    if generator is not None and baseline.get("generator") != generator:
+        problems.append(f"baseline was recorded with generator settings {baseline.get('generator')}, "
+                        f"not {generator}; re-record it with --update")
+    for size, benches in results.items():
+        for name, got in benches.items():
+            want = baseline.get("results", {}).get(size, {}).get(name)
+            if not want:
+                problems.append(f"{name} @ {size} items: no baseline entry; re-record it with --update")
+            elif got["wall_s"] > want["wall_s"] * tolerance and got["wall_s"] - want["wall_s"] > NOISE_FLOOR_S:
+                problems.append(f"{name} @ {size} items: regressed to {got['wall_s']:.3f}s vs baseline "
+                                f"{want['wall_s']:.3f}s (> x{tolerance})")
+    return problems
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CLI
+# ─────────────────────────────────────────────────────────────────────────────
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Synthetic Digi-Key archives and pipeline benchmarks.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    gen = sub.add_parser("generate", help="write a synthetic archive")
+    gen.add_argument("--out", type=Path, required=True)
+    gen.add_argument("--items", type=int, default=10_000)
+    run = sub.add_parser("run", help="benchmark the pipeline and compare against the baseline")
+    run.add_argument("--sizes", default="1000,10000", help="comma-separated line-item counts")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    run.add_argument("--update", action="store_true", help="record the results as the new baseline")
+    run.add_argument("--tolerance", type=float, default=1.5)
+    run.add_argument("--work-dir", type=Path, default=None, help="keep generated archives here")
+    for p in (gen, run):
+        p.add_argument("--mcu-share", type=float, default=0.15)
+        p.add_argument("--delta-ratio", type=float, default=0.05)
+        p.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+    gen_kw = {"mcu_share": args.mcu_share, "delta_ratio": args.delta_ratio, "seed": args.seed}
+
+    if args.cmd == "generate":
+        counts = generate_archive(args.out, args.items, **gen_kw)
+        print(json.dumps(counts))
+        return 0
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="dk_bench_"))
+    results: Dict[str, dict] = {}
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            results[str(size)] = bench_size(size, work_dir, args.repeat, **gen_kw)
+            for name in BENCH_NAMES:
+                r = results[str(size)][name]
+                print(f"{size:>9} items  {name:<17} {r['wall_s']:>9.3f}s  {r['peak_mb']:>8.1f} MB peak")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.update:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.setdefault("results", {}).update(results)
+        baseline.update({"environment": environment(), "generator": gen_kw})
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+        print(f"baseline written: {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"FAILED: no baseline at {args.baseline}; record one with --update")
+        return 1
+    problems = compare(results, json.loads(args.baseline.read_text()), args.tolerance, gen_kw)
+    for msg in problems:
+        print(f"FAILED: {msg}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
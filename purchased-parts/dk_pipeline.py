@@ -40,6 +40,8 @@ WHAT IT PRODUCES (written to OUT_DIR):
 3) updated_full_future_schema.csv  (future full schema, includes MCU columns)
 4) updated_mini.csv               (mini schema: fewer cols, ALL rows)
 5) new_purchases_enriched.csv     (only rows that came from the delta invoices JSON)
+   category_dim.csv               (optional, category_table=True: one row per
+                                   leaf category ID with its MCU flag)
 
 ───────────────────────────────────────────────────────────────────────────────
 FUTURE FULL CSV SCHEMA (stable; used for this “migration” and all later runs):
@@ -106,8 +108,61 @@ Example:
       }
   )
 
+SchemaMutations(numeric_columns=True) also writes exact integer twins of the
+formatted quantity/price columns: qty_shipped_int, gbp_unit_price_e5 (1e-5 GBP)
+and gbp_ext_price_e2 (pence), so spend can be summed without parsing strings.
+
 This is OPTIONAL. The repeatable pipeline should normally keep the schema stable.
 
+───────────────────────────────────────────────────────────────────────────────
+CACHING:
+───────────────────────────────────────────────────────────────────────────────
+
+Discovery keeps a key index (SQLite) in OUT_DIR/.dk_cache/: each JSON's kind,
+detail keys and DK part numbers, validated by (size, mtime) and content hash.
+Repeat runs over an unchanged archive classify and score base/delta candidates
+without parsing any JSON. Safe to delete; pass use_cache=False to bypass it.
+
+Products also go into a catalog (.dk_cache/catalog.sqlite) holding each product
+entry once, indexed by DK part number and manufacturer part number. Runs resolve
+parts from it with the usual base precedence, so a base products file it already
+holds (e.g. the previous merged output) is never parsed; ad-hoc tools can use
+ProductCatalog(...).lookup(dk) / .find_mfr_pn(mfr_pn).
+
+INCREMENTAL MODE (run_pipeline(..., incremental=True)):
+Each run stores the row keys of updated_full_future_schema.csv, and the stamp and a
+tail checksum of it and updated_mini.csv, in .dk_cache/run_state.sqlite. When the
+next run's base is that run's merged output, only the delta-only rows are built and
+appended to the full and mini CSVs; assertion B holds because the previous output is
+proven unchanged by its stamp and tail checksum, without rebuilding or re-reading the
+history. Without usable state it falls back to a full rebuild.
+
+BATCH MODE (run_pipeline(..., deltas=[...])):
+When several monthly exports are queued, list all their invoice + product JSONs.
+They are merged onto the discovered base in one pass (invoice deltas in export-date
+order), with new-row counts checked and reported per delta.
+
+COMPACTION (run_pipeline(..., compact_products=True)):
+merged_products_out.json keeps one entry per DK part number (the base-precedence
+winner) instead of every re-exported copy; lookups and checks are unchanged and the
+records/bytes reclaimed are reported.
+
+PARAMETRIC SEARCH (Python API, no pipeline run needed):
+  idx = ParamIndex(ProductCatalog(Path(".dk_cache/catalog.sqlite")).iter_products())
+  idx.query(("Core Processor", "contains", "Cortex-M33"),
+            ("Program Memory Size", ">=", "512KB"), ("Speed", ">=", "160MHz"))
+Units (MHz, KB/MB, V, mA, ...) are normalised, so thresholds compare numerically.
+
+SPEND ROLLUPS (.dk_cache/rollups.sqlite, kept up to date by every cached run):
+Lines, units and spend (pence) per mfr / category / core_type / mfr_pn and month,
+updated with only the appended rows on incremental runs (after a full rebuild, the
+first query recomputes them from the full CSV):
+  SpendRollups(Path(".dk_cache/rollups.sqlite")).totals("mfr", start="2025-01")
+
+RUN REPORT (run_pipeline(..., report=True)):
+Writes OUT_DIR/dk_run_report.json with per-stage wall/CPU time, peak memory and
+row/byte counts; profile=True adds a cProfile dump (dk_run_report.prof).
+
 ───────────────────────────────────────────────────────────────────────────────
 CALLSITE:
 ───────────────────────────────────────────────────────────────────────────────
@@ -115,19 +170,32 @@ CALLSITE:
 Just run:
   python dk_pipeline.py
 
+Or keep it running and drop each month's exports into the folder:
+  python dk_pipeline.py --watch
+
 Or in a notebook/chat tool session:
   run_pipeline(IN_DIR=Path("/mnt/data"), OUT_DIR=Path("/mnt/data"))
 
 """
 
 from __future__ import annotations
-import json, glob, math
+import contextlib, csv, json, glob, math, functools, hashlib, itertools, os, re, sqlite3, sys, time
+import cProfile, tracemalloc
+from datetime import datetime, timezone
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from typing import Dict, List, Tuple, Optional
 
+import numpy as np
 import pandas as pd
 
+try:
+    import resource  # POSIX only; peak RSS is left out of run reports without it
+except ImportError:
+    resource = None
+
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Configurable stable schemas
@@ -156,8 +224,26 @@ FUTURE_FULL_SCHEMA: List[str] = [
 
 MINI_SCHEMA: List[str] = ["mfr_pn", "dk_pn", "description", "qty_bought"]
 
+# Exact numeric twins of the formatted quantity/price columns, taken from the raw
+# quantityShipped / unitPrice / extendedPrice fields. Fixed point as Digi-Key reports them:
+# unit price in 1e-5 GBP, extended price in pence. Built on every run; written only with
+# SchemaMutations(numeric_columns=True).
+NUMERIC_COLUMNS: Dict[str, str] = {
+    "qty_shipped_int": "Int64",
+    "gbp_unit_price_e5": "Int64",
+    "gbp_ext_price_e2": "Int64",
+}
+
 MCU_PROMOTED_PARAM_TEXTS = ["Core Processor", "Core Size", "Speed", "Program Memory Size"]
 
+# Persistent caches (key index, ...) live here, relative to OUT_DIR unless overridden.
+CACHE_DIRNAME = ".dk_cache"
+
+# Run report (report=True) and cProfile dump (profile=True), written to OUT_DIR. The report is a
+# JSON object, not an array, so discovery classifies it as "unknown" and ignores it.
+RUN_REPORT_NAME = "dk_run_report.json"
+RUN_PROFILE_NAME = "dk_run_report.prof"
+
 
 @dataclass
 class SchemaMutations:
@@ -167,10 +253,12 @@ class SchemaMutations:
     - promote_other_params: move keys from other_parameters (JSON blob) into dedicated columns.
       Mapping is: parameterText -> new column name.
       Promoted keys are removed from the blob to avoid duplication.
+    - numeric_columns: also output the integer quantity/price columns (NUMERIC_COLUMNS).
     """
     drop_output_columns: List[str] = field(default_factory=list)
     promote_other_params: Dict[str, str] = field(default_factory=dict)  # parameterText -> new column name
     promoted_insert_before: str = "other_parameters"
+    numeric_columns: bool = False  # add NUMERIC_COLUMNS right after gbp_ext_price
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -180,36 +268,652 @@ class SchemaMutations:
 def _file_size(p: Path) -> int:
     return p.stat().st_size
 
+def _replace_atomically(out: Path, write):
+    """
+    Runs write(tmp) on a hidden sibling of `out`, then renames it over `out`: readers never see
+    a partial file, and `out` may itself be an input of the write (e.g. the spliced base).
+    """
+    tmp = out.with_name(f".{out.name}.tmp")
+    try:
+        result = write(tmp)
+        os.replace(tmp, out)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return result
+
+def _append_csv(df: pd.DataFrame, p: Path) -> None:
+    """
+    Appends df's rows (no header) to the CSV p in one write. If the write fails part-way, p is
+    rolled back (_restore_file) to exactly what it was, so it never ends in a partial row.
+    """
+    data = df.to_csv(index=False, header=False)
+    st = p.stat()
+    try:
+        with p.open("a", encoding="utf-8", newline="") as f:
+            f.write(data)
+    except BaseException:
+        _restore_file(p, st)
+        raise
+
+def _restore_file(p: Path, st: os.stat_result) -> None:
+    """Truncates p back to the size in st and restores its mtime: the stamp a run state recorded matches again."""
+    os.truncate(p, st.st_size)
+    os.utime(p, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def _file_stamp(p: Path) -> List:
+    st = p.stat()
+    return [str(p.resolve()), st.st_size, st.st_mtime_ns]
+
 def _load_json(p: Path):
     with p.open("r", encoding="utf-8") as f:
         return json.load(f)
 
-def _classify_json_doc(doc) -> str:
+def _iter_json_array(p: Path, chunk_size: int = 1 << 20):
+    """
+    Yields the elements of a top-level JSON array one at a time, reading the file
+    in chunks (stdlib only). Raises ValueError if the document is not an array.
+    """
+    dec = json.JSONDecoder()
+    ws = " \t\r\n"
+    with p.open("r", encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+        state = "open"  # open -> first -> (value <-> sep)
+        while True:
+            while pos < len(buf) and buf[pos] in ws:
+                pos += 1
+            if pos >= len(buf):
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {p}")
+                chunk = f.read(chunk_size)
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+                continue
+
+            c = buf[pos]
+            if state == "open":
+                if c != "[":
+                    raise ValueError(f"Not a JSON array: {p}")
+                pos += 1
+                state = "first"
+                continue
+            if state in ("first", "sep") and c == "]":
+                return
+            if state == "sep":
+                if c != ",":
+                    raise ValueError(f"Expected ',' or ']' in JSON array {p}")
+                pos += 1
+                state = "value"
+                continue
+
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # A scalar cut at the buffer edge can decode "successfully" (e.g. "12" of "123"),
+            # so only accept an element once its following delimiter is in the buffer.
+            if end is not None and not eof:
+                nxt = end
+                while nxt < len(buf) and buf[nxt] in ws:
+                    nxt += 1
+                if nxt >= len(buf) or buf[nxt] not in ",]":
+                    end = None
+            if end is None:
+                chunk = f.read(max(chunk_size, len(buf) - pos))
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+                continue
+            yield obj
+            pos = end
+            state = "sep"
+
+class JsonArrayStream:
+    """
+    Re-iterable view of a top-level JSON array on disk: every iteration streams the file
+    again, so only one element is in memory at a time.
+    """
+    def __init__(self, p: Path):
+        self.path = p
+
+    def __iter__(self):
+        return _iter_json_array(self.path)
+
+class DocChain:
+    """Re-iterable concatenation of several docs (parsed lists or JsonArrayStreams), in order."""
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.docs)
+
+def _chain_docs(docs):
+    return docs[0] if len(docs) == 1 else DocChain(docs)
+
+def _json_array_layout(indent: Optional[int]) -> Tuple[json.JSONEncoder, str, str]:
+    """(encoder, per-element pad, closing bytes) for indent=N (json.dump layout) or None (compact)."""
+    if indent is None:
+        return json.JSONEncoder(separators=(",", ":")), "", "]"
+    return json.JSONEncoder(indent=indent), "\n" + " " * indent, "\n]"
+
+def _json_layout_tag(indent: Optional[int]) -> str:
+    return "compact" if indent is None else f"indent={indent}"
+
+def _can_splice(p: Path, indent: Optional[int]) -> bool:
+    """p ends like a non-empty array in this layout (the layout itself is vouched for by the caller)."""
+    close = _json_array_layout(indent)[2].encode()
+    size = _file_size(p)
+    if size <= len(close) + 1:
+        return False
+    with p.open("rb") as f:
+        f.seek(size - len(close))
+        return f.read() == close
+
+def _write_json_array(out: Path, items, indent: Optional[int] = 2,
+                      splice_from: Optional[Path] = None) -> Tuple[int, str]:
+    """
+    Streams `items` to `out` as one JSON array; returns (elements encoded, sha256 of the output).
+    indent=2 is byte-identical to json.dump(list(items), f, indent=2); indent=None writes compact
+    JSON with no whitespace at all.
+    splice_from: a non-empty JSON array file already in exactly this layout (e.g. a previous
+    output of this function). Its bytes are copied through unparsed and `items` are appended.
+    The file is replaced atomically, so splice_from may be `out` itself.
+    """
+    return _replace_atomically(out, functools.partial(_write_json_array_to, items=items, indent=indent,
+                                                      splice_from=splice_from))
+
+def write_json_array(out: Path, items, indent: Optional[int] = 2) -> int:
+    """Streams `items` to `out` as one JSON array (see _write_json_array); returns the element count."""
+    return _write_json_array(out, items, indent)[0]
+
+def _write_json_array_to(out: Path, items, indent: Optional[int], splice_from: Optional[Path]) -> Tuple[int, str]:
+    enc, pad, close = _json_array_layout(indent)
+    h = hashlib.sha256()
+    n = 0
+    started = False
+    with out.open("wb") as f:
+        def w(b: bytes) -> None:
+            h.update(b)
+            f.write(b)
+
+        if splice_from is not None:
+            remaining = _file_size(splice_from) - len(close)
+            with splice_from.open("rb") as src:
+                while remaining > 0:
+                    chunk = src.read(min(1 << 20, remaining))
+                    if not chunk:
+                        break
+                    w(chunk)
+                    remaining -= len(chunk)
+            started = True
+
+        for item in items:
+            s = enc.encode(item)
+            if pad:
+                s = pad + s.replace("\n", pad)
+            w((("," if started else "[") + s).encode("utf-8"))
+            started = True
+            n += 1
+        w(close.encode() if started else b"[]")
+    return n, h.hexdigest()
+
+def _write_json_concat(out: Path, base, delta, indent: Optional[int] = 2,
+                       base_path: Optional[Path] = None) -> Tuple[int, str, bool]:
+    """
+    Writes base elements followed by delta elements as one array, without building the
+    concatenated list. If base_path is given (caller asserts it is already in this layout),
+    its raw bytes are spliced instead of re-encoding the base.
+    Returns (elements encoded, sha256, spliced).
+    """
+    if base_path is not None and _can_splice(base_path, indent):
+        n, sha = _write_json_array(out, delta, indent, splice_from=base_path)
+        return n, sha, True
+    n, sha = _write_json_array(out, itertools.chain(base, delta), indent)
+    return n, sha, False
+
+class ProductDedup:
+    """
+    Iterable filter for the products output (compaction): keeps a product entry only if it
+    is the first to carry at least one of its variation DK part numbers, i.e. the entry
+    build_prod_by_dk would pick for that part. Entries are kept in order, so every winner
+    still precedes any later copy and lookups over the compacted file are unchanged.
+    Entries without DK part numbers are never looked up and are kept as they are.
+    seen: DK part numbers already written (e.g. a compacted base that is spliced through).
+    expected: number of distinct DK part numbers the output must cover (len(prod_by_dk));
+    checked once the items are exhausted, so a failing write never replaces its target.
+    Counts the dropped entries and the bytes they would have taken in this layout.
+    """
+    def __init__(self, items, indent: Optional[int] = 2, seen=(), expected: Optional[int] = None):
+        self.items = items
+        self.seen = set(seen)
+        self.expected = expected
+        self.enc, self.pad = _json_array_layout(indent)[:2]
+        self.kept = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def __iter__(self):
+        seen = self.seen
+        for p in self.items:
+            dks = [v.get("digiKeyProductNumber") for v in p.get("productVariations", [])]
+            dks = [dk for dk in dks if dk]
+            if not dks or not seen.issuperset(dks):
+                seen.update(dks)
+                self.kept += 1
+                yield p
+                continue
+            s = self.enc.encode(p)
+            if self.pad:
+                s = self.pad + s.replace("\n", self.pad)
+            self.dropped += 1
+            self.dropped_bytes += len(s.encode("utf-8")) + 1  # + separating comma
+        if self.expected is not None:
+            assert len(seen) == self.expected, \
+                f"Compacted products cover {len(seen)} DK part numbers, expected {self.expected}"
+
+def _peek_json_head(p: Path):
+    """First element of a top-level JSON array, or None (empty / not an array / unreadable)."""
+    it = _iter_json_array(p, chunk_size=1 << 16)
+    try:
+        return next(it)
+    except (StopIteration, ValueError, UnicodeDecodeError, OSError):
+        return None
+    finally:
+        it.close()
+
+def _classify_json_head(e0) -> str:
     # invoices: list[order], where order has 'invoiceDetails'/'invoices'
-    if isinstance(doc, list) and doc and isinstance(doc[0], dict):
-        e0 = doc[0]
+    if isinstance(e0, dict):
         if "invoiceDetails" in e0 or "invoices" in e0 or "boxes" in e0:
             return "invoice"
         if "productVariations" in e0 or "parameters" in e0:
             return "product"
     return "unknown"
 
-def discover_json_base_delta(dir_: Path) -> Dict[str, Tuple[Path, Path]]:
+def _file_sha256(p: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with p.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _encode_key(key) -> str:
+    # detail keys are tuples of JSON scalars; DK part numbers are plain strings
+    return json.dumps(list(key)) if isinstance(key, tuple) else key
+
+def _decode_key(s: str, tag: str):
+    return tuple(json.loads(s)) if tag == "detail" else s
+
+def _open_cache_db(db_path: Path) -> sqlite3.Connection:
+    """Opens (creating it and its directory if needed) a cache database under the cache dir."""
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(db_path))
+    # new files only: pages freed by deletes can then be returned with PRAGMA incremental_vacuum
+    con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    return con
+
+class KeyIndex:
+    """
+    Persistent sidecar index (SQLite) of each input JSON's kind, detail keys and DK part numbers.
+    - files: path -> (size, mtime, sha256, kind); a matching stamp means "unchanged, skip parsing".
+    - csv_prints: path -> (size, mtime, columns, rows) for the input CSVs (see _csv_fingerprint).
+    - keys:  (sha256, tag, key), so renamed/copied/touched files with identical content reuse
+      their keys after a single re-hash.
+    - pending_keys: key sets of merged outputs, recorded as the union of their parts' and
+      copied into keys only once asked for (has_keys), or before prune() drops a part.
+    Overlap scoring and delta-only keys are answered with SQL joins on the key table.
+    prune() forgets files no longer on disk, and the key sets no indexed file has any more.
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._con = _open_cache_db(db_path)
+        with self._con:
+            self._con.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT, kind TEXT);
+                CREATE TABLE IF NOT EXISTS keysets (
+                    sha256 TEXT, tag TEXT, PRIMARY KEY (sha256, tag)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS keys (
+                    sha256 TEXT, tag TEXT, key TEXT, PRIMARY KEY (sha256, tag, key)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS layouts (sha256 TEXT PRIMARY KEY, layout TEXT);
+                CREATE TABLE IF NOT EXISTS csv_prints (
+                    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, ncols INTEGER, nrows INTEGER);
+                CREATE TABLE IF NOT EXISTS pending_keys (
+                    sha256 TEXT, tag TEXT, parts TEXT, PRIMARY KEY (sha256, tag)) WITHOUT ROWID;
+            """)
+
+    def close(self) -> None:
+        self._con.close()
+
+    def lookup(self, path: str, size: int, mtime_ns: int) -> Optional[Tuple[str, str]]:
+        """(sha256, kind) if the file is indexed with this exact stamp."""
+        row = self._con.execute(
+            "SELECT sha256, kind FROM files WHERE path=? AND size=? AND mtime_ns=?",
+            (path, size, mtime_ns)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def record_file(self, path: str, size: int, mtime_ns: int, sha: str, kind: str) -> None:
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)",
+                              (path, size, mtime_ns, sha, kind))
+
+    def csv_fingerprint(self, path: str, size: int, mtime_ns: int) -> Optional[Tuple[int, int]]:
+        row = self._con.execute(
+            "SELECT ncols, nrows FROM csv_prints WHERE path=? AND size=? AND mtime_ns=?",
+            (path, size, mtime_ns)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def record_csv_fingerprint(self, path: str, size: int, mtime_ns: int, ncols: int, nrows: int) -> None:
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO csv_prints VALUES (?,?,?,?,?)",
+                              (path, size, mtime_ns, ncols, nrows))
+
+    def layout(self, sha: str) -> Optional[str]:
+        """Byte layout of a JSON file this pipeline wrote itself (see _json_layout_tag)."""
+        row = self._con.execute("SELECT layout FROM layouts WHERE sha256=?", (sha,)).fetchone()
+        return row[0] if row else None
+
+    def record_output(self, p: Path, sha: str, kind: str, layout: str, tag: str, parts: List[str]) -> None:
+        """
+        Registers a merged output written by this pipeline: its stamp, kind and byte layout, and
+        its key set as the union of its parts' indexed key sets (so the next run, which uses
+        it as base, needs no parse to score it). The union is pending until first asked for:
+        an output that never becomes an input costs no key copy.
+        An output byte-identical to one of its parts (e.g. a compacted delta that added nothing)
+        already has that part's key set, which must not be rewritten from itself.
+        """
+        st = p.stat()
+        self.record_file(str(p.resolve()), st.st_size, st.st_mtime_ns, sha, kind)
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO layouts VALUES (?,?)", (sha, layout))
+        known = self._con.execute("SELECT 1 FROM keysets WHERE sha256=? AND tag=? UNION ALL "
+                                  "SELECT 1 FROM pending_keys WHERE sha256=? AND tag=?",
+                                  (sha, tag, sha, tag)).fetchone()
+        if sha not in parts and not known and all(self.has_keys(part, tag) for part in parts):
+            with self._con:
+                self._con.execute("INSERT OR REPLACE INTO pending_keys VALUES (?,?,?)", (sha, tag, json.dumps(parts)))
+
+    def _materialize(self, sha: str, tag: str, parts: List[str]) -> None:
+        """Copies a pending output's key set (the union of its parts') into the key table."""
+        if all(self.has_keys(part, tag) for part in parts):
+            with self._con:
+                self._con.execute("DELETE FROM keys WHERE sha256=? AND tag=?", (sha, tag))
+                self._con.execute(
+                    f"INSERT OR IGNORE INTO keys SELECT ?, tag, key FROM keys "
+                    f"WHERE tag=? AND sha256 IN ({','.join('?' * len(parts))})", (sha, tag, *parts))
+                self._con.execute("INSERT OR REPLACE INTO keysets VALUES (?,?)", (sha, tag))
+        with self._con:
+            self._con.execute("DELETE FROM pending_keys WHERE sha256=? AND tag=?", (sha, tag))
+
+    def prune(self) -> set:
+        """
+        Drops the files rows whose path is gone, then the key sets and layouts no remaining
+        file has: a path rewritten in place (e.g. the merged output a run replaces) already got
+        a new row, so its previous content's full key copy goes too. Returns the live sha256s.
+        """
+        stale = [(path,) for (path,) in self._con.execute("SELECT path FROM files").fetchall()
+                 if not os.path.exists(path)]
+        with self._con:
+            self._con.executemany("DELETE FROM files WHERE path=?", stale)
+        live = {sha for (sha,) in self._con.execute("SELECT DISTINCT sha256 FROM files")}
+        # a live output still pending on a part about to go takes its copy now
+        for sha, tag, parts in self._con.execute("SELECT sha256, tag, parts FROM pending_keys").fetchall():
+            if sha in live and not set(json.loads(parts)) <= live:
+                self._materialize(sha, tag, json.loads(parts))
+        with self._con:
+            dead = [(sha,) for (sha,) in self._con.execute(
+                "SELECT sha256 FROM keysets UNION SELECT sha256 FROM layouts "
+                "UNION SELECT sha256 FROM pending_keys").fetchall() if sha not in live]
+            for table in ("keys", "keysets", "layouts", "pending_keys"):
+                self._con.executemany(f"DELETE FROM {table} WHERE sha256=?", dead)
+        if dead:
+            self._con.execute("PRAGMA incremental_vacuum")
+        return live
+
+    def has_keys(self, sha: str, tag: str) -> bool:
+        if self._con.execute("SELECT 1 FROM keysets WHERE sha256=? AND tag=?", (sha, tag)).fetchone():
+            return True
+        row = self._con.execute("SELECT parts FROM pending_keys WHERE sha256=? AND tag=?", (sha, tag)).fetchone()
+        if row is None:
+            return False
+        self._materialize(sha, tag, json.loads(row[0]))
+        return self.has_keys(sha, tag)
+
+    def put_keys(self, sha: str, tag: str, keys) -> None:
+        with self._con:
+            self._con.execute("DELETE FROM keys WHERE sha256=? AND tag=?", (sha, tag))
+            self._con.executemany("INSERT OR IGNORE INTO keys VALUES (?,?,?)",
+                                  ((sha, tag, _encode_key(k)) for k in keys))
+            self._con.execute("INSERT OR REPLACE INTO keysets VALUES (?,?)", (sha, tag))
+
+    def get_keys(self, sha: str, tag: str) -> frozenset:
+        cur = self._con.execute("SELECT key FROM keys WHERE sha256=? AND tag=?", (sha, tag))
+        return frozenset(_decode_key(k, tag) for (k,) in cur)
+
+    def overlap(self, sha_a: str, sha_b: str, tag: str) -> int:
+        return self._con.execute(
+            "SELECT COUNT(*) FROM keys a JOIN keys b ON b.sha256=? AND b.tag=a.tag AND b.key=a.key "
+            "WHERE a.sha256=? AND a.tag=?", (sha_b, sha_a, tag)).fetchone()[0]
+
+    def difference(self, sha_a: str, sha_b: str, tag: str) -> frozenset:
+        """Keys of a that are not in b."""
+        cur = self._con.execute(
+            "SELECT a.key FROM keys a WHERE a.sha256=? AND a.tag=? AND NOT EXISTS "
+            "(SELECT 1 FROM keys b WHERE b.sha256=? AND b.tag=a.tag AND b.key=a.key)",
+            (sha_a, tag, sha_b))
+        return frozenset(_decode_key(k, tag) for (k,) in cur)
+
+class DocRegistry:
+    """
+    Per-run cache of the JSON inputs, keyed by (path, size, mtime).
+    - kind(): classified from a streaming peek at the first array element (no full parse);
+      with an index, only files that peek as invoice/product JSONs are hashed and recorded.
+    - doc(): full parse, at most once per file per run.
+    - detail_keys() / prod_keys(): key sets for overlap scoring and the delta-only computation.
+    - csv_fingerprint(): (columns, data rows) of an input CSV, without pandas.
+    With a KeyIndex attached, kinds and key sets come from the on-disk index when the file
+    is unchanged, so discovery over an unchanged archive parses no JSON at all.
+    With keep_docs=False, doc() returns a JsonArrayStream instead of a parsed list: no input is
+    held parsed as a whole, at the cost of re-streaming the file per pass (the key sets kept
+    here still grow with the archive).
+    A file that changes on disk mid-run gets a new stamp and is re-read.
+    Discovery release()s the docs of candidates it rules out, so only the chosen files stay parsed.
+    A registry may outlive a run (RunCache): trim() then drops the parsed docs and every entry
+    whose file changed or is gone, and adopt() / adopt_csv() record what a run knows about the
+    outputs it wrote, so the next run that reads them as inputs starts warm.
+    """
+    def __init__(self, index: Optional[KeyIndex] = None, keep_docs: bool = True):
+        self.index = index
+        self.keep_docs = keep_docs
+        self._kinds: Dict[Tuple, str] = {}
+        self._docs: Dict[Tuple, list] = {}
+        self._keys: Dict[Tuple, frozenset] = {}
+        self._hashes: Dict[Tuple, str] = {}
+        self._csv_prints: Dict[Tuple, Optional[Tuple[int, int]]] = {}
+        self._ids: Dict[Tuple, np.ndarray] = {}
+
+    @staticmethod
+    def _stamp(p: Path) -> Tuple[str, int, int]:
+        st = p.stat()
+        return (str(p.resolve()), st.st_size, st.st_mtime_ns)
+
+    def content_hash(self, p: Path) -> str:
+        k = self._stamp(p)
+        if k not in self._hashes:
+            hit = self.index.lookup(*k) if self.index else None
+            self._hashes[k] = hit[0] if hit else _file_sha256(p)
+        return self._hashes[k]
+
+    def kind(self, p: Path) -> str:
+        k = self._stamp(p)
+        if k not in self._kinds:
+            hit = self.index.lookup(*k) if self.index else None
+            if hit:
+                kind = hit[1]
+            else:
+                # the head peek is cheap; only real candidates are hashed and indexed
+                kind = _classify_json_head(_peek_json_head(p))
+                if self.index and kind != "unknown":
+                    self.index.record_file(*k, self.content_hash(p), kind)
+            self._kinds[k] = kind
+        return self._kinds[k]
+
+    def doc(self, p: Path):
+        """The file's top-level array: a parsed list, or a JsonArrayStream if keep_docs=False."""
+        if not self.keep_docs:
+            return JsonArrayStream(p)
+        k = self._stamp(p)
+        if k not in self._docs:
+            self._docs[k] = _load_json(p)
+        return self._docs[k]
+
+    def release(self, p: Path) -> None:
+        """Drops p's parsed doc (its key sets stay), e.g. once discovery has ruled it out."""
+        self._docs.pop(self._stamp(p), None)
+
+    def trim(self) -> None:
+        """Drops all parsed docs, and the entries of files that changed on disk or are gone."""
+        self._docs.clear()
+        current: Dict[Tuple, bool] = {}
+        for memo in (self._kinds, self._keys, self._hashes, self._csv_prints, self._ids):
+            for k in list(memo):
+                stamp = k[:3]
+                if stamp not in current:
+                    try:
+                        current[stamp] = self._stamp(Path(stamp[0])) == stamp
+                    except OSError:
+                        current[stamp] = False
+                if not current[stamp]:
+                    del memo[k]
+
+    def csv_fingerprint(self, p: Path) -> Optional[Tuple[int, int]]:
+        """(columns, data rows) of a CSV, or None if unreadable; see _csv_fingerprint."""
+        k = self._stamp(p)
+        if k not in self._csv_prints:
+            hit = self.index.csv_fingerprint(*k) if self.index else None
+            if hit is None:
+                hit = _csv_fingerprint(p)
+                if hit is not None and self.index:
+                    self.index.record_csv_fingerprint(*k, *hit)
+            self._csv_prints[k] = hit
+        return self._csv_prints[k]
+
+    def _key_set(self, p: Path, tag: str, fn) -> frozenset:
+        k = self._stamp(p) + (tag,)
+        if k not in self._keys:
+            if self.index:
+                sha = self.content_hash(p)
+                if self.index.has_keys(sha, tag):
+                    self._keys[k] = self.index.get_keys(sha, tag)
+                else:
+                    self._keys[k] = frozenset(fn(self.doc(p)))
+                    self.index.put_keys(sha, tag, self._keys[k])
+            else:
+                self._keys[k] = frozenset(fn(self.doc(p)))
+        return self._keys[k]
+
+    def _ensure_indexed(self, p: Path, tag: str, fn) -> Optional[str]:
+        """sha256 of p with its key set present in the index (parsing only if missing)."""
+        if not self.index:
+            return None
+        sha = self.content_hash(p)
+        if not self.index.has_keys(sha, tag):
+            self._key_set(p, tag, fn)
+        return sha
+
+    @staticmethod
+    def _tag_fn(tag: str):
+        return iter_detail_keys if tag == "detail" else iter_prod_dk_keys
+
+    def detail_keys(self, p: Path) -> frozenset:
+        return self._key_set(p, "detail", iter_detail_keys)
+
+    def detail_ids(self, p: Path) -> np.ndarray:
+        """detail_keys(p) as sorted int64 ids (see detail_key_ids)."""
+        k = self._stamp(p)
+        if k not in self._ids:
+            self._ids[k] = np.sort(detail_key_ids(self.detail_keys(p)))
+        return self._ids[k]
+
+    def prod_keys(self, p: Path) -> frozenset:
+        return self._key_set(p, "prod", iter_prod_dk_keys)
+
+    def overlap(self, a: Path, b: Path, tag: str) -> int:
+        """|keys(a) & keys(b)|; an index lookup when a KeyIndex is attached."""
+        fn = self._tag_fn(tag)
+        if self.index:
+            return self.index.overlap(self._ensure_indexed(a, tag, fn), self._ensure_indexed(b, tag, fn), tag)
+        return len(self._key_set(a, tag, fn) & self._key_set(b, tag, fn))
+
+    def difference(self, a: Path, b: Path, tag: str) -> frozenset:
+        """keys(a) - keys(b), without materialising keys(b) when a KeyIndex is attached."""
+        fn = self._tag_fn(tag)
+        if self.index:
+            return self.index.difference(self._ensure_indexed(a, tag, fn), self._ensure_indexed(b, tag, fn), tag)
+        return self._key_set(a, tag, fn) - self._key_set(b, tag, fn)
+
+    def held_keys(self, paths: List[Path], tag: str) -> Optional[Tuple[frozenset, Optional[np.ndarray]]]:
+        """
+        Union of the paths' key sets (and for "detail" their sorted ids) if this registry holds
+        all of them in memory, else None; no index lookup or parse. Taken before a run writes
+        the output that merges these paths (which may replace one of them), for adopt().
+        """
+        stamps = [self._stamp(p) for p in paths]
+        if not all(k + (tag,) in self._keys for k in stamps):
+            return None
+        keys = frozenset().union(*(self._keys[k + (tag,)] for k in stamps))
+        ids = None
+        if tag == "detail":
+            ids = np.unique(np.concatenate([
+                self._ids[k] if k in self._ids else detail_key_ids(self._keys[k + (tag,)]) for k in stamps]))
+        return keys, ids
+
+    def adopt(self, out: Path, sha: str, kind: str, tag: str,
+              held: Optional[Tuple[frozenset, Optional[np.ndarray]]]) -> None:
+        """Records a JSON output just written: its sha256 and kind, and its key set if held (see held_keys)."""
+        k = self._stamp(out)
+        self._hashes[k] = sha
+        self._kinds[k] = kind
+        if held is not None:
+            self._keys[k + (tag,)] = held[0]
+            if held[1] is not None:
+                self._ids[k] = held[1]
+
+    def adopt_csv(self, out: Path, columns: int, rows: int) -> None:
+        """Records the fingerprint of a CSV just written with `columns` columns and `rows` data rows."""
+        k = self._stamp(out)
+        self._csv_prints[k] = (columns, rows)
+        if self.index:
+            self.index.record_csv_fingerprint(*k, columns, rows)
+
+def _least_overlap(reg: DocRegistry, candidates: List[Path], overlap) -> Path:
+    """
+    Candidate with minimal overlap(path); tie-breaker: bigger file (more complete base).
+    A candidate's parsed doc is released as soon as it loses, so scoring holds at most two.
+    """
+    best = None
+    for p in candidates:
+        scored = (overlap(p), -_file_size(p), p)
+        if best is None or scored < best:
+            if best is not None:
+                reg.release(best[2])
+            best = scored
+        else:
+            reg.release(p)
+    return best[2]
+
+def discover_json_base_delta(dir_: Path, registry: Optional[DocRegistry] = None) -> Dict[str, Tuple[Path, Path]]:
     """
     Finds invoice/product JSONs; for each class picks:
       delta = smallest file
       base  = candidate with minimal overlap with delta (so we avoid already-merged files)
+    Pass a DocRegistry to reuse the parsed docs/key sets in later steps.
     """
+    reg = registry if registry is not None else DocRegistry()
     json_paths = [Path(p) for p in glob.glob(str(dir_ / "*.json"))]
     groups: Dict[str, List[Path]] = {"invoice": [], "product": [], "unknown": []}
 
     for p in json_paths:
-        try:
-            doc = _load_json(p)
-        except Exception:
-            groups["unknown"].append(p)
-            continue
-        groups[_classify_json_doc(doc)].append(p)
+        groups[reg.kind(p)].append(p)
 
     out: Dict[str, Tuple[Path, Path]] = {}
     for kind in ("invoice", "product"):
@@ -221,49 +925,114 @@ def discover_json_base_delta(dir_: Path) -> Dict[str, Tuple[Path, Path]]:
         delta = paths_sorted[0]
         candidates = paths_sorted[1:]
 
-        delta_doc = _load_json(delta)
+        tag = "detail" if kind == "invoice" else "prod"
+        def overlap(path: Path) -> int:
+            return reg.overlap(delta, path, tag)
+
+        out[kind] = (_least_overlap(reg, candidates, overlap), delta)
+
+    return out
 
+def _export_date(invoice_doc) -> str:
+    """Latest order dateEntered in an invoices export (ISO-8601 text, so it sorts as a date)."""
+    return max((o.get("dateEntered") or "" for o in invoice_doc), default="")
+
+def discover_json_base_deltas(dir_: Path, delta_paths: List[Path], registry: Optional[DocRegistry] = None,
+                              base_paths: Optional[List[Path]] = None) -> Dict[str, Tuple[Path, List[Path]]]:
+    """
+    Batch variant of discover_json_base_delta: the deltas are given (any mix of invoice and
+    product JSONs, classified by schema), and for each class the base is picked among the
+    other JSONs in dir_ by the usual rule (minimal overlap with the deltas; bigger file wins ties).
+    base_paths pins the base of each class it contains instead (e.g. the previous merged outputs).
+    Invoice deltas are ordered by export date; product deltas keep the given order.
+    """
+    reg = registry if registry is not None else DocRegistry()
+    pinned = {reg.kind(p): p for p in base_paths or []}
+    given = {p.resolve() for p in delta_paths}
+    json_paths = [Path(p) for p in glob.glob(str(dir_ / "*.json")) if Path(p).resolve() not in given]
+    deltas: Dict[str, List[Path]] = {"invoice": [], "product": [], "unknown": []}
+    groups: Dict[str, List[Path]] = {"invoice": [], "product": [], "unknown": []}
+
+    for p in delta_paths:
+        deltas[reg.kind(p)].append(p)
+    for p in json_paths:
+        groups[reg.kind(p)].append(p)
+    if deltas["unknown"]:
+        raise RuntimeError(f"Not an invoice or product JSON: {', '.join(p.name for p in deltas['unknown'])}")
+
+    out: Dict[str, Tuple[Path, List[Path]]] = {}
+    for kind in ("invoice", "product"):
+        if not deltas[kind]:
+            raise RuntimeError(f"Need >=1 {kind} delta JSON; got none in {[p.name for p in delta_paths]}")
+        if kind in pinned:
+            groups[kind] = [pinned[kind]]
+        if not groups[kind]:
+            raise RuntimeError(f"Need a base {kind} JSON in {dir_} besides the deltas; found none")
+
+        tag = "detail" if kind == "invoice" else "prod"
+        def overlap(path: Path) -> int:
+            return sum(reg.overlap(d, path, tag) for d in deltas[kind])
+
+        base = _least_overlap(reg, groups[kind], overlap)
+        ordered = deltas[kind]
         if kind == "invoice":
-            delta_keys = set(iter_detail_keys(delta_doc))
-            def overlap(path: Path) -> int:
-                base_doc = _load_json(path)
-                base_keys = set(iter_detail_keys(base_doc))
-                return len(base_keys & delta_keys)
-        else:
-            delta_keys = set(iter_prod_dk_keys(delta_doc))
-            def overlap(path: Path) -> int:
-                base_doc = _load_json(path)
-                base_keys = set(iter_prod_dk_keys(base_doc))
-                return len(base_keys & delta_keys)
-
-        # Choose base with minimal overlap; tie-breaker: bigger file (more complete base).
-        scored = [(overlap(p), -_file_size(p), p) for p in candidates]
-        scored.sort()
-        base = scored[0][2]
-        out[kind] = (base, delta)
+            ordered = sorted(ordered, key=lambda p: _export_date(reg.doc(p)))
+        out[kind] = (base, ordered)
 
     return out
 
-def discover_csv_pair(dir_: Path) -> Tuple[Path, Path]:
+def _csv_record_count(p: Path, chunk_size: int = 1 << 20) -> int:
+    """
+    Records in a CSV file, header included: newlines outside double quotes (so quoted
+    multiline fields count once), plus an unterminated last line. Buffered bytes scan;
+    "" escapes toggle the quote state twice, so they need no special casing.
+    """
+    n = 0
+    in_quotes = False
+    last = b"\n"
+    with p.open("rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if not in_quotes and b'"' not in chunk:
+                n += chunk.count(b"\n")
+            else:
+                parts = chunk.split(b'"')
+                n += sum(part.count(b"\n") for part in parts[in_quotes::2])
+                in_quotes ^= (len(parts) - 1) % 2 == 1
+            last = chunk[-1:]
+    return n + (last != b"\n")
+
+def _csv_fingerprint(p: Path) -> Optional[Tuple[int, int]]:
+    """(columns, data rows): header via the csv module, rows via _csv_record_count. None if unreadable."""
+    try:
+        with p.open("r", encoding="utf-8", errors="ignore", newline="") as f:
+            header = next(csv.reader(f), None)
+    except (OSError, csv.Error):
+        return None
+    if not header:
+        return None
+    return len(header), _csv_record_count(p) - 1
+
+def discover_csv_pair(dir_: Path, registry: Optional[DocRegistry] = None) -> Tuple[Path, Path]:
     """
     Returns (full_csv, mini_csv).
     Uses rule: mini has far fewer columns and same row count as full.
     Fallback: smallest file = mini, largest = full.
+    Column/row counts come from a cheap fingerprint (no pandas parse), cached by the registry.
     """
+    reg = registry if registry is not None else DocRegistry()
     csv_paths = [Path(p) for p in glob.glob(str(dir_ / "*.csv"))]
     if len(csv_paths) < 2:
         raise RuntimeError(f"Need >=2 CSVs in {dir_}; found {len(csv_paths)}")
 
     info = []
     for p in csv_paths:
-        try:
-            df0 = pd.read_csv(p, nrows=1)
-            ncols = len(df0.columns)
-        except Exception:
+        fp = reg.csv_fingerprint(p)
+        if fp is None:
             continue
-
-        with p.open("r", encoding="utf-8", errors="ignore") as f:
-            nrows = sum(1 for _ in f) - 1
+        ncols, nrows = fp
         info.append((p, _file_size(p), ncols, nrows))
 
     if not info:
@@ -287,23 +1056,97 @@ def discover_csv_pair(dir_: Path) -> Tuple[Path, Path]:
 # Core transforms
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _detail_key(d) -> tuple:
+    inv_id = d.get("invoiceId")
+    det_id = d.get("detailId")
+    if inv_id is not None and det_id is not None:
+        return (inv_id, det_id)
+    return (inv_id,
+            d.get("digiKeyProductNumber"),
+            d.get("manufacturerProductNumber"),
+            d.get("quantityShipped"),
+            d.get("extendedPrice"))
+
+# Detail keys as int64 ids. The common (invoiceId, detailId) key is packed arithmetically
+# (invoiceId << 20 | detailId), so building it allocates nothing and decodes exactly; any other
+# key (the 5-tuple fallback, out-of-range or non-int ids) maps to a negative 63-bit hash of
+# its JSON form. Both are stable across processes and runs. A hashed id can only be decoded
+# back inside the detail_key_scope() that encoded it (run_pipeline opens one per run).
+_DET_ID_BITS = 20
+_INV_ID_LIMIT = 1 << 42
+_fallback_keys: Optional[Dict[int, tuple]] = None
+
+@contextlib.contextmanager
+def detail_key_scope():
+    """Remembers the fallback keys encoded inside the block (nested blocks share the outer map)."""
+    global _fallback_keys
+    outer = _fallback_keys
+    if outer is None:
+        _fallback_keys = {}
+    try:
+        yield
+    finally:
+        _fallback_keys = outer
+
+def _packable(inv_id, det_id) -> bool:
+    return (type(inv_id) is int and type(det_id) is int
+            and 0 <= inv_id < _INV_ID_LIMIT and 0 <= det_id < (1 << _DET_ID_BITS))
+
+def encode_detail_key(key: tuple) -> int:
+    if len(key) == 2 and _packable(*key):
+        return (key[0] << _DET_ID_BITS) | key[1]
+    digest = hashlib.blake2b(json.dumps(list(key)).encode("utf-8"), digest_size=8).digest()
+    kid = -(int.from_bytes(digest, "big") >> 1) - 1
+    if _fallback_keys is not None:
+        _fallback_keys[kid] = key
+    return kid
+
+def detail_key_id(d) -> int:
+    """encode_detail_key(_detail_key(d)) without building the tuple in the common case."""
+    inv_id = d.get("invoiceId")
+    det_id = d.get("detailId")
+    if _packable(inv_id, det_id):
+        return (inv_id << _DET_ID_BITS) | det_id
+    return encode_detail_key(_detail_key(d))
+
+def decode_detail_key(kid: int) -> tuple:
+    """Original key tuple for an id; KeyError for a fallback id not encoded in the current scope."""
+    kid = int(kid)
+    if kid >= 0:
+        return (kid >> _DET_ID_BITS, kid & ((1 << _DET_ID_BITS) - 1))
+    if _fallback_keys is None or kid not in _fallback_keys:
+        raise KeyError(f"detail key id {kid} is a hashed fallback key not encoded in this scope")
+    return _fallback_keys[kid]
+
+def _key_label(kid: int) -> str:
+    """A detail key id for error messages: its key tuple when it can be decoded, else the id."""
+    try:
+        return str(decode_detail_key(kid))
+    except KeyError:
+        return f"id {int(kid)}"
+
+def detail_key_ids(keys) -> np.ndarray:
+    """int64 ids for an iterable of detail keys (tuples); ids pass through unchanged."""
+    if isinstance(keys, np.ndarray):
+        return keys.astype(np.int64, copy=False)
+    return np.fromiter((k if isinstance(k, (int, np.integer)) else encode_detail_key(k) for k in keys),
+                       dtype=np.int64)
+
 def iter_detail_keys(invoice_doc):
     """
     Generates a stable-ish uniqueness key for invoiceDetails.
     Prefer (invoiceId, detailId). Fallback includes product/qty/price fields.
+    Like the other transforms, accepts any iterable of orders (parsed list or stream).
     """
     for order in invoice_doc:
         for d in order.get("invoiceDetails", []):
-            inv_id = d.get("invoiceId")
-            det_id = d.get("detailId")
-            if inv_id is not None and det_id is not None:
-                yield (inv_id, det_id)
-            else:
-                yield (inv_id,
-                       d.get("digiKeyProductNumber"),
-                       d.get("manufacturerProductNumber"),
-                       d.get("quantityShipped"),
-                       d.get("extendedPrice"))
+            yield _detail_key(d)
+
+def iter_invoice_dks(invoice_doc):
+    """DK part number of every invoice detail (repeats included)."""
+    for order in invoice_doc:
+        for d in order.get("invoiceDetails", []):
+            yield d.get("digiKeyProductNumber", "")
 
 def iter_prod_dk_keys(products_doc):
     for p in products_doc:
@@ -315,6 +1158,7 @@ def iter_prod_dk_keys(products_doc):
 def build_prod_by_dk(products_base, products_delta):
     """
     Base precedence: if dk_pn exists in base, delta does not override it.
+    (Several deltas chained in date order: an earlier delta also wins over a later one.)
     This is what makes the “excluding new entries, data identical” assertion meaningful.
     """
     lut = {}
@@ -330,6 +1174,216 @@ def build_prod_by_dk(products_base, products_delta):
                 lut[dk] = p
     return lut
 
+class ProductCatalog:
+    """
+    Persistent product store (SQLite): each product JSON entry once (by content hash), indexed
+    by every variation's digiKeyProductNumber and by manufacturerProductNumber.
+    - parts / mfr_parts: global lookups across everything ingested, first seen wins (ad-hoc tools).
+    - source_parts: dk -> product per product file (sha256), first seen within that file;
+      view([base, delta, ...]) resolves a run's lookups with build_prod_by_dk's precedence.
+    - source_products: which product entries each file holds (also those without variations).
+    - facts: product_facts() per (product, dk), tagged with the _facts_signature() they were
+      derived under (see ProductEnrichment).
+    Each product file is ingested once; a merged output is registered from its parts in SQL,
+    so the next run's base needs no parse for lookups. prune() forgets the files that are no
+    longer indexed, and with them every product entry no remaining file holds.
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._con = _open_cache_db(db_path)
+        with self._con:
+            self._con.executescript("""
+                CREATE TABLE IF NOT EXISTS products (prod_hash TEXT PRIMARY KEY, doc TEXT) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS parts (dk TEXT PRIMARY KEY, prod_hash TEXT) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS mfr_parts (
+                    mfr_pn TEXT, prod_hash TEXT, PRIMARY KEY (mfr_pn, prod_hash)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS sources (sha256 TEXT PRIMARY KEY) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS source_parts (
+                    sha256 TEXT, dk TEXT, prod_hash TEXT, PRIMARY KEY (sha256, dk)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS source_products (
+                    sha256 TEXT, prod_hash TEXT, PRIMARY KEY (sha256, prod_hash)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS source_products_hash ON source_products (prod_hash);
+                CREATE TABLE IF NOT EXISTS facts (
+                    prod_hash TEXT, dk TEXT, signature TEXT, facts TEXT, PRIMARY KEY (prod_hash, dk)) WITHOUT ROWID;
+            """)
+
+    def close(self) -> None:
+        self._con.close()
+
+    def has_source(self, sha: str) -> bool:
+        return self._con.execute("SELECT 1 FROM sources WHERE sha256=?", (sha,)).fetchone() is not None
+
+    def ingest(self, sha: str, products) -> None:
+        """Adds a product file (any iterable of product entries) unless its content is already in."""
+        if self.has_source(sha):
+            return
+        with self._con:
+            for p in products:
+                h = _product_hash(p)
+                self._con.execute("INSERT OR IGNORE INTO products VALUES (?,?)",
+                                  (h, json.dumps(p, ensure_ascii=False, separators=(",", ":"))))
+                self._con.execute("INSERT OR IGNORE INTO source_products VALUES (?,?)", (sha, h))
+                mfr_pn = p.get("manufacturerProductNumber")
+                if mfr_pn:
+                    self._con.execute("INSERT OR IGNORE INTO mfr_parts VALUES (?,?)", (mfr_pn, h))
+                for v in p.get("productVariations", []):
+                    dk = v.get("digiKeyProductNumber")
+                    if dk:
+                        self._con.execute("INSERT OR IGNORE INTO source_parts VALUES (?,?,?)", (sha, dk, h))
+                        self._con.execute("INSERT OR IGNORE INTO parts VALUES (?,?)", (dk, h))
+            self._con.execute("INSERT INTO sources VALUES (?)", (sha,))
+
+    def record_merged(self, sha: str, parts: List[str]) -> None:
+        """Registers a merged output (parts concatenated in order) without reading it."""
+        if self.has_source(sha) or not all(self.has_source(part) for part in parts):
+            return
+        with self._con:
+            for part in parts:
+                self._con.execute("INSERT OR IGNORE INTO source_parts "
+                                  "SELECT ?, dk, prod_hash FROM source_parts WHERE sha256=?", (sha, part))
+                self._con.execute("INSERT OR IGNORE INTO source_products "
+                                  "SELECT ?, prod_hash FROM source_products WHERE sha256=?", (sha, part))
+            self._con.execute("INSERT INTO sources VALUES (?)", (sha,))
+
+    def prune(self, live: set) -> None:
+        """
+        Forgets the product files whose sha256 is not in live (see KeyIndex.prune), then the
+        product entries no remaining file holds; a global lookup that pointed at one of those
+        is re-pointed at a remaining file's entry for the same part, if any.
+        """
+        dead = [(sha,) for (sha,) in self._con.execute("SELECT sha256 FROM sources").fetchall()
+                if sha not in live]
+        if not dead:
+            return
+        with self._con:
+            for table in ("source_parts", "source_products", "sources"):
+                self._con.executemany(f"DELETE FROM {table} WHERE sha256=?", dead)
+            orphans = "prod_hash NOT IN (SELECT prod_hash FROM source_products)"
+            for table in ("products", "mfr_parts", "facts"):
+                self._con.execute(f"DELETE FROM {table} WHERE {orphans}")
+            if self._con.execute(f"DELETE FROM parts WHERE {orphans}").rowcount:
+                self._con.execute("INSERT OR IGNORE INTO parts SELECT dk, prod_hash FROM source_parts")
+        self._con.execute("PRAGMA incremental_vacuum")
+
+    def product(self, prod_hash: str) -> Optional[dict]:
+        row = self._con.execute("SELECT doc FROM products WHERE prod_hash=?", (prod_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def lookup(self, dk: str) -> Optional[dict]:
+        """Product for a DK part number, first seen across everything ingested."""
+        row = self._con.execute("SELECT prod_hash FROM parts WHERE dk=?", (dk,)).fetchone()
+        return self.product(row[0]) if row else None
+
+    def find_mfr_pn(self, mfr_pn: str) -> List[dict]:
+        """Every stored product entry with this manufacturer part number."""
+        rows = self._con.execute("SELECT prod_hash FROM mfr_parts WHERE mfr_pn=?", (mfr_pn,)).fetchall()
+        return [self.product(h) for (h,) in rows]
+
+    def facts(self, prod_hashes: Dict[str, str], signature: str, batch: int = 500) -> Dict[str, dict]:
+        """dk -> product facts stored for (prod_hashes[dk], dk) under `signature` (see ProductEnrichment)."""
+        want = {(h, dk) for dk, h in prod_hashes.items()}
+        found = {}
+        for chunk in _chunked(sorted({h for h, _ in want}), batch):
+            for h, dk, f in self._con.execute(
+                    f"SELECT prod_hash, dk, facts FROM facts WHERE signature=? "
+                    f"AND prod_hash IN ({','.join('?' * len(chunk))})", [signature, *chunk]):
+                if (h, dk) in want:
+                    found[dk] = json.loads(f)
+        return found
+
+    def put_facts(self, rows: List[Tuple[str, str, Dict[str, object]]], signature: str) -> None:
+        """Stores (prod_hash, dk, facts) rows derived under `signature`, replacing older ones."""
+        with self._con:
+            self._con.executemany("INSERT OR REPLACE INTO facts VALUES (?,?,?,?)",
+                                  ((h, dk, signature, json.dumps(f, ensure_ascii=False)) for h, dk, f in rows))
+
+    def view(self, shas: List[str]) -> "CatalogView":
+        return CatalogView(self.db_path, shas)
+
+    def iter_products(self):
+        """Each product entry that some DK part number currently resolves to (see lookup)."""
+        for (doc,) in self._con.execute(
+                "SELECT doc FROM products WHERE prod_hash IN (SELECT DISTINCT prod_hash FROM parts)"):
+            yield json.loads(doc)
+
+class CatalogView:
+    """
+    Read-only dk -> product mapping over a ProductCatalog, restricted to the given product files
+    in precedence order: what build_prod_by_dk(base, delta) returns, without loading the files.
+    The dk -> product hash map is loaded with one query on first use; preload(dks) then fetches
+    the entries a build will ask for in batches, instead of one query per part in get().
+    Each product entry is decoded once per process. Picklable (workers reopen the db by path).
+    """
+    def __init__(self, db_path: Path, shas: List[str]):
+        self.db_path = db_path
+        self.shas = list(shas)
+        self._rank = {sha: i for i, sha in enumerate(self.shas)}
+        self._con = None
+        self._hashes: Optional[Dict[str, str]] = None
+        self._memo: Dict[object, Optional[dict]] = {}
+        self._docs: Dict[str, dict] = {}
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "shas": self.shas}
+
+    def __setstate__(self, state):
+        self.__init__(state["db_path"], state["shas"])
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is None:
+            self._con = sqlite3.connect(str(self.db_path))
+        return self._con
+
+    def prod_hashes(self) -> Dict[str, str]:
+        """dk -> product hash for every part the view resolves."""
+        if self._hashes is None:
+            rows = self._db().execute(
+                f"SELECT sha256, dk, prod_hash FROM source_parts "
+                f"WHERE sha256 IN ({','.join('?' * len(self.shas))})", self.shas).fetchall()
+            # later files first, so the earliest file's entry for a dk is the one kept
+            rows.sort(key=lambda r: self._rank[r[0]], reverse=True)
+            self._hashes = {dk: h for _, dk, h in rows}
+        return self._hashes
+
+    def preload(self, dks, batch: int = 500) -> None:
+        """Fetches and decodes the product entries of dks not loaded yet."""
+        hashes = self.prod_hashes()
+        todo = list({hashes[dk] for dk in dks if dk in hashes} - self._docs.keys())
+        for chunk in _chunked(todo, batch):
+            for h, doc in self._db().execute(
+                    f"SELECT prod_hash, doc FROM products WHERE prod_hash IN ({','.join('?' * len(chunk))})", chunk):
+                self._docs[h] = json.loads(doc)
+
+    def get(self, dk, default=None):
+        if dk not in self._memo:
+            h = self.prod_hashes().get(dk)
+            prod = None
+            if h is not None:
+                if h not in self._docs:
+                    row = self._db().execute("SELECT doc FROM products WHERE prod_hash=?", (h,)).fetchone()
+                    self._docs[h] = json.loads(row[0])
+                prod = self._docs[h]
+            self._memo[dk] = prod
+        prod = self._memo[dk]
+        return default if prod is None else prod
+
+    def __getitem__(self, dk):
+        prod = self.get(dk)
+        if prod is None:
+            raise KeyError(dk)
+        return prod
+
+    def __contains__(self, dk) -> bool:
+        return self.get(dk) is not None
+
+    def __len__(self) -> int:
+        return len(self.prod_hashes())
+
+    def close(self) -> None:
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
 def category_t2(prod):
     if not prod:
         return ""
@@ -353,6 +1407,81 @@ def is_mcu_product(prod):
     s = " ".join(n.lower() for n in names)
     return ("microcontroller" in s) or ("application specific microcontrollers" in s)
 
+def _category_leaf(cat) -> Optional[dict]:
+    """Deepest node of a category chain (cat non-empty); None if the tree branches."""
+    while True:
+        children = cat.get("childCategories") or []
+        if len(children) > 1:
+            return None
+        if not children or not children[0]:
+            return cat
+        cat = children[0]
+
+def _category_entry(cat) -> Tuple[str, str, bool, List[str]]:
+    """(top-level name, category_t2 name, is_mcu_product flag, names top -> leaf) of a category chain."""
+    names = []
+    c = cat
+    while c:
+        names.append(c.get("name", ""))
+        children = c.get("childCategories") or []
+        c = children[0] if children else None
+    t1 = names[0] if names else ""
+    t2 = (names[1] or t1) if len(names) > 1 else t1
+    s = " ".join(n.lower() for n in names)
+    return t1, t2, "microcontroller" in s, names
+
+# Columns of the category dimension table (CategoryIndex.frame / category_table=True).
+CATEGORY_TABLE_COLUMNS: List[str] = ["category_id", "category_t1", "category", "category_path", "is_mcu"]
+
+class CategoryIndex:
+    """
+    Category dimension: per leaf categoryId (of the products' nested `category` chains) its
+    top-level name, second-level name (category_t2, the rows' `category`) and the
+    is_mcu_product flag, derived from the first product seen with that leaf. classify() is
+    then one dict lookup by the leaf id, checked against the top-level, second-level and leaf
+    names; a miss is derived and stored, and a name conflict (e.g. a renamed category) is
+    derived without being stored. Trees that branch use category_t2 / is_mcu_product directly.
+    """
+    def __init__(self, products=()):
+        self._by_leaf: Dict[object, Tuple[str, str, bool, List[str]]] = {}
+        for prod in products:
+            self.classify(prod)
+
+    def __len__(self) -> int:
+        return len(self._by_leaf)
+
+    def classify(self, prod) -> Tuple[str, bool]:
+        """(category_t2(prod), is_mcu_product(prod))."""
+        cat = prod.get("category") if prod else None
+        if not cat:
+            return "", False
+        leaf = _category_leaf(cat)
+        if leaf is None:
+            return category_t2(prod), is_mcu_product(prod)
+        leaf_id = leaf.get("categoryId")
+        e = self._by_leaf.get(leaf_id)
+        if e is None or not self._same_names(e[3], cat, leaf):
+            conflict = e is not None
+            e = _category_entry(cat)
+            if leaf_id is not None and not conflict:
+                self._by_leaf[leaf_id] = e
+        return e[1], e[2]
+
+    @staticmethod
+    def _same_names(names: List[str], cat: dict, leaf: dict) -> bool:
+        if names[0] != cat.get("name", "") or names[-1] != leaf.get("name", ""):
+            return False
+        if leaf is cat:
+            return len(names) == 1
+        return len(names) > 1 and names[1] == cat["childCategories"][0].get("name", "")
+
+    def frame(self) -> pd.DataFrame:
+        """One row per leaf categoryId (CATEGORY_TABLE_COLUMNS), ordered by path."""
+        rows = [(leaf_id, t1, t2, " > ".join(n or "" for n in names), mcu)
+                for leaf_id, (t1, t2, mcu, names) in self._by_leaf.items()]
+        rows.sort(key=lambda r: (r[3], str(r[0])))
+        return pd.DataFrame(rows, columns=CATEGORY_TABLE_COLUMNS, dtype=object)
+
 def extract_mcu_fields(prod):
     params = { prm.get("parameterText",""): prm.get("valueText","")
                for prm in (prod.get("parameters") or []) }
@@ -386,108 +1515,313 @@ def build_other_params_dict(prod):
         out[k] = prm.get("valueText","")
     return out
 
-def build_rows(invoices_doc, prod_by_dk, new_detail_keys: Optional[set]=None):
+# Row columns derived from the product alone (per DK part number), in row order.
+PRODUCT_FACT_COLUMNS: List[str] = [
+    "category", "series", "product_status", "package_type",
+    "core_processor", "core_type", "clock_speed", "program_memory_size",
+    "other_parameters",
+]
+
+def product_facts(prod, dk, categories: Optional[CategoryIndex] = None) -> Dict[str, object]:
+    """Values of PRODUCT_FACT_COLUMNS for one DK part number (prod may be None)."""
+    if categories is not None:
+        t2, mcu = categories.classify(prod)
+    else:
+        t2, mcu = category_t2(prod), is_mcu_product(prod)
+    f = {"category": t2}
+
+    if prod:
+        f["series"] = (prod.get("series") or {}).get("name","")
+        f["product_status"] = (prod.get("productStatus") or {}).get("status","")
+        pt = ""
+        for v in prod.get("productVariations", []):
+            if v.get("digiKeyProductNumber") == dk:
+                pt = (v.get("packageType") or {}).get("name","")
+                break
+        f["package_type"] = pt
+    else:
+        f["series"] = ""
+        f["product_status"] = ""
+        f["package_type"] = ""
+
+    if prod and mcu:
+        cp, ct, clk, pm = extract_mcu_fields(prod)
+        f["core_processor"] = cp
+        f["core_type"] = ct
+        f["clock_speed"] = clk
+        f["program_memory_size"] = pm
+    else:
+        f["core_processor"] = ""
+        f["core_type"] = ""
+        f["clock_speed"] = ""
+        f["program_memory_size"] = ""
+
+    # Only the serialized blob is kept: rows share it per DK part (see ProductEnrichment), and
+    # promotion expands it into dicts once per distinct blob when it is actually needed.
+    f["other_parameters"] = json.dumps(build_other_params_dict(prod), ensure_ascii=False)
+    return f
+
+# Bump whenever product_facts() or the rules it uses (category / MCU classification, MCU
+# field extraction) change: incremental runs refuse to extend rows built by another version.
+FACTS_VERSION = 1
+
+def _facts_signature() -> str:
+    """Everything besides the product entry itself that a row's product facts depend on."""
+    return json.dumps({"version": FACTS_VERSION, "columns": PRODUCT_FACT_COLUMNS,
+                       "mcu_param_texts": MCU_PROMOTED_PARAM_TEXTS})
+
+def _product_hash(prod) -> str:
+    blob = json.dumps(prod, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+class ProductEnrichment:
     """
-    Builds 1 row per invoiceDetail.
+    product_facts() per DK part number, computed at most once per run and shared by every
+    invoice line (and both build passes) that bought the part, so rows share one facts dict
+    (and one other_parameters string) per part.
+    With a catalog and the dk -> product hash map of prod_by_dk (CatalogView.prod_hashes, so no
+    product is hashed), preload() persists them: facts stored for the same (product hash, dk)
+    under the current _facts_signature() are reused without decoding the product entry, the
+    rest are derived and stored. A pickled copy (for build workers) keeps only the memo.
+    """
+    def __init__(self, prod_by_dk, categories: Optional[CategoryIndex] = None,
+                 catalog: Optional[ProductCatalog] = None, prod_hashes: Optional[Dict[str, str]] = None):
+        self.prod_by_dk = prod_by_dk
+        self.categories = categories if categories is not None else CategoryIndex()
+        self.catalog = catalog
+        self.prod_hashes = prod_hashes
+        self._memo: Dict[object, Dict[str, object]] = {}
+
+    def __getstate__(self):
+        return {**self.__dict__, "catalog": None, "prod_hashes": None}
+
+    def preload(self, dks) -> None:
+        """Fills the memo for dks: stored facts first, then derived ones (stored for next time)."""
+        todo = set(dks) - self._memo.keys()
+        keys: Dict[str, str] = {}
+        if self.catalog is not None and self.prod_hashes is not None:
+            keys = {dk: self.prod_hashes[dk] for dk in todo if dk in self.prod_hashes}
+            stored = self.catalog.facts(keys, _facts_signature())
+            self._memo.update(stored)
+            todo -= stored.keys()
+        if isinstance(self.prod_by_dk, CatalogView):
+            self.prod_by_dk.preload(todo)
+        for dk in todo:
+            self.facts(dk)
+        if keys and todo:
+            self.catalog.put_facts([(keys[dk], dk, self._memo[dk]) for dk in todo if dk in keys],
+                                   _facts_signature())
+
+    def facts(self, dk) -> Dict[str, object]:
+        f = self._memo.get(dk)
+        if f is None:
+            f = self._memo[dk] = product_facts(self.prod_by_dk.get(dk), dk, self.categories)
+        return f
+
+# Row fields taken from the invoice detail itself (and its invoice), in row order around
+# PRODUCT_FACT_COLUMNS ("category" follows "description"; the rest follow "date_shipped").
+_DETAIL_COLUMNS: List[str] = ["_detail_key", "_qty_bought", "description", "dk_pn", "mfr_pn", "mfr",
+                              "qty_shipped", "gbp_unit_price", "gbp_ext_price", "invoice_id",
+                              "date_shipped", *NUMERIC_COLUMNS]
+
+def build_frame(invoices_doc, prod_by_dk, new_detail_keys: Optional[set]=None,
+                enrichment: Optional[ProductEnrichment]=None) -> pd.DataFrame:
+    """
+    Builds 1 row per invoiceDetail (the first line seen for each detail key).
     Adds internal columns for assertions:
-      _detail_key, _is_new, _qty_bought, _other_dict
+      _detail_key, _is_new, _qty_bought
+    _detail_key is the int64 id of the line's key (decode_detail_key recovers the tuple);
+    new_detail_keys may hold key tuples or ids.
+    Invoice details are flattened into one tuple per line in a single pass and transposed
+    into columns; every product-derived column is computed once per distinct DK part number
+    (through `enrichment`, which can be shared between builds) and joined on by integer code.
+    other_parameters is categorical: each distinct blob is held once and rows hold codes.
+    """
+    return pd.DataFrame(_frame_columns(invoices_doc, prod_by_dk, new_detail_keys, enrichment))
+
+def build_rows(invoices_doc, prod_by_dk, new_detail_keys: Optional[set]=None,
+               enrichment: Optional[ProductEnrichment]=None) -> List[Dict[str, object]]:
+    """build_frame's rows as one dict per row (same columns and values)."""
+    cols = _frame_columns(invoices_doc, prod_by_dk, new_detail_keys, enrichment)
+    return [dict(zip(cols, vals)) for vals in zip(*cols.values())]
+
+def _frame_columns(invoices_doc, prod_by_dk, new_detail_keys: Optional[set]=None,
+                   enrichment: Optional[ProductEnrichment]=None) -> Dict[str, list]:
     """
+    build_frame's column lists, in output column order (before DataFrame construction);
+    other_parameters is already the pd.Categorical the frame holds.
+    """
+    recs = []
+    codes: List[int] = []
+    code_of: Dict[object, int] = {}
     seen = set()
-    rows = []
     for order in invoices_doc:
         inv_by_id = {inv.get("invoiceId"): inv for inv in order.get("invoices", [])}
         for d in order.get("invoiceDetails", []):
-            inv_id = d.get("invoiceId")
-            det_id = d.get("detailId")
-            if inv_id is not None and det_id is not None:
-                key = (inv_id, det_id)
-            else:
-                key = (inv_id,
-                       d.get("digiKeyProductNumber"),
-                       d.get("manufacturerProductNumber"),
-                       d.get("quantityShipped"),
-                       d.get("extendedPrice"))
+            key = detail_key_id(d)
             if key in seen:
                 continue
             seen.add(key)
 
             dk = d.get("digiKeyProductNumber", "")
-            prod = prod_by_dk.get(dk)
+            inv_id = d.get("invoiceId")
             inv = inv_by_id.get(inv_id)
+            recs.append((key, d.get("quantityInitial", ""), d.get("description",""), dk,
+                         d.get("manufacturerProductNumber",""), d.get("manufacturerName",""),
+                         d.get("quantityShipped",""), d.get("formattedUnitPrice",""),
+                         d.get("formattedExtendedPrice",""), inv_id if inv_id is not None else "",
+                         inv.get("dateShipped","") if inv else "",
+                         d.get("quantityShipped"), d.get("unitPrice"), d.get("extendedPrice")))
+            codes.append(code_of.setdefault(dk, len(code_of)))
+    cols: Dict[str, list] = (dict(zip(_DETAIL_COLUMNS, map(list, zip(*recs)))) if recs
+                             else {c: [] for c in _DETAIL_COLUMNS})
+    del recs
+
+    # Delta membership as one vectorised integer join
+    if new_detail_keys is not None and len(new_detail_keys):
+        cols["_is_new"] = np.isin(np.asarray(cols["_detail_key"], dtype=np.int64),
+                                  detail_key_ids(new_detail_keys)).tolist()
+    else:
+        cols["_is_new"] = [False] * len(cols["_detail_key"])
+
+    # Product dimension: one row per distinct DK part number, joined by code
+    enrichment = enrichment or ProductEnrichment(prod_by_dk)
+    dims = [enrichment.facts(dk) for dk in code_of]
+    take = np.asarray(codes, dtype=np.intp)
+    for c in PRODUCT_FACT_COLUMNS:
+        dim = np.empty(len(dims), dtype=object)
+        dim[:] = [f[c] for f in dims]
+        if c == "other_parameters":
+            dim_codes, blobs = pd.factorize(dim)
+            cols[c] = pd.Categorical.from_codes(dim_codes[take], categories=blobs)
+        else:
+            cols[c] = dim[take].tolist()
 
-            r = {}
-            r["_detail_key"] = key
-            r["_is_new"] = bool(new_detail_keys and key in new_detail_keys)
-            r["_qty_bought"] = d.get("quantityInitial", "")
-
-            r["description"] = d.get("description","")
-            r["category"] = category_t2(prod)
-            r["dk_pn"] = dk
-            r["mfr_pn"] = d.get("manufacturerProductNumber","")
-            r["mfr"] = d.get("manufacturerName","")
-
-            r["qty_shipped"] = d.get("quantityShipped","")
-            r["gbp_unit_price"] = d.get("formattedUnitPrice","")
-            r["gbp_ext_price"] = d.get("formattedExtendedPrice","")
-
-            r["invoice_id"] = inv_id if inv_id is not None else ""
-            r["date_shipped"] = inv.get("dateShipped","") if inv else ""
-
-            if prod:
-                r["series"] = (prod.get("series") or {}).get("name","")
-                r["product_status"] = (prod.get("productStatus") or {}).get("status","")
-                pt = ""
-                for v in prod.get("productVariations", []):
-                    if v.get("digiKeyProductNumber") == dk:
-                        pt = (v.get("packageType") or {}).get("name","")
-                        break
-                r["package_type"] = pt
-            else:
-                r["series"] = ""
-                r["product_status"] = ""
-                r["package_type"] = ""
-
-            if prod and is_mcu_product(prod):
-                cp, ct, clk, pm = extract_mcu_fields(prod)
-                r["core_processor"] = cp
-                r["core_type"] = ct
-                r["clock_speed"] = clk
-                r["program_memory_size"] = pm
-            else:
-                r["core_processor"] = ""
-                r["core_type"] = ""
-                r["clock_speed"] = ""
-                r["program_memory_size"] = ""
+    n_num = len(NUMERIC_COLUMNS)
+    order_ = (["_detail_key", "_is_new"] + _DETAIL_COLUMNS[1:3] + ["category"] + _DETAIL_COLUMNS[3:-n_num]
+              + PRODUCT_FACT_COLUMNS[1:] + _DETAIL_COLUMNS[-n_num:])
+    return {c: cols[c] for c in order_}
+
+def declare_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Casts NUMERIC_COLUMNS to their declared (nullable integer) dtypes, in place."""
+    for c, dtype in NUMERIC_COLUMNS.items():
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c]).astype(dtype)
+    return df
 
-            other_dict = build_other_params_dict(prod)
-            r["_other_dict"] = other_dict
-            r["other_parameters"] = json.dumps(other_dict, ensure_ascii=False)
 
-            rows.append(r)
-    return rows
+# ─────────────────────────────────────────────────────────────────────────────
+# Parallel build (workers > 1)
+# ─────────────────────────────────────────────────────────────────────────────
+
+_SHARD_CTX: Dict[str, object] = {}
+
+def _init_shard_worker(enrichment: ProductEnrichment, new_ids: Optional[np.ndarray]) -> None:
+    _SHARD_CTX["enrichment"] = enrichment
+    _SHARD_CTX["new_ids"] = new_ids
+
+def _build_shard(args):
+    orders, mark_new = args
+    enrichment = _SHARD_CTX["enrichment"]
+    return _frame_columns(orders, enrichment.prod_by_dk, _SHARD_CTX["new_ids"] if mark_new else None, enrichment)
+
+def _chunked(iterable, n: int):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+def make_build_pool(prod_by_dk, workers: int, new_detail_keys: Optional[set] = None,
+                    enrichment: Optional[ProductEnrichment] = None) -> ProcessPoolExecutor:
+    """
+    Process pool for build_parallel whose workers each hold prod_by_dk (with the facts memo of
+    `enrichment`, if given, e.g. after its preload()) and the ids of new_detail_keys, sent once
+    per worker rather than with every shard.
+    """
+    new_ids = detail_key_ids(new_detail_keys) if new_detail_keys else None
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_shard_worker,
+                               initargs=(enrichment or ProductEnrichment(prod_by_dk), new_ids))
+
+def build_parallel(pool: ProcessPoolExecutor, invoices_doc, mark_new: bool = False,
+                   shard_size: int = 250) -> pd.DataFrame:
+    """
+    Shards orders across `pool` (see make_build_pool), each shard deduped locally, then merges
+    the shards in order and dedups across them keeping the first occurrence. The result is the
+    frame build_frame produces, with _is_new set from the pool's new_detail_keys if mark_new.
+    """
+    parts = list(pool.map(_build_shard, ((chunk, mark_new) for chunk in _chunked(invoices_doc, shard_size))))
+    if not parts:
+        return build_frame([], {})
+    ids = np.fromiter(itertools.chain.from_iterable(part["_detail_key"] for part in parts), dtype=np.int64)
+    _, first = np.unique(ids, return_index=True)
+    keep = np.zeros(len(ids), dtype=bool)
+    keep[first] = True
+    cols = {}
+    for c in parts[0]:
+        if c == "other_parameters":
+            # one category per distinct blob again, however many shards carried it
+            merged = pd.api.types.union_categoricals([part[c] for part in parts])
+            cols[c] = merged if keep.all() else merged[keep]
+        else:
+            merged = list(itertools.chain.from_iterable(part[c] for part in parts))
+            cols[c] = merged if keep.all() else list(itertools.compress(merged, keep))
+    return pd.DataFrame(cols)
+
+def _run_jobs(jobs, workers: int) -> list:
+    """Runs independent callables, concurrently on threads when workers > 1; results in job order."""
+    if workers <= 1:
+        return [job() for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+        futures = [ex.submit(job) for job in jobs]
+        return [f.result() for f in futures]
+
+def _promote_other_params(df: pd.DataFrame, promote: Dict[str, str]) -> None:
+    """
+    Promotion engine for apply_schema_mutations, in place.
+    Rows share their parameter blob with every other purchase of the same product, so the
+    blobs are factorized once and each distinct blob is parsed into a dict only here.
+    All promoted keys are picked and the stripped blob re-serialised once per distinct blob,
+    then every column is broadcast back to the rows with a single take.
+    """
+    if not len(df):
+        for new_col in promote.values():
+            df[new_col] = ""
+        return
+    codes, uniques = pd.factorize(df["other_parameters"], use_na_sentinel=False)
+    dicts = [json.loads(u) if isinstance(u, str) and u else {} for u in uniques]
+
+    picked = {new_col: np.empty(len(uniques), dtype=object) for new_col in promote.values()}
+    stripped = np.empty(len(uniques), dtype=object)
+    for i, d in enumerate(dicts):
+        d = d or {}
+        for src_key, new_col in promote.items():
+            picked[new_col][i] = d.get(src_key, "")
+        rest = dict(d)
+        for src_key in promote:
+            rest.pop(src_key, None)
+        stripped[i] = json.dumps(rest, ensure_ascii=False)
+
+    for new_col, values in picked.items():
+        df[new_col] = values[codes]
+    df["other_parameters"] = pd.Categorical(stripped)[codes]
 
 def apply_schema_mutations(df: pd.DataFrame, schema: List[str], mut: Optional[SchemaMutations]) -> Tuple[pd.DataFrame, List[str]]:
+    """Returns (df, schema_out). Promoted columns are added to df in place; pass a copy to keep the input."""
     if not mut:
         return df, schema
 
     schema_out = [c for c in schema if c not in mut.drop_output_columns]
 
+    if mut.numeric_columns:
+        num_cols = [c for c in NUMERIC_COLUMNS if c not in schema_out]
+        idx = schema_out.index("gbp_ext_price") + 1 if "gbp_ext_price" in schema_out else len(schema_out)
+        schema_out[idx:idx] = num_cols
+
     if mut.promote_other_params:
-        # Promote from _other_dict into dedicated columns, and remove keys from blob.
-        for src_key, new_col in mut.promote_other_params.items():
-            if new_col not in df.columns:
-                df[new_col] = ""
-            def pick(row):
-                d = row.get("_other_dict", {}) or {}
-                return d.get(src_key, "")
-            df[new_col] = df.apply(pick, axis=1)
-
-        def strip_and_dump(row):
-            d = dict(row.get("_other_dict", {}) or {})
-            for src_key in mut.promote_other_params.keys():
-                d.pop(src_key, None)
-            return json.dumps(d, ensure_ascii=False)
-        df["other_parameters"] = df.apply(strip_and_dump, axis=1)
+        # Promote keys from the other_parameters blob into dedicated columns, and remove them from it.
+        _promote_other_params(df, mut.promote_other_params)
 
         # Insert new columns before 'other_parameters'
         insert_before = mut.promoted_insert_before
@@ -504,113 +1838,1137 @@ def apply_schema_mutations(df: pd.DataFrame, schema: List[str], mut: Optional[Sc
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# Pipeline runner
+# Typed columnar output (Parquet / Arrow IPC; needs pyarrow)
 # ─────────────────────────────────────────────────────────────────────────────
 
-def run_pipeline(
-    IN_DIR: Path,
-    OUT_DIR: Path,
-    schema_mutations: Optional[SchemaMutations] = None,
-) -> None:
-    # 1) Discover inputs
-    pairs = discover_json_base_delta(IN_DIR)
-    inv_base_p, inv_delta_p = pairs["invoice"]
-    prod_base_p, prod_delta_p = pairs["product"]
-    full_csv_p, mini_csv_p = discover_csv_pair(IN_DIR)
+ARROW_FORMATS = {"parquet": ".parquet", "feather": ".arrow"}
 
-    invoices_base = _load_json(inv_base_p)
-    invoices_delta = _load_json(inv_delta_p)
-    products_base = _load_json(prod_base_p)
-    products_delta = _load_json(prod_delta_p)
+def _parse_money(s: str) -> Optional[Decimal]:
+    digits = re.sub(r"[^0-9.\-]", "", s)
+    return Decimal(digits) if digits not in ("", ".", "-") else None
 
-    # 2) Expected new rows from delta = delta_only(detail_key)
-    base_detail_keys = set(iter_detail_keys(invoices_base))
-    delta_detail_keys = set(iter_detail_keys(invoices_delta))
-    delta_only_keys = delta_detail_keys - base_detail_keys
+def _arrow_table(df: pd.DataFrame, schema_out: List[str]):
+    """
+    The full-schema frame as an Arrow table with real types:
+      qty_shipped / invoice_id / NUMERIC_COLUMNS -> int64, gbp_*_price -> decimal128(18, 5)
+      (parsed from the formatted strings), date_shipped -> timestamp[ms, UTC],
+      other_parameters -> map<string, string>, everything else -> string.
+    """
+    import pyarrow as pa
+
+    arrays, fields = [], []
+    for c in schema_out:
+        s = df[c]
+        if c in NUMERIC_COLUMNS:
+            typ = pa.int64()
+            arr = pa.array(s, type=typ)
+        elif c in ("qty_shipped", "invoice_id"):
+            typ = pa.int64()
+            arr = pa.array(pd.to_numeric(s.replace("", None), errors="coerce").astype("Int64"), type=typ)
+        elif c in ("gbp_unit_price", "gbp_ext_price"):
+            typ = pa.decimal128(18, 5)
+            parsed = {v: _parse_money(str(v)) for v in s.fillna("").unique()}
+            arr = pa.array([parsed[v] for v in s.fillna("")], type=typ)
+        elif c == "date_shipped":
+            typ = pa.timestamp("ms", tz="UTC")
+            ts = pd.to_datetime(s.replace("", None), utc=True, format="ISO8601", errors="coerce")
+            arr = pa.array(ts.astype("datetime64[ms, UTC]"), type=typ)
+        elif c == "other_parameters":
+            typ = pa.map_(pa.string(), pa.string())
+            parsed = {v: list(json.loads(v).items()) if v else [] for v in s.fillna("").unique()}
+            arr = pa.array([parsed[v] for v in s.fillna("")], type=typ)
+        else:
+            typ = pa.string()
+            arr = pa.array(s.fillna("").astype(str), type=typ)
+        arrays.append(arr)
+        fields.append(pa.field(c, typ))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+def write_arrow_dataset(df: pd.DataFrame, schema_out: List[str], out_dir: Path, fmt: str,
+                        append: bool = False) -> Path:
+    """
+    Writes the rows as one part file of a dataset directory (read back whole with e.g.
+    pd.read_parquet(out_dir) or pyarrow.dataset). A full write replaces all parts;
+    append=True adds the next part, which is how incremental runs extend it.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError(f"arrow_format={fmt!r} needs pyarrow (pip install pyarrow)") from e
+    suffix = ARROW_FORMATS[fmt]
+    out_dir.mkdir(parents=True, exist_ok=True)
+    parts = sorted(out_dir.glob(f"part-*{suffix}"))
+    if not append:
+        for old in parts:
+            old.unlink()
+        parts = []
+    part = out_dir / f"part-{len(parts):05d}{suffix}"
+    table = _arrow_table(df, schema_out)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, part)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, part)
+    return part
 
-    # 3) Build lookup with base precedence
-    prod_by_dk = build_prod_by_dk(products_base, products_delta)
 
-    # 4) Build base rows and merged rows (deduped)
-    base_rows = build_rows(invoices_base, prod_by_dk, new_detail_keys=None)
-    merged_rows = build_rows(invoices_base + invoices_delta, prod_by_dk, new_detail_keys=delta_only_keys)
+# ─────────────────────────────────────────────────────────────────────────────
+# Run state (incremental mode)
+# ─────────────────────────────────────────────────────────────────────────────
 
-    df_base = pd.DataFrame(base_rows)
-    df_merged = pd.DataFrame(merged_rows)
+def _mutations_signature(mut: Optional[SchemaMutations]) -> str:
+    return json.dumps(asdict(mut) if mut else None, sort_keys=True)
 
-    # 5) ASSERT A: expected additions matches output “new” markings
-    expected_new = len(delta_only_keys)
-    actual_new = int(df_merged["_is_new"].sum())
-    assert actual_new == expected_new, f"New row count mismatch: expected {expected_new}, got {actual_new}"
+class RunState:
+    """
+    Persistent record (SQLite) of the last written full CSV: its stamp and tail checksum (and
+    the mini CSV's), schema signature and, per row in file order, the int64 detail key id and
+    a hash of the row's CSV-visible text (_row_hashes).
+    An incremental run uses it to prove the previous output is intact (assertion B)
+    without rebuilding the history; append_outputs uses it to extend the previous output.
+    The row hashes are only kept for append_outputs: a full rewrite stores them when it
+    is asked to, appended rows add their own, and no run re-reads the file to derive them.
+    keys() / row_hashes() are kept in memory for as long as the stored full CSV stamp is the
+    one they were read under, so a RunState that outlives a run (RunCache) reads them once.
+    """
+    def __init__(self, db_path: Path):
+        self._con = _open_cache_db(db_path)
+        with self._con:
+            self._con.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+                CREATE TABLE IF NOT EXISTS rows (seq INTEGER PRIMARY KEY, key_id INTEGER, row_hash INTEGER);
+            """)
+        self._memo: Dict[str, Optional[np.ndarray]] = {}
+        self._memo_stamp = None
+
+    def close(self) -> None:
+        self._con.close()
+
+    def meta(self) -> Dict[str, object]:
+        return {k: json.loads(v) for k, v in self._con.execute("SELECT k, v FROM meta")}
+
+    def _stamp(self) -> List[Optional[str]]:
+        return [v for (v,) in self._con.execute(
+            "SELECT v FROM meta WHERE k IN ('full_csv', 'size', 'mtime_ns', 'rows') ORDER BY k")]
+
+    def _cached(self, name: str, load) -> Optional[np.ndarray]:
+        stamp = self._stamp()
+        if stamp != self._memo_stamp:
+            self._memo, self._memo_stamp = {}, stamp
+        if name not in self._memo:
+            self._memo[name] = load()
+        return self._memo[name]
+
+    def keys(self) -> np.ndarray:
+        """Stored detail key ids in file order."""
+        return self._cached("keys", lambda: np.fromiter(
+            (k for (k,) in self._con.execute("SELECT key_id FROM rows ORDER BY seq")), dtype=np.int64))
+
+    def row_hashes(self) -> Optional[np.ndarray]:
+        """Stored _row_hashes (as int64) in file order; None unless every row has one."""
+        def load():
+            vals = [h for (h,) in self._con.execute("SELECT row_hash FROM rows ORDER BY seq")]
+            if any(h is None for h in vals):
+                return None
+            return np.array(vals, dtype=np.int64)
+        return self._cached("row_hashes", load)
+
+    def save(self, meta: Dict[str, object], keys: np.ndarray, hashes: Optional[np.ndarray] = None,
+             append: bool = False) -> None:
+        """
+        Records meta and the written rows' keys (and hashes, if known); append extends the rows.
+        A rewrite of the same keys in the same order (a repeated full run) keeps the stored rows
+        and only forgets their hashes.
+        """
+        # what is in memory for the rows kept is extended, so an append is not followed by a re-read
+        memo = {}
+        if append and self._memo_stamp == self._stamp():
+            if self._memo.get("keys") is not None:
+                memo["keys"] = np.concatenate([self._memo["keys"], keys.astype(np.int64)])
+            if hashes is not None and self._memo.get("row_hashes") is not None:
+                memo["row_hashes"] = np.concatenate([self._memo["row_hashes"], hashes.astype(np.int64)])
+        same_rows = not append and hashes is None and np.array_equal(self.keys(), keys)
+        with self._con:
+            if not append:
+                self._con.execute("DELETE FROM meta")
+            if same_rows:
+                self._con.execute("UPDATE rows SET row_hash=NULL WHERE row_hash IS NOT NULL")
+                memo["keys"] = self._memo["keys"]
+            else:
+                if not append:
+                    self._con.execute("DELETE FROM rows")
+                self._con.executemany("INSERT INTO rows (key_id, row_hash) VALUES (?,?)",
+                                      zip(keys.tolist(), hashes.tolist() if hashes is not None
+                                          else itertools.repeat(None)))
+            self._con.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)",
+                                  ((k, json.dumps(v)) for k, v in meta.items()))
+        self._memo, self._memo_stamp = memo, self._stamp()
+
+# Bytes at the end of a written CSV covered by its stored tail checksum
+CSV_TAIL_BYTES = 1 << 16
+
+def _tail_sha256(p: Path) -> str:
+    """sha256 of p's last CSV_TAIL_BYTES: catches truncation, appends and edits near the end."""
+    with p.open("rb") as f:
+        f.seek(max(0, _file_size(p) - CSV_TAIL_BYTES))
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _output_meta(out_full: Path, out_mini: Path, schema_out: List[str],
+                 mut: Optional[SchemaMutations]) -> Dict[str, object]:
+    st = out_full.stat()
+    st_mini = out_mini.stat()
+    return {"full_csv": str(out_full.resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "tail_sha256": _tail_sha256(out_full),
+            "mini_csv": str(out_mini.resolve()), "mini_size": st_mini.st_size, "mini_mtime_ns": st_mini.st_mtime_ns,
+            "mini_tail_sha256": _tail_sha256(out_mini),
+            "schema": schema_out, "mutations": _mutations_signature(mut), "facts": _facts_signature()}
+
+def _previous_outputs_blocker(meta: Dict[str, object], out_full: Path, out_mini: Path) -> Optional[str]:
+    """
+    Reason the full/mini CSVs are not exactly as the run recorded in meta wrote them, or None.
+    Checked by stamp and tail checksum only, so the cost does not grow with the history.
+    """
+    for p, path, size, mtime_ns, tail in (
+            (out_full, meta.get("full_csv"), meta.get("size"), meta.get("mtime_ns"), meta.get("tail_sha256")),
+            (out_mini, meta.get("mini_csv"), meta.get("mini_size"), meta.get("mini_mtime_ns"),
+             meta.get("mini_tail_sha256"))):
+        if not p.exists() or path != str(p.resolve()):
+            return f"previous output {p.name} not found"
+        st = p.stat()
+        if (size, mtime_ns) != (st.st_size, st.st_mtime_ns) or tail != _tail_sha256(p):
+            return f"{p.name} changed since the last run"
+    return None
+
+def _incremental_blocker(state: RunState, out_full: Path, out_mini: Path, mut: Optional[SchemaMutations],
+                         base_ids: np.ndarray) -> Optional[str]:
+    """Reason an incremental run cannot continue from the stored state, or None. base_ids: sorted key ids."""
+    meta = state.meta()
+    if not meta:
+        return "no stored run state"
+    blocker = _previous_outputs_blocker(meta, out_full, out_mini)
+    if blocker:
+        return blocker
+    if meta.get("mutations") != _mutations_signature(mut):
+        return "schema mutations changed"
+    if meta.get("facts") != _facts_signature():
+        return "product facts rules changed"
+    if meta.get("rows") != len(base_ids):
+        return "stored rows do not match the base invoices"
+    if not np.array_equal(np.sort(state.keys()), base_ids):
+        return "stored row keys differ from the base invoices"
+    return None
+
+def _csv_text(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    df's cells as the text to_csv writes for them: NA (of any dtype, e.g. Int64) is "".
+    String columns only have NA filled and NA-free categoricals are kept as they are (they
+    hash like their values), so only the other columns are converted cell by cell.
+    """
+    out = {}
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            if not s.isna().any():
+                out[c] = s
+                continue
+        elif pd.api.types.is_string_dtype(s.dtype) and s.dtype != object:
+            out[c] = s.fillna("")
+            continue
+        s = s.astype(object)
+        out[c] = s.where(s.notna(), "").astype(str)
+    return pd.DataFrame(out, index=df.index)
 
-    # 6) ASSERT B: excluding new rows, base data identical
-    base_keyed = df_base.set_index("_detail_key")
-    merged_old = df_merged[~df_merged["_is_new"]].set_index("_detail_key")
-    assert set(base_keyed.index) == set(merged_old.index), "Key sets differ between base and merged-old"
-    for col in FUTURE_FULL_SCHEMA:
-        a = base_keyed[col].fillna("")
-        b = merged_old[col].fillna("")
-        if not a.equals(b):
-            diff = (a != b)
-            first_bad = diff[diff].index[0]
-            raise AssertionError(f"Column '{col}' differs for key {first_bad}: base='{a.loc[first_bad]}' merged='{b.loc[first_bad]}'")
+def _row_hashes(df: pd.DataFrame, cols: List[str]) -> np.ndarray:
+    # Hash the CSV-visible text of each cell, so dtype-only differences (int vs object) don't count.
+    return pd.util.hash_pandas_object(_csv_text(df[cols]), index=False).to_numpy()
 
-    # 7) ASSERT C: any NEW MCU rows have at least one MCU field populated
+def _append_blocker(state: RunState, out_full: Path, out_mini: Path, schema_out: List[str],
+                    mut: Optional[SchemaMutations], df_out: pd.DataFrame) -> Optional[str]:
+    """
+    Reason the previous full/mini CSVs cannot simply be extended with df_out's new rows, or None.
+    Appending is safe when both files are exactly as last written (stamps and tail checksums),
+    the schema is unchanged and df_out's old rows are, in order, the stored rows; their content
+    is compared too when the stored rows have hashes (see RunState).
+    """
+    meta = state.meta()
+    if not meta:
+        return "no stored run state"
+    blocker = _previous_outputs_blocker(meta, out_full, out_mini)
+    if blocker:
+        return blocker
+    if meta.get("mutations") != _mutations_signature(mut):
+        return "schema mutations changed"
+    if meta.get("schema") != schema_out:
+        return "output schema changed"
+    is_new = df_out["_is_new"].to_numpy(dtype=bool)
+    n_old = meta.get("rows")
+    if n_old != int((~is_new).sum()) or is_new[:n_old].any():
+        return "previous rows are not the leading rows of this run"
+    if not np.array_equal(state.keys(), df_out["_detail_key"].to_numpy(dtype=np.int64)[:n_old]):
+        return "row keys differ from the previous output"
+    stored = state.row_hashes()
+    if stored is not None and not np.array_equal(stored, _row_hashes(df_out.iloc[:n_old], schema_out).view(np.int64)):
+        return "row contents differ from the previous output"
+    return None
+
+def assert_old_rows_identical(df_base: pd.DataFrame, df_merged: pd.DataFrame, cols: List[str]) -> None:
+    """
+    Assertion B: the merged rows that are not new must equal the base rows, key by key.
+    One 64-bit hash per row over `cols` is compared for all rows in a single vectorised step;
+    only rows whose hashes differ are drilled into column by column to report the first
+    differing column (schema order) and key (base order).
+    """
+    merged_old = df_merged[~df_merged["_is_new"].astype(bool)]
+    base_keys = df_base["_detail_key"].to_numpy(dtype=np.int64)
+    old_keys = merged_old["_detail_key"].to_numpy(dtype=np.int64)
+    if not np.array_equal(base_keys, old_keys):
+        assert len(base_keys) == len(old_keys) and np.array_equal(np.sort(base_keys), np.sort(old_keys)), \
+            "Key sets differ between base and merged-old"
+        merged_old = merged_old.iloc[pd.Index(old_keys).get_indexer(base_keys)]
+
+    bad = np.flatnonzero(_row_hashes(df_base, cols) != _row_hashes(merged_old, cols))
+    if not len(bad):
+        return
+    a_rows = df_base.iloc[bad]
+    b_rows = merged_old.iloc[bad]
+    for col in cols:
+        a = _csv_text(a_rows[[col]])[col]
+        b = _csv_text(b_rows[[col]])[col]
+        diff = a.to_numpy() != b.to_numpy()
+        if diff.any():
+            i = int(np.flatnonzero(diff)[0])
+            first_bad = _key_label(base_keys[bad[i]])
+            raise AssertionError(f"Column '{col}' differs for key {first_bad}: base='{a.iloc[i]}' merged='{b.iloc[i]}'")
+
+def assert_new_rows_per_delta(df: pd.DataFrame, new_keys_by_delta: Dict[str, set]) -> None:
+    """Assertion A for a batch: every key credited to a delta (by name) is one of df's new rows."""
+    new_ids = df.loc[df["_is_new"].astype(bool), "_detail_key"].to_numpy(dtype=np.int64)
+    for name, new_keys in new_keys_by_delta.items():
+        got = int(np.isin(new_ids, detail_key_ids(new_keys)).sum())
+        assert got == len(new_keys), f"New row count mismatch for delta {name}: expected {len(new_keys)}, got {got}"
+
+def assert_new_mcu_rows(df: pd.DataFrame) -> None:
     mcu_cols = ["core_processor", "core_type", "clock_speed", "program_memory_size"]
-    new_mcu_rows = df_merged[df_merged["_is_new"] & (df_merged["core_processor"].fillna("") != "")]
+    new_mcu_rows = df[df["_is_new"] & (df["core_processor"].fillna("") != "")]
     if len(new_mcu_rows) > 0:
         ok = (new_mcu_rows[mcu_cols].fillna("").astype(str) != "").any(axis=1).all()
         assert ok, "Some newly-added MCU rows have all MCU fields empty"
 
-    # 8) Informational: diff vs input full CSV
-    orig_full = pd.read_csv(full_csv_p)
-    row_diff_vs_input_full = len(df_merged) - len(orig_full)
+def _mini_frame(df_out: pd.DataFrame) -> pd.DataFrame:
+    return pd.DataFrame({
+        "mfr_pn": df_out["mfr_pn"],
+        "dk_pn": df_out["dk_pn"],
+        "description": df_out["description"],
+        "qty_bought": df_out["_qty_bought"],
+    })
 
-    # 9) Apply optional schema mutations
-    df_out, schema_out = apply_schema_mutations(df_merged.copy(), FUTURE_FULL_SCHEMA.copy(), schema_mutations)
 
-    # 10) Write outputs
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
+# ─────────────────────────────────────────────────────────────────────────────
+# Spend rollups
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Row columns the rollups are keyed by (each crossed with the date_shipped month).
+# "total" (key "") holds the per-month totals over all rows.
+ROLLUP_DIMENSIONS: List[str] = ["mfr", "category", "core_type", "mfr_pn"]
+
+def _rollup_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """(dim, key, month, lines, qty, spend_e2) sums over the rows of df."""
+    base = pd.DataFrame({
+        "month": df["date_shipped"].fillna("").astype(str).str[:7],
+        "qty": pd.to_numeric(df["qty_shipped_int"]).fillna(0).astype(np.int64),
+        "spend_e2": pd.to_numeric(df["gbp_ext_price_e2"]).fillna(0).astype(np.int64),
+    }, index=df.index)
+    parts = []
+    for dim in ["total"] + ROLLUP_DIMENSIONS:
+        keys = "" if dim == "total" else df[dim].fillna("").astype(str)
+        g = (base.assign(key=keys).groupby(["key", "month"], sort=False)
+             .agg(lines=("qty", "size"), qty=("qty", "sum"), spend_e2=("spend_e2", "sum")).reset_index())
+        g.insert(0, "dim", dim)
+        parts.append(g)
+    return pd.concat(parts, ignore_index=True)
+
+def _rollup_csv_columns(columns: List[str]) -> Optional[List[str]]:
+    """Columns of a full CSV the rollups can be rebuilt from (see _read_rollup_rows), or None."""
+    qty = next((c for c in ("qty_shipped_int", "qty_shipped") if c in columns), None)
+    spend = next((c for c in ("gbp_ext_price_e2", "gbp_ext_price") if c in columns), None)
+    need = ["date_shipped", *ROLLUP_DIMENSIONS]
+    if qty is None or spend is None or not set(need) <= set(columns):
+        return None
+    return need + [qty, spend]
+
+def _read_rollup_rows(p: Path) -> pd.DataFrame:
+    """
+    A written full CSV's rows as _rollup_frame takes them. Without the numeric twins, units
+    come from qty_shipped (the same number) and pence from the formatted gbp_ext_price,
+    parsed once per distinct value.
+    """
+    cols = _rollup_csv_columns(pd.read_csv(p, nrows=0).columns.tolist())
+    if cols is None:
+        raise ValueError(f"{p.name} lacks the columns the spend rollups are built from")
+    df = pd.read_csv(p, usecols=cols, dtype=str, keep_default_na=False)
+    if "qty_shipped_int" not in df:
+        df["qty_shipped_int"] = pd.to_numeric(df["qty_shipped"], errors="coerce")
+    if "gbp_ext_price_e2" not in df:
+        codes, uniques = pd.factorize(df["gbp_ext_price"])
+        pence = [_parse_money(u) for u in uniques]
+        df["gbp_ext_price_e2"] = np.array([int(m * 100) if m is not None else 0 for m in pence],
+                                          dtype=np.int64)[codes]
+    return df
+
+class SpendRollups:
+    """
+    Persistent pre-aggregated spend (SQLite): per ROLLUP_DIMENSIONS value and date_shipped
+    month (YYYY-MM), the line count, units shipped (qty_shipped_int) and spend in pence
+    (gbp_ext_price_e2). Kept in step with updated_full_future_schema.csv: appending runs add
+    only the appended rows; a full rewrite just marks the table stale (invalidate), and the
+    next read rebuilds it from the CSV itself. The stamp of the CSV it matches is stored, so
+    a table out of step is detected instead of double counted.
+    """
+    def __init__(self, db_path: Path):
+        self._con = _open_cache_db(db_path)
+        with self._con:
+            self._con.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+                CREATE TABLE IF NOT EXISTS rollups (
+                    dim TEXT, key TEXT, month TEXT, lines INTEGER, qty INTEGER, spend_e2 INTEGER,
+                    PRIMARY KEY (dim, key, month));
+            """)
+
+    def close(self) -> None:
+        self._con.close()
+
+    def _meta(self, k: str):
+        row = self._con.execute("SELECT v FROM meta WHERE k = ?", (k,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def stamp(self) -> Optional[List]:
+        return self._meta("full_csv")
+
+    def invalidate(self, csv_path: Path) -> None:
+        """Marks the table to be rebuilt from csv_path (just rewritten) when next read."""
+        with self._con:
+            self._con.execute("DELETE FROM rollups")
+            self._con.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)",
+                                  (("full_csv", json.dumps(_file_stamp(csv_path))),
+                                   ("rebuild_from", json.dumps(str(csv_path)))))
+
+    def refresh(self) -> None:
+        """Does the rebuild invalidate() deferred, if any (rows() and totals() call it)."""
+        src = self._meta("rebuild_from")
+        if src is None or not Path(src).exists():
+            return
+        df = _read_rollup_rows(Path(src))
+        self.update(df, _file_stamp(Path(src)), reset=True)
+
+    def update(self, df: pd.DataFrame, stamp: List, reset: bool = False) -> None:
+        """
+        Adds df's rows (all rows when reset) and records the stamp of the CSV they now match.
+        While a rebuild is pending, df's rows are left to it (they are in the CSV too).
+        """
+        if not reset and self._meta("rebuild_from") is not None:
+            df = df.iloc[:0]
+        agg = _rollup_frame(df) if len(df) else None
+        with self._con:
+            if reset:
+                self._con.execute("DELETE FROM rollups")
+                self._con.execute("DELETE FROM meta WHERE k = 'rebuild_from'")
+            if agg is not None:
+                self._con.executemany(
+                    "INSERT INTO rollups VALUES (?,?,?,?,?,?) ON CONFLICT (dim, key, month) DO UPDATE SET "
+                    "lines = lines + excluded.lines, qty = qty + excluded.qty, "
+                    "spend_e2 = spend_e2 + excluded.spend_e2",
+                    agg.itertuples(index=False, name=None))
+            self._con.execute("INSERT OR REPLACE INTO meta VALUES ('full_csv', ?)", (json.dumps(stamp),))
+
+    def rows(self, dim: str, key: Optional[str] = None) -> List[Tuple[str, str, int, int, int]]:
+        """(key, month, lines, qty, spend_e2) per month for dim (optionally one key), by key and month."""
+        self.refresh()
+        sql, args = "SELECT key, month, lines, qty, spend_e2 FROM rollups WHERE dim = ?", [dim]
+        if key is not None:
+            sql, args = sql + " AND key = ?", args + [key]
+        return self._con.execute(sql + " ORDER BY key, month", args).fetchall()
+
+    def totals(self, dim: str, start: Optional[str] = None, end: Optional[str] = None,
+               ) -> List[Tuple[str, int, int, int]]:
+        """(key, lines, qty, spend_e2) for dim summed over months start..end (YYYY-MM, inclusive), biggest spend first."""
+        self.refresh()
+        sql, args = "SELECT key, SUM(lines), SUM(qty), SUM(spend_e2) FROM rollups WHERE dim = ?", [dim]
+        if start is not None:
+            sql, args = sql + " AND month >= ?", args + [start]
+        if end is not None:
+            sql, args = sql + " AND month <= ?", args + [end]
+        return self._con.execute(sql + " GROUP BY key ORDER BY SUM(spend_e2) DESC, key", args).fetchall()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Parametric search
+# ─────────────────────────────────────────────────────────────────────────────
+
+_SI_PREFIX = {"": 1.0, "p": 1e-12, "n": 1e-9, "u": 1e-6, "µ": 1e-6, "μ": 1e-6, "m": 1e-3,
+              "k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9}
+_BIN_PREFIX = {"": 1, "k": 1 << 10, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+# The number must start a word (so "SC-74A" or "Cortex®-M33F" hold no quantity), and a sign only
+# counts at the start of the value or after whitespace / "~" ("-40°C ~ 85°C").
+_QTY_RE = re.compile(r"(?<![\w.+-])((?:(?<![^\s~])[-+])?\d+(?:\.\d+)?)\s*([pnuµμmkKMG]?)(Hz|bit|B|V|A|W|F|H|Ohms?|Ω|°C|s|%)(?![A-Za-z])")
+_ORG_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kKMG]?)\s*x\s*(\d+)\s*$")
+_NUM_RE = re.compile(r"^\s*[-+]?\d+(?:\.\d+)?\s*$")
+
+def parse_quantity(text) -> Optional[Tuple[float, float, str]]:
+    """
+    Digi-Key valueText -> (lo, hi, unit) in base units (Hz, B, bit, V, A, W, F, H, Ohm, °C, s, %),
+    or None if it holds no quantity. "1.71V ~ 3.6V" gives a range; single values have lo == hi.
+    Memory sizes use binary prefixes ("512KB" = 524288 B); "32K x 8" organisations become bytes.
+    Bare numbers ("39") are unitless.
+    """
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        return float(text), float(text), ""
+    if not isinstance(text, str):
+        return None
+    found = []
+    for m in _QTY_RE.finditer(text):
+        num, prefix, unit = float(m.group(1)), m.group(2), m.group(3)
+        if unit in ("Ohm", "Ohms", "Ω"):
+            unit = "Ohm"
+        if unit in ("B", "bit"):
+            if prefix not in _BIN_PREFIX:
+                continue
+            found.append((num * _BIN_PREFIX[prefix], unit))
+        else:
+            found.append((num * _SI_PREFIX[prefix], unit))
+    if found:
+        lo, unit = found[0]
+        if "~" in text and len(found) > 1 and found[1][1] == unit:
+            return lo, found[1][0], unit
+        return lo, lo, unit
+    m = _ORG_RE.match(text)
+    if m:
+        size = float(m.group(1)) * _BIN_PREFIX[m.group(2)] * int(m.group(3)) / 8
+        return size, size, "B"
+    if _NUM_RE.match(text):
+        return float(text), float(text), ""
+    return None
+
+def _norm_text(s) -> str:
+    return " ".join(str(s).replace("®", "").replace("™", "").lower().split())
+
+class ParamIndex:
+    """
+    In-memory parametric search over product `parameters` (parameterText / valueText):
+      idx = ParamIndex(ProductCatalog(path).iter_products())   # or any iterable of product entries
+      idx.query(("Core Processor", "contains", "Cortex-M33"),
+                ("Program Memory Size", ">=", "512KB"),
+                ("Speed", ">=", "160MHz"))
+    Numeric filters (>=, >, <=, <, between, covers) run on per-parameter sorted arrays
+    (binary search); ranges such as "1.71V ~ 3.6V" match >= on their upper end, <= on their
+    lower end and `covers` when the value lies inside. Thresholds may carry units ("160MHz")
+    or be plain numbers in base units. Text filters (==, in, contains) use per-parameter
+    inverted indexes and ignore case and ®/™. Filters are ANDed.
+    Products are deduplicated by DK part number, first seen wins (as in build_prod_by_dk).
+    """
+    NUMERIC_OPS = (">=", ">", "<=", "<", "between", "covers")
+    TEXT_OPS = ("==", "in", "contains")
+
+    def __init__(self, products):
+        self.parts: List[Dict[str, object]] = []
+        seen_dk = set()
+        text: Dict[str, Dict[str, List[int]]] = {}
+        nums: Dict[str, List[Tuple[float, float, str, int]]] = {}
+        for p in products:
+            dks = [v.get("digiKeyProductNumber") for v in p.get("productVariations", [])
+                   if v.get("digiKeyProductNumber")]
+            if dks and all(dk in seen_dk for dk in dks):
+                continue
+            seen_dk.update(dks)
+            pid = len(self.parts)
+            self.parts.append({"mfr_pn": p.get("manufacturerProductNumber", ""),
+                               "mfr": (p.get("manufacturer") or {}).get("name", ""),
+                               "description": (p.get("description") or {}).get("catalog", ""),
+                               "dk_pns": dks})
+            done = set()
+            for prm in p.get("parameters") or []:
+                name, value = prm.get("parameterText", ""), prm.get("valueText", "")
+                if name in done:
+                    continue
+                done.add(name)
+                text.setdefault(name, {}).setdefault(_norm_text(value), []).append(pid)
+                q = parse_quantity(value)
+                if q is not None:
+                    nums.setdefault(name, []).append((*q, pid))
+
+        self._text = {name: {v: np.asarray(ids, dtype=np.int32) for v, ids in vals.items()}
+                      for name, vals in text.items()}
+        self._num: Dict[str, Tuple[str, np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = {}
+        for name, entries in nums.items():
+            # a parameter's unit is its most common one; values in any other unit stay text-only
+            units = pd.Series([e[2] for e in entries]).value_counts()
+            unit = units.index[0]
+            lo = np.array([e[0] for e in entries if e[2] == unit])
+            hi = np.array([e[1] for e in entries if e[2] == unit])
+            ids = np.array([e[3] for e in entries if e[2] == unit], dtype=np.int32)
+            lo_order, hi_order = np.argsort(lo, kind="stable"), np.argsort(hi, kind="stable")
+            self._num[name] = (unit, lo[lo_order], ids[lo_order], hi[hi_order], ids[hi_order])
+
+    def parameters(self) -> List[str]:
+        return sorted(self._text)
+
+    def unit(self, name: str) -> Optional[str]:
+        """Base unit of a numeric parameter ("" for plain counts), or None if it is text-only."""
+        return self._num[name][0] if name in self._num else None
+
+    def _threshold(self, name: str, value) -> float:
+        unit = self._num[name][0]
+        q = parse_quantity(value)
+        if q is None or (q[2] != unit and not isinstance(value, (int, float))):
+            raise ValueError(f"{value!r} is not a quantity in {unit or 'plain numbers'} (parameter {name!r})")
+        return q[0]
+
+    def _filter(self, name: str, op: str, value) -> np.ndarray:
+        if name not in self._text:
+            raise KeyError(f"No parameter {name!r} in the index")
+        if op in self.TEXT_OPS:
+            vals = self._text[name]
+            if op == "==":
+                return vals.get(_norm_text(value), np.empty(0, dtype=np.int32))
+            if op == "in":
+                hits = [vals[v] for v in map(_norm_text, value) if v in vals]
+            else:
+                needle = _norm_text(value)
+                hits = [ids for v, ids in vals.items() if needle in v]
+            return np.unique(np.concatenate(hits)) if hits else np.empty(0, dtype=np.int32)
+        if op not in self.NUMERIC_OPS:
+            raise ValueError(f"Unknown operator {op!r}; expected one of {self.NUMERIC_OPS + self.TEXT_OPS}")
+        if name not in self._num:
+            raise ValueError(f"Parameter {name!r} has no numeric values")
+        _, lo, lo_ids, hi, hi_ids = self._num[name]
+        if op in (">=", ">"):
+            return np.sort(hi_ids[np.searchsorted(hi, self._threshold(name, value), "left" if op == ">=" else "right"):])
+        if op in ("<=", "<"):
+            return np.sort(lo_ids[:np.searchsorted(lo, self._threshold(name, value), "right" if op == "<=" else "left")])
+        a, b = (value, value) if op == "covers" else value
+        a, b = self._threshold(name, a), self._threshold(name, b)
+        if op == "covers":
+            a, b = b, a  # lo <= x and hi >= x
+        reach_up = hi_ids[np.searchsorted(hi, a, "left"):]
+        reach_down = lo_ids[:np.searchsorted(lo, b, "right")]
+        return np.intersect1d(reach_up, reach_down)
+
+    def query_ids(self, *filters: Tuple[str, str, object]) -> np.ndarray:
+        """Ids (positions in self.parts) matching every (parameterText, op, value) filter."""
+        ids = np.arange(len(self.parts), dtype=np.int32)
+        for name, op, value in filters:
+            ids = np.intersect1d(ids, self._filter(name, op, value), assume_unique=True)
+            if not len(ids):
+                break
+        return ids
+
+    def query(self, *filters: Tuple[str, str, object]) -> List[Dict[str, object]]:
+        """Matching parts: mfr_pn, mfr, description and their DK part numbers."""
+        return [self.parts[i] for i in self.query_ids(*filters)]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Run instrumentation
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)  # bytes on macOS, KiB elsewhere
+
+class RunProfiler:
+    """
+    Stopwatch over the pipeline's sequential stages: lap(name, **counts) closes the stage that
+    started at the previous lap, recording wall/CPU seconds, peak RSS (process high-water mark),
+    optionally the stage's tracemalloc peak, and any row/byte counts passed in.
+    A disabled profiler is a no-op, so run_pipeline is instrumented unconditionally.
+    CPU time is this process only; worker processes are totalled separately at the end.
+    """
+    def __init__(self, enabled: bool = False, trace_memory: bool = False, profile: bool = False):
+        self.enabled = enabled or trace_memory or profile
+        self.trace_memory = trace_memory
+        self.stages: List[Dict[str, object]] = []
+        self.started = datetime.now(timezone.utc)
+        self._cprofile = cProfile.Profile() if profile else None
+        if trace_memory:
+            tracemalloc.start()
+        if self._cprofile:
+            self._cprofile.enable()
+        self._t0 = self._wall = time.perf_counter()
+        self._cpu0 = self._cpu = time.process_time()
+
+    def lap(self, name: str, **counts) -> None:
+        if not self.enabled:
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        rec: Dict[str, object] = {"stage": name, "wall_s": round(wall - self._wall, 6),
+                                  "cpu_s": round(cpu - self._cpu, 6), "peak_rss_mb": _peak_rss_mb()}
+        if self.trace_memory:
+            rec["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 1)
+            tracemalloc.reset_peak()
+        rec.update(counts)
+        self.stages.append(rec)
+        self._wall, self._cpu = time.perf_counter(), time.process_time()
+
+    def close(self) -> None:
+        """Stops cProfile / tracemalloc without a report (e.g. the run failed); finish() does too."""
+        if self._cprofile:
+            self._cprofile.disable()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def finish(self, out_dir: Path, **extra) -> Optional[Path]:
+        """Stops profiling and writes the run report (+ cProfile dump); returns the report path."""
+        if not self.enabled:
+            return None
+        self.close()
+        if self._cprofile:
+            self._cprofile.dump_stats(str(out_dir / RUN_PROFILE_NAME))
+        children_cpu = None
+        if resource is not None:
+            ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+            children_cpu = round(ru.ru_utime + ru.ru_stime, 6)
+        report = {
+            "started": self.started.isoformat(),
+            "finished": datetime.now(timezone.utc).isoformat(),
+            **extra,
+            "totals": {"wall_s": round(time.perf_counter() - self._t0, 6),
+                       "cpu_s": round(time.process_time() - self._cpu0, 6),
+                       "children_cpu_s": children_cpu,
+                       "peak_rss_mb": _peak_rss_mb()},
+            "stages": self.stages,
+        }
+        out = out_dir / RUN_REPORT_NAME
+        with out.open("w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return out
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Pipeline runner
+# ─────────────────────────────────────────────────────────────────────────────
+
+class RunCache:
+    """
+    The on-disk caches of one cache dir (key index, run state, spend rollups, product catalog)
+    and a DocRegistry over the key index, opened once and shared by consecutive runs
+    (run_pipeline(cache=...), as watch() does). Each run then starts with the kinds, hashes,
+    key sets and CSV fingerprints earlier runs read or wrote, each still checked against its
+    file's stamp, and with the stored row keys in memory. Parsed docs never outlive a run.
+    """
+    def __init__(self, cache_root: Path):
+        self.cache_root = cache_root
+        with contextlib.ExitStack() as opened:
+            self.key_index = opened.enter_context(contextlib.closing(KeyIndex(cache_root / "key_index.sqlite")))
+            self.run_state = opened.enter_context(contextlib.closing(RunState(cache_root / "run_state.sqlite")))
+            self.rollups = opened.enter_context(contextlib.closing(SpendRollups(cache_root / "rollups.sqlite")))
+            self.catalog = ProductCatalog(cache_root / "catalog.sqlite")
+            opened.pop_all()
+        self.registry = DocRegistry(self.key_index)
+
+    def close(self) -> None:
+        for db in (self.catalog, self.rollups, self.run_state, self.key_index):
+            db.close()
+
+def run_pipeline(
+    IN_DIR: Path,
+    OUT_DIR: Path,
+    schema_mutations: Optional[SchemaMutations] = None,
+    use_cache: bool = True,
+    cache_dir: Optional[Path] = None,
+    incremental: bool = False,
+    stream: bool = False,
+    json_indent: Optional[int] = 2,
+    workers: int = 1,
+    arrow_format: Optional[str] = None,
+    deltas: Optional[List[Path]] = None,
+    bases: Optional[List[Path]] = None,
+    report: bool = False,
+    profile: bool = False,
+    trace_memory: bool = False,
+    append_outputs: bool = False,
+    compact_products: bool = False,
+    category_table: bool = False,
+    cache: Optional[RunCache] = None,
+) -> None:
+    """
+    cache=RunCache(...) runs against caches the caller keeps open across runs (instead of
+    opening cache_dir's for this run only), so consecutive runs share what they have read.
+
+    category_table=True also writes OUT_DIR/category_dim.csv, the category dimension
+    (CATEGORY_TABLE_COLUMNS: leaf categoryId, top-level and second-level names, full path,
+    MCU flag) of every input product, from the CategoryIndex the rows are classified with.
+
+    compact_products=True writes merged_products_out.json deduplicated: a product entry is
+    kept only if it is the first (base precedence) to carry one of its DK part numbers, so
+    copies re-exported in later deltas are dropped and DK lookups (assertions A/B) are
+    unchanged. The records and bytes reclaimed are reported. A compacted output used as
+    the next base is spliced through and only the delta is filtered.
+
+    append_outputs=True: on a full rebuild, when updated_full_future_schema.csv / updated_mini.csv
+    in OUT_DIR are exactly what the last run wrote (stamps, tail checksums and schema in the
+    run state) and this run's old rows are its rows (keys, and per-row hashes once a rewrite
+    with append_outputs stored them), only the new rows are appended to both files.
+    Otherwise (e.g. schema or mutations changed) they are rewritten, with a note.
+
+    report=True writes OUT_DIR/dk_run_report.json: per-stage wall/CPU time, peak RSS and
+    row/byte counts (discover, load, keys, lookup, build, the assertions, mutations, writes),
+    plus run totals and inputs. trace_memory=True adds each stage's tracemalloc peak (slow);
+    profile=True also dumps cProfile stats to OUT_DIR/dk_run_report.prof (pstats format).
+    Either implies report=True.
+
+    deltas=[...] (batch mode) merges several queued delta exports in one run: any mix of
+    invoice and product JSONs (relative paths are taken from IN_DIR). Invoice deltas are
+    applied in export-date order, product deltas in the given order, both with base
+    precedence; the base is discovered among the remaining JSONs in IN_DIR, unless
+    bases=[...] names it (an invoice and/or a product JSON). Assertion A is checked per
+    delta and the outputs are written once.
+
+    arrow_format="parquet" | "feather" additionally writes the full-schema rows as a typed
+    dataset directory (updated_full_future_schema.parquet/ or .arrow/) with numeric
+    quantities/prices, a real date_shipped timestamp and other_parameters as a map column.
+    Requires pyarrow. Incremental runs append a part to an existing dataset.
+
+    workers=N (>1) shards the orders across N processes for row building (merged back
+    deterministically, in today's order) and writes the independent outputs concurrently.
+
+    json_indent: layout of the merged JSON outputs; 2 (default) matches the historical
+    json.dump(..., indent=2) files, None writes compact JSON (much smaller and faster).
+    When the base JSON is a previous output of this pipeline in the same layout (known via
+    the cache), its bytes are spliced through and only the delta elements are encoded.
+
+    stream=True never holds a whole input JSON parsed in memory: invoices and products are
+    streamed element by element through every pass (key extraction, product lookup,
+    row building, merged JSON writes), trading repeated file reads for the parsed documents.
+    Memory still grows with the archive: the built rows, the key sets and the dk -> product
+    lookup (all product entries, unless the cached catalog serves a spliced base) are held
+    in full, so this lowers the peak rather than bounding it.
+
+    incremental=True builds only the delta-only rows and appends them to the previous
+    updated_full_future_schema.csv / updated_mini.csv in OUT_DIR. Assertion B is then
+    checked against the per-row hashes stored by the previous run instead of a full
+    rebuild. Falls back to a full rebuild (with a note) when there is no usable state.
+    """
+    with contextlib.ExitStack() as cleanup:
+        _run_pipeline(cleanup, IN_DIR, OUT_DIR, schema_mutations=schema_mutations, use_cache=use_cache,
+                      cache_dir=cache_dir, incremental=incremental, stream=stream,
+                      json_indent=json_indent, workers=workers,
+                      arrow_format=arrow_format, deltas=deltas, bases=bases, report=report,
+                      profile=profile, trace_memory=trace_memory, append_outputs=append_outputs,
+                      compact_products=compact_products, category_table=category_table, cache=cache)
+
+def _run_pipeline(
+    cleanup: contextlib.ExitStack,
+    IN_DIR: Path,
+    OUT_DIR: Path,
+    schema_mutations: Optional[SchemaMutations],
+    use_cache: bool,
+    cache_dir: Optional[Path],
+    incremental: bool,
+    stream: bool,
+    json_indent: Optional[int],
+    workers: int,
+    arrow_format: Optional[str],
+    deltas: Optional[List[Path]],
+    bases: Optional[List[Path]],
+    report: bool,
+    profile: bool,
+    trace_memory: bool,
+    append_outputs: bool,
+    compact_products: bool,
+    category_table: bool,
+    cache: Optional[RunCache],
+) -> None:
+    """run_pipeline's body; everything it opens is closed by `cleanup`, also when the run fails."""
+    if bases and not deltas:
+        raise ValueError("bases=[...] pins the base JSONs of a batch run; pass deltas=[...] too")
+    if arrow_format is not None and arrow_format not in ARROW_FORMATS:
+        raise ValueError(f"arrow_format must be one of {sorted(ARROW_FORMATS)}; got {arrow_format!r}")
+    if (incremental or append_outputs) and not use_cache:
+        raise ValueError("incremental=True / append_outputs=True need use_cache=True "
+                         "(run state lives in the cache dir)")
+    if cache is not None and not use_cache:
+        raise ValueError("cache=... needs use_cache=True")
+    cache_root = cache_dir or OUT_DIR / CACHE_DIRNAME
+    prof = RunProfiler(report, trace_memory=trace_memory, profile=profile)
+    cleanup.callback(prof.close)
+    cleanup.enter_context(detail_key_scope())
+
+    # 1) Discover inputs (each JSON is parsed at most once; the registry keeps docs + key sets,
+    #    and the on-disk key index lets unchanged files skip parsing during discovery)
+    key_index = None
+    run_state = None
+    rollups = None
+    catalog = None
+    if use_cache:
+        if cache is None:
+            cache = cleanup.enter_context(contextlib.closing(RunCache(cache_root)))
+        key_index, run_state, rollups, catalog = cache.key_index, cache.run_state, cache.rollups, cache.catalog
+        registry = cache.registry
+        registry.keep_docs = not stream
+        cleanup.callback(registry.trim)
+    else:
+        registry = DocRegistry(keep_docs=not stream)
+    if deltas:
+        batch = discover_json_base_deltas(IN_DIR, [IN_DIR / p for p in deltas], registry,
+                                          [IN_DIR / p for p in bases or []])
+        inv_base_p, inv_delta_ps = batch["invoice"]
+        prod_base_p, prod_delta_ps = batch["product"]
+    else:
+        pairs = discover_json_base_delta(IN_DIR, registry)
+        inv_base_p, inv_delta_ps = pairs["invoice"][0], [pairs["invoice"][1]]
+        prod_base_p, prod_delta_ps = pairs["product"][0], [pairs["product"][1]]
+    full_csv_p, mini_csv_p = discover_csv_pair(IN_DIR, registry)
 
     out_products = OUT_DIR / "merged_products_out.json"
     out_invoices = OUT_DIR / "merged_invoices_out.json"
     out_full     = OUT_DIR / "updated_full_future_schema.csv"
     out_mini     = OUT_DIR / "updated_mini.csv"
     out_new      = OUT_DIR / "new_purchases_enriched.csv"
+    out_arrow    = OUT_DIR / f"updated_full_future_schema{ARROW_FORMATS[arrow_format]}" if arrow_format else None
+    out_categories = OUT_DIR / "category_dim.csv" if category_table else None
+
+    input_paths = [inv_base_p] + inv_delta_ps + [prod_base_p] + prod_delta_ps
+    prof.lap("discover", input_bytes=sum(_file_size(p) for p in input_paths))
+
+    if incremental:
+        blocker = _incremental_blocker(run_state, out_full, out_mini, schema_mutations,
+                                       registry.detail_ids(inv_base_p))
+        if blocker:
+            print(f"incremental: {blocker}; doing a full rebuild")
+            incremental = False
+
+    # A merged JSON output whose base is a previous output in the same layout splices the base's
+    # bytes; decided up front, since a spliced base is only read for what the run needs from it.
+    layout = _json_layout_tag(json_indent)
+    # A compacted products output is tagged "<layout>+dedup": splicing it as the base keeps the
+    # next output compacted only if the delta is filtered against the base's DK part numbers.
+    out_layouts = {"product": layout + "+dedup" if compact_products else layout, "invoice": layout}
+    splice = {}
+    for kind, base_p in (("product", prod_base_p), ("invoice", inv_base_p)):
+        base_layout = key_index.layout(registry.content_hash(base_p)) if key_index is not None else None
+        splice[kind] = base_layout in (out_layouts[kind], layout + "+dedup") and _can_splice(base_p, json_indent)
+
+    # Incremental runs never build base rows; base invoices are only streamed (if not spliced) into the merged JSON.
+    invoices_base = JsonArrayStream(inv_base_p) if incremental else registry.doc(inv_base_p)
+    invoices_delta = _chain_docs([registry.doc(p) for p in inv_delta_ps])
+    # A spliced products base is not parsed: the catalog resolves its lookups (ingesting it if new).
+    catalog_view = catalog is not None and splice["product"]
+    products_base = JsonArrayStream(prod_base_p) if catalog_view else registry.doc(prod_base_p)
+    products_delta = _chain_docs([registry.doc(p) for p in prod_delta_ps])
+    prof.lap("load")
+
+    # 2) Expected new rows from delta = delta_only(detail_key); with several deltas, each one
+    #    is credited with the keys not already in the base or an earlier delta
+    new_keys_by_delta: List[set] = []
+    delta_only_keys = set()
+    for p in inv_delta_ps:
+        new_keys = set(registry.difference(p, inv_base_p, "detail")) - delta_only_keys
+        new_keys_by_delta.append(new_keys)
+        delta_only_keys |= new_keys
+    prof.lap("keys", delta_only_keys=len(delta_only_keys))
+
+    # 3) Build lookup with base precedence, plus the per-DK enrichment table the builds join against
+    #    (over the persistent catalog for a spliced base: only the entries the builds use are read),
+    #    and the product facts the catalog stored for unchanged parts
+    view = None
+    if catalog is not None:
+        catalog.ingest(registry.content_hash(prod_base_p), products_base)
+        for p in prod_delta_ps:
+            catalog.ingest(registry.content_hash(p), registry.doc(p))
+        view = cleanup.enter_context(contextlib.closing(
+            catalog.view([registry.content_hash(p) for p in [prod_base_p] + prod_delta_ps])))
+    prod_by_dk = view if catalog_view else build_prod_by_dk(products_base, products_delta)
+    categories = CategoryIndex(itertools.chain(products_base, products_delta)) if category_table else None
+    enrichment = ProductEnrichment(prod_by_dk, categories=categories, catalog=catalog,
+                                   prod_hashes=view.prod_hashes() if view is not None else None)
+    enrichment.preload(iter_invoice_dks(invoices_delta if incremental
+                                        else itertools.chain(invoices_base, invoices_delta)))
+    prof.lap("lookup", products=len(prod_by_dk))
+
+    pool = (cleanup.enter_context(make_build_pool(prod_by_dk, workers, delta_only_keys, enrichment))
+            if workers > 1 else None)
+    if pool:
+        def build(docs, new_keys):
+            return build_parallel(pool, docs, mark_new=new_keys is not None)
+    else:
+        def build(docs, new_keys):
+            return build_frame(docs, prod_by_dk, new_detail_keys=new_keys, enrichment=enrichment)
+    if incremental:
+        # 4) Build only the delta rows; rows already in base are skipped by key
+        df_delta = build(invoices_delta, delta_only_keys)
+        df_merged = df_delta[df_delta["_is_new"]].reset_index(drop=True)
+    else:
+        # 4) Build base rows and merged rows (deduped)
+        df_base = build(invoices_base, None)
+        df_merged = build(itertools.chain(invoices_base, invoices_delta), delta_only_keys)
+    if pool:
+        pool.shutdown()
 
-    with out_products.open("w", encoding="utf-8") as f:
-        json.dump(products_base + products_delta, f, indent=2)
-    with out_invoices.open("w", encoding="utf-8") as f:
-        json.dump(invoices_base + invoices_delta, f, indent=2)
+    declare_dtypes(df_merged)
+    prof.lap("build", base_rows=None if incremental else len(df_base), merged_rows=len(df_merged))
 
-    df_out[schema_out].to_csv(out_full, index=False)
+    # 5) ASSERT A: expected additions matches output “new” markings
+    expected_new = len(delta_only_keys)
+    actual_new = int(df_merged["_is_new"].sum())
+    assert actual_new == expected_new, f"New row count mismatch: expected {expected_new}, got {actual_new}"
+    if len(inv_delta_ps) > 1:
+        assert_new_rows_per_delta(df_merged, {p.name: keys for p, keys in zip(inv_delta_ps, new_keys_by_delta)})
+    prof.lap("assert_a", new_rows=actual_new)
 
-    mini_df = pd.DataFrame({
-        "mfr_pn": df_out["mfr_pn"],
-        "dk_pn": df_out["dk_pn"],
-        "description": df_out["description"],
-        "qty_bought": df_out["_qty_bought"],
-    })
-    mini_df.to_csv(out_mini, index=False)
+    # 6) ASSERT B: excluding new rows, base data identical
+    if incremental:
+        # Old rows are the previous output itself: its keys were matched to the base keys before
+        # choosing incremental mode, and its stamp and tail checksum, checked again here, prove
+        # it is still the file that run wrote.
+        stored = run_state.keys()
+        changed = _previous_outputs_blocker(run_state.meta(), out_full, out_mini)
+        if changed:
+            raise AssertionError(f"Previous outputs changed during the run: {changed}")
+    else:
+        assert_old_rows_identical(df_base, df_merged, FUTURE_FULL_SCHEMA)
+    prof.lap("assert_b")
+
+    # 7) ASSERT C: any NEW MCU rows have at least one MCU field populated
+    if len(df_merged):
+        assert_new_mcu_rows(df_merged)
+    prof.lap("assert_c")
+
+    # 8) Informational: diff vs input full CSV
+    orig_full_rows = registry.csv_fingerprint(full_csv_p)[1]
+    out_row_count = len(df_merged) + (len(stored) if incremental else 0)
+    row_diff_vs_input_full = out_row_count - orig_full_rows
+    prof.lap("input_csv", rows=orig_full_rows)
 
-    df_new = df_out[df_out["_is_new"]][schema_out].copy()
-    df_new.to_csv(out_new, index=False)
+    # 9) Apply optional schema mutations
+    # df_merged is not needed after this point, so it is mutated in place rather than copied
+    df_out, schema_out = apply_schema_mutations(df_merged, FUTURE_FULL_SCHEMA.copy(), schema_mutations)
+    prof.lap("mutations", columns=len(schema_out))
+
+    # 10) Write outputs
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    # The five files are independent: with workers > 1 they are written concurrently (threads);
+    # index/state bookkeeping happens afterwards on this thread.
+    dedup = None
+    json_jobs = []
+    for out_p, kind, tag, base_p, delta_ps, base, delta in (
+            (out_products, "product", "prod", prod_base_p, prod_delta_ps, products_base, products_delta),
+            (out_invoices, "invoice", "detail", inv_base_p, inv_delta_ps, invoices_base, invoices_delta)):
+        out_layout = out_layouts[kind]
+        if out_layout != layout:
+            items, seen = ((delta, registry.prod_keys(base_p)) if splice[kind]
+                           else (itertools.chain(base, delta), ()))
+            dedup = ProductDedup(items, json_indent, seen=seen, expected=len(prod_by_dk))
+            base, delta = [], dedup
+        # Hashed (and the key sets in memory taken) now: with pinned bases (watch mode) base_p is
+        # the output this job replaces.
+        parts = [registry.content_hash(p) for p in [base_p] + delta_ps]
+        held = registry.held_keys([base_p] + delta_ps, tag)
+        json_jobs.append((out_p, kind, tag, parts, held, out_layout, functools.partial(
+            _write_json_concat, out_p, base, delta, json_indent, base_path=base_p if splice[kind] else None)))
+
+    # Rows to append to the existing full/mini CSVs, or None to rewrite them: an incremental
+    # df_out holds only the new rows; append_outputs extends an unchanged previous output.
+    df_append = df_out if incremental else None
+    if append_outputs and not incremental:
+        blocker = _append_blocker(run_state, out_full, out_mini, schema_out, schema_mutations, df_out)
+        if blocker:
+            print(f"append_outputs: {blocker}; rewriting the full and mini CSVs")
+        else:
+            df_append = df_out[df_out["_is_new"]]
+    prev_full_stamp = _file_stamp(out_full) if out_full.exists() else None
+    df_new = df_out.loc[df_out["_is_new"], schema_out] if len(df_out) else pd.DataFrame(columns=schema_out)
+
+    def write_full() -> None:
+        if df_append is None:
+            _replace_atomically(out_full, functools.partial(df_out[schema_out].to_csv, index=False))
+        elif len(df_append):
+            _append_csv(df_append[schema_out], out_full)
+
+    def write_mini() -> None:
+        if df_append is None:
+            _replace_atomically(out_mini, functools.partial(_mini_frame(df_out).to_csv, index=False))
+        elif len(df_append):
+            _append_csv(_mini_frame(df_append), out_mini)
+
+    jobs = [job[-1] for job in json_jobs] + [write_full, write_mini, functools.partial(
+        _replace_atomically, out_new, functools.partial(df_new.to_csv, index=False))]
+    if out_arrow is not None:
+        if incremental and not out_arrow.exists():
+            print(f"{arrow_format}: no existing {out_arrow.name} dataset to append to; "
+                  f"run a full rebuild with arrow_format={arrow_format!r} to create it")
+            out_arrow = None
+        elif not incremental or len(df_out):
+            jobs.append(functools.partial(write_arrow_dataset, df_out, schema_out, out_arrow,
+                                          arrow_format, append=incremental))
+    if out_categories is not None:
+        jobs.append(functools.partial(_replace_atomically, out_categories,
+                                      functools.partial(categories.frame().to_csv, index=False)))
+    # If any write fails, CSVs already appended to are rolled back too: the previous outputs
+    # then still match the run state (which is only saved after every write succeeded).
+    appended = [(p, p.stat()) for p in (out_full, out_mini)] if df_append is not None and len(df_append) else []
+    try:
+        results = _run_jobs(jobs, workers)
+    except BaseException:
+        for p, st in appended:
+            _restore_file(p, st)
+        raise
+
+    if key_index:
+        for (out_p, kind, tag, parts, held, out_layout, _), (_, sha, _) in zip(json_jobs, results):
+            key_index.record_output(out_p, sha, kind, out_layout, tag, parts)
+            registry.adopt(out_p, sha, kind, tag, held)
+            if kind == "product":
+                catalog.record_merged(sha, parts)
+        # the CSVs this run wrote are discovery candidates when OUT_DIR is IN_DIR (watch mode)
+        registry.adopt_csv(out_full, len(schema_out), out_row_count)
+        registry.adopt_csv(out_mini, len(MINI_SCHEMA), out_row_count)
+        registry.adopt_csv(out_new, len(schema_out), len(df_new))
+    if df_append is not None:
+        run_state.save({**_output_meta(out_full, out_mini, schema_out, schema_mutations), "rows": out_row_count},
+                       df_append["_detail_key"].to_numpy(dtype=np.int64),
+                       _row_hashes(df_append, schema_out).view(np.int64), append=True)
+    elif run_state:
+        run_state.save({**_output_meta(out_full, out_mini, schema_out, schema_mutations), "rows": len(df_out)},
+                       df_out["_detail_key"].to_numpy(dtype=np.int64),
+                       _row_hashes(df_out, schema_out).view(np.int64) if append_outputs else None)
+    if rollups is not None:
+        if df_append is None:
+            if _rollup_csv_columns(schema_out) is not None:
+                rollups.invalidate(out_full)  # rebuilt from the CSV when first read
+            else:
+                rollups.update(df_out, _file_stamp(out_full), reset=True)
+        elif rollups.stamp() == prev_full_stamp:
+            rollups.update(df_append, _file_stamp(out_full))
+        else:
+            print("rollups: not in step with the previous full CSV; a full rebuild recomputes them")
+    out_paths = [out_products, out_invoices, out_full, out_mini, out_new]
+    if out_categories is not None:
+        out_paths.append(out_categories)
+    prof.lap("write", rows=len(df_out), appended=df_append is not None,
+             output_bytes=sum(_file_size(p) for p in out_paths))
 
     # 11) Print the key run summary
     # (All of this shows up in your run logs; nothing is required downstream.)
-    non_mcu = df_out[df_out["core_processor"].fillna("") == ""][schema_out]
+    # In incremental mode df_out only holds the new rows, so these figures cover the delta.
+    non_mcu = df_out[df_out["core_processor"].fillna("") == ""][schema_out] if len(df_out) else df_new
     total_cells = non_mcu.size
     missing_cells = int(non_mcu.replace({"": pd.NA}).isna().sum().sum())
     missing_pct = missing_cells / total_cells if total_cells else math.nan
 
-    mcu_row_count = int((df_out["core_processor"].fillna("") != "").sum())
+    mcu_row_count = int((df_out["core_processor"].fillna("") != "").sum()) if len(df_out) else 0
+    scope = " (new rows only)" if incremental else ""
 
     print("─" * 80)
+    print(f"MODE: {'incremental (append delta rows)' if incremental else 'full rebuild'}"
+          f"{' (new rows appended to the full/mini CSVs)' if df_append is not None and not incremental else ''}")
     print("INPUTS (auto-discovered):")
     print(f"  invoices base : {inv_base_p.name}")
-    print(f"  invoices delta: {inv_delta_p.name}")
+    print(f"  invoices delta: {', '.join(p.name for p in inv_delta_ps)}")
     print(f"  products base : {prod_base_p.name}")
-    print(f"  products delta: {prod_delta_p.name}")
+    print(f"  products delta: {', '.join(p.name for p in prod_delta_ps)}")
     print(f"  full csv      : {full_csv_p.name}")
     print(f"  mini csv      : {mini_csv_p.name}")
     print("OUTPUTS:")
@@ -619,14 +2977,142 @@ def run_pipeline(
     print(f"  {out_full}")
     print(f"  {out_mini}")
     print(f"  {out_new}")
+    if out_categories is not None:
+        print(f"  {out_categories}")
+    if out_arrow is not None:
+        print(f"  {out_arrow}/")
+    if prof.enabled:
+        print(f"  {OUT_DIR / RUN_REPORT_NAME}")
     print("CHECKS:")
     print(f"  expected new rows (delta-only): {expected_new}")
     print(f"  actual new rows               : {actual_new}")
+    if len(inv_delta_ps) > 1:
+        for p, new_keys in zip(inv_delta_ps, new_keys_by_delta):
+            print(f"    {p.name}: {len(new_keys)}")
     print(f"  row diff vs input full csv    : {row_diff_vs_input_full}")
-    print(f"  MCU rows (core_processor non-empty): {mcu_row_count}")
-    print(f"  missingness (non-MCU rows only): {missing_pct*100:.2f}%")
+    if dedup is not None:
+        print(f"  products compaction           : {dedup.dropped} duplicate entries dropped "
+              f"({dedup.dropped_bytes} bytes reclaimed)")
+    print(f"  MCU rows (core_processor non-empty){scope}: {mcu_row_count}")
+    print(f"  missingness (non-MCU rows only){scope}: {missing_pct*100:.2f}%")
     print("─" * 80)
 
+    prof.finish(
+        OUT_DIR,
+        mode="incremental" if incremental else "full",
+        options={"stream": stream, "workers": workers, "json_indent": json_indent,
+                 "arrow_format": arrow_format, "use_cache": use_cache, "compact_products": compact_products,
+                 "category_table": category_table,
+                 "schema_mutations": asdict(schema_mutations) if schema_mutations else None},
+        inputs={p.name: _file_size(p) for p in input_paths + [full_csv_p, mini_csv_p]},
+        outputs={p.name: _file_size(p) for p in out_paths},
+        rows={"output": out_row_count, "new": actual_new, "mcu": mcu_row_count},
+        compaction={"dropped": dedup.dropped, "bytes_reclaimed": dedup.dropped_bytes} if dedup else None,
+    )
+    if key_index:
+        # the outputs just replaced (and inputs deleted since) leave stale key sets / lookups
+        catalog.prune(key_index.prune())
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Watch mode
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _json_stamps(dir_: Path) -> Dict[Path, Tuple[int, int]]:
+    """(size, mtime_ns) of every *.json in dir_ (files vanishing mid-scan are skipped)."""
+    out = {}
+    for p in glob.glob(str(dir_ / "*.json")):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        out[Path(p)] = (st.st_size, st.st_mtime_ns)
+    return out
+
+class Watcher:
+    """
+    watch()'s state, one poll at a time: poll() scans IN_DIR once and, if a batch is ready,
+    merges it (see watch). Keeps one RunCache open across its runs (unless run_kwargs bring
+    their own cache=, or use_cache=False); close() closes it.
+    """
+    def __init__(self, IN_DIR: Path, OUT_DIR: Path, **run_kwargs):
+        run_kwargs.setdefault("incremental", run_kwargs.get("use_cache", True))
+        self._own_cache = run_kwargs.get("use_cache", True) and run_kwargs.get("cache") is None
+        if self._own_cache:
+            run_kwargs["cache"] = RunCache(run_kwargs.get("cache_dir") or OUT_DIR / CACHE_DIRNAME)
+        self.IN_DIR = IN_DIR
+        self.OUT_DIR = OUT_DIR
+        self.run_kwargs = run_kwargs
+        self.out_jsons = [OUT_DIR / "merged_invoices_out.json", OUT_DIR / "merged_products_out.json"]
+        self._outputs = {p.resolve() for p in self.out_jsons}
+        self.done = _json_stamps(IN_DIR)
+        self.failed: List[Dict[Path, Tuple[int, int]]] = []  # batches held back until one of their files changes
+        self._last = self.done
+
+    def poll(self) -> Optional[bool]:
+        """True if a batch was merged, False if its run failed, None if no batch was ready."""
+        now = _json_stamps(self.IN_DIR)
+        self.failed = [b for b in self.failed if all(now.get(p) == st for p, st in b.items())]
+        held = {p for b in self.failed for p in b}
+        new = {p: st for p, st in now.items()
+               if p not in self.done and p not in held and p.resolve() not in self._outputs}
+        settled = all(self._last.get(p) == st for p, st in new.items())
+        self._last = now
+        if not new or not settled:
+            return None
+        kinds = {p: _classify_json_head(_peek_json_head(p)) for p in new}
+        for p in [p for p, kind in kinds.items() if kind == "unknown"]:
+            print(f"watch: ignoring {p.name} (not an invoice or product export)")
+            self.done[p] = new.pop(p)
+        if not {"invoice", "product"} <= set(kinds.values()):
+            return None  # wait for the other half of the export
+
+        batch = sorted(new, key=lambda p: (new[p][1], p.name))
+        print(f"watch: merging {', '.join(p.name for p in batch)}")
+        try:
+            run_pipeline(IN_DIR=self.IN_DIR, OUT_DIR=self.OUT_DIR, deltas=batch,
+                         bases=[p for p in self.out_jsons if p.exists()], **self.run_kwargs)
+        except Exception as e:
+            print(f"watch: run failed ({type(e).__name__}: {e}); waiting for the files to change")
+            self.failed.append(new)
+            return False
+        self.done.update(new)
+        return True
+
+    def close(self) -> None:
+        if self._own_cache:
+            self.run_kwargs["cache"].close()
+
+def watch(IN_DIR: Path, OUT_DIR: Path, interval: float = 2.0, max_runs: Optional[int] = None,
+          **run_kwargs) -> int:
+    """
+    Service mode: stays resident and polls IN_DIR every `interval` seconds for new export JSONs.
+    Once a new invoice JSON and product JSON have both arrived and stopped changing (same size
+    and mtime on two polls), they are merged onto the previous merged outputs in OUT_DIR as one
+    batch run (deltas=..., bases=...), incremental by default, so only their rows are built and
+    the outputs are replaced atomically. The caches stay open across runs (RunCache): a run
+    starts with the key sets, hashes and stored row keys the previous one read or wrote, so
+    the merged base is neither parsed nor re-read from the index. JSONs present at startup
+    count as processed (run the pipeline once first). A failed batch is reported and retried
+    as a whole once any of its files changes (or disappears). run_kwargs go to run_pipeline.
+    Returns the number of completed runs (after max_runs, or on Ctrl-C).
+    """
+    watcher = Watcher(IN_DIR, OUT_DIR, **run_kwargs)
+    runs = 0
+    print(f"watch: polling {IN_DIR} every {interval:g}s for new exports (Ctrl-C to stop)")
+    try:
+        while max_runs is None or runs < max_runs:
+            time.sleep(interval)
+            if watcher.poll():
+                runs += 1
+    except KeyboardInterrupt:
+        print("watch: stopped")
+    finally:
+        watcher.close()
+    return runs
 
 if __name__ == "__main__":
-    run_pipeline(IN_DIR=Path("."), OUT_DIR=Path("."))
+    if "--watch" in sys.argv[1:]:
+        watch(IN_DIR=Path("."), OUT_DIR=Path("."))
+    else:
+        run_pipeline(IN_DIR=Path("."), OUT_DIR=Path("."))
@@ -0,0 +1,912 @@
+"""Regression tests for dk_pipeline (pytest). Inputs are cut from the checked-in merged outputs."""
+from __future__ import annotations
+import contextlib, copy, csv, io, json, multiprocessing, os, re, shutil, sqlite3, sys, tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dk_pipeline as dk
+
+HERE = Path(__file__).resolve().parent
+
+
+def _archive(dir_: Path, inv_base=slice(0, 150), inv_delta=slice(150, None),
+             prod_base=slice(0, 150), prod_delta=slice(140, 180)) -> None:
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    dir_.mkdir(parents=True, exist_ok=True)
+    for name, doc in (("inv_base.json", invoices[inv_base]), ("inv_delta.json", invoices[inv_delta]),
+                      ("prod_base.json", products[prod_base]), ("prod_delta.json", products[prod_delta])):
+        (dir_ / name).write_text(json.dumps(doc, indent=2), encoding="utf-8")
+    shutil.copy(HERE / "updated_full_future_schema.csv", dir_ / "full.csv")
+    shutil.copy(HERE / "updated_mini.csv", dir_ / "mini.csv")
+
+
+def _run(**kwargs) -> str:
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        dk.run_pipeline(**kwargs)
+    return out.getvalue()
+
+
+def test_compaction_all_duplicate_delta_twice(tmp_path):
+    # Every delta product is already in the base, so the compacted output is byte-identical
+    # to the base; its cached key set must survive both runs.
+    _archive(tmp_path / "in", prod_delta=slice(10, 20))
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out", compact_products=True)
+
+    nxt = tmp_path / "in2"
+    nxt.mkdir()
+    shutil.copy(tmp_path / "out" / "merged_products_out.json", nxt / "prod_base.json")
+    shutil.copy(tmp_path / "out" / "merged_invoices_out.json", nxt / "inv_base.json")
+    for name in ("prod_delta.json", "inv_delta.json", "full.csv", "mini.csv"):
+        shutil.copy(tmp_path / "in" / name, nxt / name)
+    expected = dk.build_prod_by_dk(json.loads((nxt / "prod_base.json").read_text(encoding="utf-8")), [])
+    for _ in range(2):
+        summary = _run(IN_DIR=nxt, OUT_DIR=tmp_path / "out", deltas=["inv_delta.json", "prod_delta.json"],
+                       bases=["inv_base.json", "prod_base.json"], compact_products=True)
+        assert "10 duplicate entries dropped" in summary
+        out = json.loads((tmp_path / "out" / "merged_products_out.json").read_text(encoding="utf-8"))
+        assert dk.build_prod_by_dk(out, []) == expected
+
+
+def test_failed_compaction_leaves_previous_output(tmp_path, monkeypatch):
+    _archive(tmp_path / "in")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out", use_cache=False)
+    before = (tmp_path / "out" / "merged_products_out.json").read_bytes()
+
+    # A part no product entry carries makes the coverage check fail mid-write.
+    build = dk.build_prod_by_dk
+    monkeypatch.setattr(dk, "build_prod_by_dk", lambda base, delta: {**build(base, delta), "PHANTOM-ND": {}})
+    with pytest.raises(AssertionError, match="Compacted products cover"):
+        _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out", use_cache=False, compact_products=True)
+    assert (tmp_path / "out" / "merged_products_out.json").read_bytes() == before
+    assert not list((tmp_path / "out").glob(".*.tmp"))
+
+
+def test_enrichment_cache_follows_config(tmp_path, monkeypatch):
+    _archive(tmp_path / "in")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    monkeypatch.setattr(dk, "MCU_PROMOTED_PARAM_TEXTS", dk.MCU_PROMOTED_PARAM_TEXTS[:1])
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "fresh")
+    for name in ("updated_full_future_schema.csv", "new_purchases_enriched.csv"):
+        assert (tmp_path / "out" / name).read_bytes() == (tmp_path / "fresh" / name).read_bytes()
+
+
+def test_stored_product_facts_are_reused_until_the_product_changes(tmp_path, monkeypatch):
+    _archive(tmp_path / "in")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    before = (tmp_path / "out" / "updated_full_future_schema.csv").read_bytes()
+
+    derive = dk.product_facts
+    derived = []  # parts whose facts were derived from a product entry
+    monkeypatch.setattr(dk, "product_facts",
+                        lambda prod, part, *a: (prod and derived.append(part)) or derive(prod, part, *a))
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    assert not derived
+    assert (tmp_path / "out" / "updated_full_future_schema.csv").read_bytes() == before
+
+    # an edited product entry has another hash: only its parts are derived again
+    invoiced = set(dk.iter_invoice_dks(json.loads((tmp_path / "in" / "inv_delta.json").read_text(encoding="utf-8"))))
+    products = json.loads((tmp_path / "in" / "prod_delta.json").read_text(encoding="utf-8"))
+    prod = next(p for p in products[10:] if p.get("series")  # [10:] is not shadowed by the base
+                and invoiced & {v["digiKeyProductNumber"] for v in p["productVariations"]})
+    prod["series"] = {**prod["series"], "name": "Edited series"}
+    (tmp_path / "in" / "prod_delta.json").write_text(json.dumps(products, indent=2), encoding="utf-8")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    parts = {v["digiKeyProductNumber"] for v in prod["productVariations"]}
+    assert derived and set(derived) <= parts
+    full = pd.read_csv(tmp_path / "out" / "updated_full_future_schema.csv", dtype=str, keep_default_na=False)
+    assert (full.loc[full["dk_pn"].isin(parts), "series"] == "Edited series").all()
+
+
+def test_incremental_falls_back_when_facts_rules_changed(tmp_path, monkeypatch):
+    # Rows built under other product-facts rules must not be extended with rows built under these.
+    d = _incremental_setup(tmp_path)
+    monkeypatch.setattr(dk, "MCU_PROMOTED_PARAM_TEXTS", dk.MCU_PROMOTED_PARAM_TEXTS[:1])
+    summary = _incremental_run(d)
+    assert "incremental: product facts rules changed; doing a full rebuild" in summary
+
+    fresh = _full_rebuild(tmp_path)
+    assert (d / "updated_full_future_schema.csv").read_bytes() == (fresh / "updated_full_future_schema.csv").read_bytes()
+
+
+def test_pinned_base_outputs_are_registered(tmp_path):
+    # Watch mode pins the bases to the outputs the run replaces; the new outputs must still
+    # be indexed (keys + catalog) so the next cycle does not re-parse the merged history.
+    d = tmp_path / "in"
+    _archive(d, inv_delta=slice(150, 170), prod_delta=slice(140, 160))
+    _run(IN_DIR=d, OUT_DIR=d)
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    (d / "inv_delta2.json").write_text(json.dumps(invoices[170:190], indent=2), encoding="utf-8")
+    (d / "prod_delta2.json").write_text(json.dumps(products[160:], indent=2), encoding="utf-8")
+    _run(IN_DIR=d, OUT_DIR=d, deltas=["inv_delta2.json", "prod_delta2.json"],
+         bases=["merged_invoices_out.json", "merged_products_out.json"], incremental=True)
+
+    cache = d / dk.CACHE_DIRNAME
+    key_index, catalog = dk.KeyIndex(cache / "key_index.sqlite"), dk.ProductCatalog(cache / "catalog.sqlite")
+    try:
+        for name, tag in (("merged_invoices_out.json", "detail"), ("merged_products_out.json", "prod")):
+            assert key_index.has_keys(dk._file_sha256(d / name), tag)
+        assert catalog.has_source(dk._file_sha256(d / "merged_products_out.json"))
+    finally:
+        key_index.close()
+        catalog.close()
+
+
+def test_watch_retries_failed_batch_and_keeps_warm_state(tmp_path):
+    d = tmp_path / "in"
+    _archive(d, inv_delta=slice(150, 170), prod_delta=slice(140, 160))
+    _run(IN_DIR=d, OUT_DIR=d)
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    good = json.dumps(products[160:], indent=2)
+    watcher = dk.Watcher(d, d)
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            (d / "inv_delta2.json").write_text(json.dumps(invoices[170:185], indent=2), encoding="utf-8")
+            (d / "prod_delta2.json").write_text(good[:len(good) // 2], encoding="utf-8")  # truncated copy
+            assert watcher.poll() is None  # not settled yet
+            assert watcher.poll() is False
+            assert watcher.poll() is None  # held back until one of its files changes
+            (d / "prod_delta2.json").write_text(good, encoding="utf-8")  # only the bad half is re-copied
+            assert watcher.poll() is None
+            assert watcher.poll() is True
+            (d / "inv_delta3.json").write_text(json.dumps(invoices[185:], indent=2), encoding="utf-8")
+            (d / "prod_delta3.json").write_text(good, encoding="utf-8")
+            assert watcher.poll() is None
+            assert watcher.poll() is True
+
+        assert "watch: run failed" in out.getvalue()
+        assert out.getvalue().count("MODE: incremental") == 2
+        # the second cycle started from the key sets the first one adopted for its outputs
+        merged = d / "merged_invoices_out.json"
+        keys, ids = watcher.run_kwargs["cache"].registry.held_keys([merged], "detail")
+        parsed = frozenset(dk.iter_detail_keys(json.loads(merged.read_text(encoding="utf-8"))))
+        assert keys == parsed
+        assert ids.tolist() == sorted(dk.detail_key_ids(parsed).tolist())
+    finally:
+        watcher.close()
+    fresh = _full_rebuild(tmp_path)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv", "merged_invoices_out.json"):
+        assert (d / name).read_bytes() == (fresh / name).read_bytes()
+
+
+def test_run_report_records_every_stage(tmp_path):
+    _archive(tmp_path / "in")
+    out = tmp_path / "out"
+    assert dk.RunProfiler().finish(out) is None  # disabled: writes nothing
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=out, report=True, trace_memory=True)
+    report = json.loads((out / dk.RUN_REPORT_NAME).read_text(encoding="utf-8"))
+    assert [s["stage"] for s in report["stages"]] == [
+        "discover", "load", "keys", "lookup", "build", "assert_a", "assert_b", "assert_c",
+        "input_csv", "mutations", "write"]
+    for stage in report["stages"]:
+        assert {"wall_s", "cpu_s", "peak_rss_mb", "tracemalloc_peak_mb"} <= stage.keys()
+        assert stage["wall_s"] >= 0 and stage["cpu_s"] >= 0
+    stages = {s["stage"]: s for s in report["stages"]}
+    assert stages["build"]["merged_rows"] == report["rows"]["output"] > 0
+    assert stages["write"]["output_bytes"] == sum(report["outputs"].values())
+    assert {"wall_s", "cpu_s", "children_cpu_s", "peak_rss_mb"} <= report["totals"].keys()
+    assert report["mode"] == "full" and report["options"]["use_cache"] is True
+    assert not tracemalloc.is_tracing()
+
+
+def test_failed_run_closes_what_it_opened(tmp_path, monkeypatch):
+    # Watch mode keeps running after a failed cycle: nothing the run opened may outlive it.
+    _archive(tmp_path / "in")
+    connections = []
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, "connect", lambda *a, **kw: connections.append(connect(*a, **kw)) or connections[-1])
+
+    def broken_build(pool, *args, **kwargs):
+        pool.submit(int).result()
+        raise RuntimeError("build failed")
+    monkeypatch.setattr(dk, "build_parallel", broken_build)
+    with pytest.raises(RuntimeError, match="build failed"):
+        _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out", workers=2, profile=True, trace_memory=True)
+
+    assert connections
+    for con in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            con.execute("SELECT 1")
+    assert not multiprocessing.active_children()
+    assert not tracemalloc.is_tracing()
+    assert sys.getprofile() is None
+
+
+def _incremental_setup(tmp_path, **kwargs) -> Path:
+    d = tmp_path / "in"
+    _archive(d, inv_delta=slice(150, 170), prod_delta=slice(140, 160))
+    _run(IN_DIR=d, OUT_DIR=d, **kwargs)
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    (d / "inv_delta2.json").write_text(json.dumps(invoices[170:], indent=2), encoding="utf-8")
+    (d / "prod_delta2.json").write_text(json.dumps(products[160:], indent=2), encoding="utf-8")
+    return d
+
+
+def _incremental_run(d: Path, **kwargs) -> str:
+    return _run(IN_DIR=d, OUT_DIR=d, deltas=["inv_delta2.json", "prod_delta2.json"],
+                bases=["merged_invoices_out.json", "merged_products_out.json"], incremental=True, **kwargs)
+
+
+def _two_delta_setup(tmp_path, name: str) -> Path:
+    """_incremental_setup's history, with the rest of the archive queued as two invoice + product deltas."""
+    d = tmp_path / name
+    _archive(d, inv_delta=slice(150, 170), prod_delta=slice(140, 160))
+    _run(IN_DIR=d, OUT_DIR=d)
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    for i, inv, prod in ((2, slice(170, 185), slice(160, 170)), (3, slice(185, None), slice(170, None))):
+        (d / f"inv_delta{i}.json").write_text(json.dumps(invoices[inv], indent=2), encoding="utf-8")
+        (d / f"prod_delta{i}.json").write_text(json.dumps(products[prod], indent=2), encoding="utf-8")
+    return d
+
+
+def test_batch_checks_each_delta_and_matches_sequential_runs(tmp_path, monkeypatch):
+    bases = ["merged_invoices_out.json", "merged_products_out.json"]
+    checked = []
+    per_delta = dk.assert_new_rows_per_delta
+    monkeypatch.setattr(dk, "assert_new_rows_per_delta", lambda df, keys: checked.append(keys) or per_delta(df, keys))
+    batch = _two_delta_setup(tmp_path, "batch")
+    _run(IN_DIR=batch, OUT_DIR=batch, deltas=["inv_delta2.json", "prod_delta2.json", "inv_delta3.json",
+                                              "prod_delta3.json"], bases=bases, incremental=True)
+
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    seen = set(dk.iter_detail_keys(invoices[:170]))
+    assert len(checked) == 1 and list(checked[0]) == ["inv_delta2.json", "inv_delta3.json"]
+    for name, docs in (("inv_delta2.json", invoices[170:185]), ("inv_delta3.json", invoices[185:])):
+        assert checked[0][name] and checked[0][name] == set(dk.iter_detail_keys(docs)) - seen
+        seen |= checked[0][name]
+
+    sequential = _two_delta_setup(tmp_path, "sequential")
+    for i in (2, 3):
+        _run(IN_DIR=sequential, OUT_DIR=sequential, deltas=[f"inv_delta{i}.json", f"prod_delta{i}.json"],
+             bases=bases, incremental=True)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv", *bases):
+        assert (batch / name).read_bytes() == (sequential / name).read_bytes(), name
+
+
+def test_assert_new_rows_per_delta_names_the_short_delta():
+    df = pd.DataFrame({"_is_new": [False, True, True],
+                       "_detail_key": dk.detail_key_ids([(1, 1), (2, 1), (3, 1)])})
+    dk.assert_new_rows_per_delta(df, {"a.json": {(2, 1)}, "b.json": {(3, 1)}})
+    with pytest.raises(AssertionError, match="for delta b.json: expected 2, got 1"):
+        dk.assert_new_rows_per_delta(df, {"a.json": {(2, 1)}, "b.json": {(3, 1), (1, 1)}})
+
+
+def test_incremental_falls_back_when_mini_csv_changed(tmp_path):
+    d = _incremental_setup(tmp_path)
+    with (d / "updated_mini.csv").open("a", encoding="utf-8") as f:
+        f.write("edited,by,hand,1\n")
+    assert "incremental: updated_mini.csv changed since the last run; doing a full rebuild" in _incremental_run(d)
+    assert "edited,by,hand" not in (d / "updated_mini.csv").read_text(encoding="utf-8")
+
+
+def test_incremental_falls_back_when_stored_keys_differ(tmp_path):
+    d = _incremental_setup(tmp_path)
+    con = sqlite3.connect(str(d / dk.CACHE_DIRNAME / "run_state.sqlite"))
+    with con:
+        con.execute("UPDATE rows SET key_id = key_id + 1 WHERE seq = (SELECT MIN(seq) FROM rows)")
+    con.close()
+    summary = _incremental_run(d)
+    assert "incremental: stored row keys differ from the base invoices; doing a full rebuild" in summary
+    assert "MODE: full rebuild" in summary
+
+
+def test_run_state_rewrite_of_the_same_keys_forgets_their_hashes(tmp_path):
+    state = dk.RunState(tmp_path / "run_state.sqlite")
+    try:
+        keys = np.array([3, 1, 2], dtype=np.int64)
+        state.save({"rows": 3}, keys, np.array([7, 8, 9], dtype=np.int64))
+        state.save({"rows": 3}, keys)
+        assert state.keys().tolist() == [3, 1, 2] and state.row_hashes() is None
+        state.save({"rows": 2}, keys[:2])
+        assert state.keys().tolist() == [3, 1] and state.meta() == {"rows": 2}
+    finally:
+        state.close()
+
+
+def _append_run(d: Path, **kwargs) -> str:
+    return _run(IN_DIR=d, OUT_DIR=d, deltas=["inv_delta2.json", "prod_delta2.json"],
+                bases=["merged_invoices_out.json", "merged_products_out.json"], append_outputs=True, **kwargs)
+
+
+def _full_rebuild(tmp_path, **kwargs) -> Path:
+    """The outputs _incremental_setup + one more run should match, built in one full run."""
+    fresh = tmp_path / "fresh"
+    _archive(fresh, inv_delta=slice(150, None), prod_delta=slice(140, None))
+    _run(IN_DIR=fresh, OUT_DIR=fresh, **kwargs)
+    return fresh
+
+
+def test_append_outputs_matches_a_full_rebuild(tmp_path):
+    d = _incremental_setup(tmp_path)
+    before = (d / "updated_full_future_schema.csv").read_bytes()
+    summary = _append_run(d)
+    assert "MODE: full rebuild (new rows appended to the full/mini CSVs)" in summary
+    assert (d / "updated_full_future_schema.csv").read_bytes().startswith(before)
+    fresh = _full_rebuild(tmp_path)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv"):
+        assert (d / name).read_bytes() == (fresh / name).read_bytes()
+
+
+def _edit_mini_csv(d: Path, monkeypatch) -> None:
+    with (d / "updated_mini.csv").open("a", encoding="utf-8") as f:
+        f.write("edited,by,hand,1\n")
+
+
+def _drop_series_column(d: Path, monkeypatch) -> None:
+    monkeypatch.setattr(dk, "FUTURE_FULL_SCHEMA", [c for c in dk.FUTURE_FULL_SCHEMA if c != "series"])
+
+
+@pytest.mark.parametrize("change, mutations, reason", [
+    (_edit_mini_csv, None, "updated_mini.csv changed since the last run"),
+    (_drop_series_column, None, "output schema changed"),
+    (None, dk.SchemaMutations(numeric_columns=True), "schema mutations changed"),
+], ids=["outputs_edited", "schema_changed", "mutations_changed"])
+def test_append_outputs_rewrites_when_blocked(tmp_path, monkeypatch, change, mutations, reason):
+    d = _incremental_setup(tmp_path)
+    if change:
+        change(d, monkeypatch)
+    summary = _append_run(d, schema_mutations=mutations)
+    assert f"append_outputs: {reason}; rewriting the full and mini CSVs" in summary
+    assert "MODE: full rebuild\n" in summary
+    fresh = _full_rebuild(tmp_path, schema_mutations=mutations)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv"):
+        assert (d / name).read_bytes() == (fresh / name).read_bytes()
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "feather"])
+def test_arrow_dataset_reads_back_typed_csv_values(tmp_path, fmt):
+    ds = pytest.importorskip("pyarrow.dataset")
+    import pyarrow as pa
+    mutations = dk.SchemaMutations(numeric_columns=True)
+    d = _incremental_setup(tmp_path, schema_mutations=mutations, arrow_format=fmt)
+    _incremental_run(d, schema_mutations=mutations, arrow_format=fmt)
+
+    out = d / f"updated_full_future_schema{dk.ARROW_FORMATS[fmt]}"
+    assert len(list(out.glob("part-*"))) == 2  # the incremental run appended a part
+    table = ds.dataset(out, format="parquet" if fmt == "parquet" else "ipc").to_table()
+    types = dict(zip(table.schema.names, table.schema.types))
+    for c in ("qty_shipped", "invoice_id", *dk.NUMERIC_COLUMNS):
+        assert types[c] == pa.int64(), c
+    assert types["gbp_unit_price"] == types["gbp_ext_price"] == pa.decimal128(18, 5)
+    assert types["date_shipped"] == pa.timestamp("ms", tz="UTC")
+    assert types["other_parameters"] == pa.map_(pa.string(), pa.string())
+
+    rows = table.to_pylist()
+    csv_rows = pd.read_csv(d / "updated_full_future_schema.csv", dtype=str, keep_default_na=False).to_dict("records")
+    assert len(rows) == len(csv_rows)
+    for row, text in zip(rows, csv_rows):
+        assert row["dk_pn"] == text["dk_pn"] and row["mfr"] == text["mfr"]
+        assert row["qty_shipped"] == int(text["qty_shipped"]) == row["qty_shipped_int"]
+        assert row["invoice_id"] == int(text["invoice_id"])
+        assert row["gbp_unit_price"] == dk._parse_money(text["gbp_unit_price"])
+        assert row["gbp_ext_price"] == dk._parse_money(text["gbp_ext_price"])
+        assert row["gbp_unit_price"] * 100000 == row["gbp_unit_price_e5"] == int(text["gbp_unit_price_e5"])
+        assert row["gbp_ext_price"] * 100 == row["gbp_ext_price_e2"] == int(text["gbp_ext_price_e2"])
+        assert row["date_shipped"] == pd.Timestamp(text["date_shipped"]).to_pydatetime()
+        params = text["other_parameters"]
+        assert dict(row["other_parameters"]) == (json.loads(params) if params else {})
+
+
+def test_failed_write_rolls_back_appended_csvs(tmp_path, monkeypatch):
+    d = _incremental_setup(tmp_path)
+    names = ("updated_full_future_schema.csv", "updated_mini.csv")
+    before = {name: ((d / name).read_bytes(), (d / name).stat().st_mtime_ns) for name in names}
+    replace = dk._replace_atomically
+
+    def broken(out, write):
+        if out.name == "new_purchases_enriched.csv":
+            raise OSError("disk full")
+        return replace(out, write)
+    monkeypatch.setattr(dk, "_replace_atomically", broken)
+    with pytest.raises(OSError, match="disk full"):
+        _incremental_run(d)
+    assert {name: ((d / name).read_bytes(), (d / name).stat().st_mtime_ns) for name in names} == before
+
+    # the merged JSONs were already replaced, so the retry rebuilds; it must not build on a partial append
+    monkeypatch.setattr(dk, "_replace_atomically", replace)
+    _incremental_run(d)
+    fresh = _full_rebuild(tmp_path)
+    for name in names:
+        assert (d / name).read_bytes() == (fresh / name).read_bytes()
+
+
+def test_incremental_detects_rows_edited_behind_the_stamp(tmp_path):
+    d = _incremental_setup(tmp_path)
+    full = d / "updated_full_future_schema.csv"
+    st = full.stat()
+    text = full.read_text(encoding="utf-8")
+    last = text.splitlines()[-1]
+    edited = last.replace("0", "1", 1) if "0" in last else last.replace("1", "0", 1)
+    full.write_text(text[:text.rindex(last)] + edited + text[text.rindex(last) + len(last):], encoding="utf-8")
+    os.utime(full, ns=(st.st_atime_ns, st.st_mtime_ns))
+    summary = _incremental_run(d)
+    assert ("incremental: updated_full_future_schema.csv changed since the last run; doing a full rebuild"
+            in summary)
+    assert edited not in full.read_text(encoding="utf-8")
+
+
+@pytest.mark.parametrize("mutations", [None, dk.SchemaMutations(numeric_columns=True),
+                                       dk.SchemaMutations(drop_output_columns=["mfr_pn"])])
+def test_incremental_rollups_match_a_full_recompute(tmp_path, mutations):
+    d = _incremental_setup(tmp_path, schema_mutations=mutations)
+    rollups = dk.SpendRollups(d / dk.CACHE_DIRNAME / "rollups.sqlite")
+    try:
+        rollups.totals("total")  # does the rebuild the full run deferred, if it could
+        assert "MODE: incremental" in _incremental_run(d, schema_mutations=mutations)
+        incremental = {dim: rollups.rows(dim) for dim in ["total"] + dk.ROLLUP_DIMENSIONS}
+    finally:
+        rollups.close()
+    assert sum(spend for *_, spend in incremental["total"]) > 0
+
+    fresh = _full_rebuild(tmp_path, schema_mutations=mutations)
+    rollups = dk.SpendRollups(fresh / dk.CACHE_DIRNAME / "rollups.sqlite")
+    try:
+        assert {dim: rollups.rows(dim) for dim in incremental} == incremental
+    finally:
+        rollups.close()
+
+
+def test_replaced_outputs_leave_no_cached_keys(tmp_path):
+    d = _incremental_setup(tmp_path)
+    replaced = {dk._file_sha256(d / name) for name in ("merged_invoices_out.json", "merged_products_out.json")}
+    _incremental_run(d)
+
+    cache = d / dk.CACHE_DIRNAME
+    key_index, catalog = sqlite3.connect(str(cache / "key_index.sqlite")), sqlite3.connect(str(cache / "catalog.sqlite"))
+    try:
+        indexed = {sha for (sha,) in key_index.execute("SELECT sha256 FROM files")}
+        assert not replaced & indexed
+        assert {sha for (sha,) in key_index.execute("SELECT DISTINCT sha256 FROM keys")} <= indexed
+        assert {sha for (sha,) in catalog.execute("SELECT DISTINCT sha256 FROM source_parts")} <= indexed
+    finally:
+        key_index.close()
+        catalog.close()
+
+
+def test_output_key_sets_are_copied_once_needed_and_outlive_their_parts(tmp_path):
+    index = dk.KeyIndex(tmp_path / "key_index.sqlite")
+    try:
+        files = {}
+        for name, keys in (("a", {("1", "x")}), ("b", {("2", "y"), ("1", "x")})):
+            (tmp_path / name).write_text(name, encoding="utf-8")
+            st = (tmp_path / name).stat()
+            index.record_file(str(tmp_path / name), st.st_size, st.st_mtime_ns, name * 64, "invoice")
+            index.put_keys(name * 64, "detail", keys)
+            files[name] = name * 64
+        (tmp_path / "out").write_text("out", encoding="utf-8")
+        index.record_output(tmp_path / "out", "o" * 64, "invoice", "layout", "detail", list(files.values()))
+        assert not index._con.execute("SELECT 1 FROM keys WHERE sha256=?", ("o" * 64,)).fetchone()
+
+        (tmp_path / "a").unlink()
+        index.prune()
+        assert index.has_keys("o" * 64, "detail")
+        assert index.get_keys("o" * 64, "detail") == {("1", "x"), ("2", "y")}
+        assert not index.has_keys("a" * 64, "detail")
+    finally:
+        index.close()
+
+
+def test_replaced_product_files_leave_no_orphaned_products(tmp_path):
+    _archive(tmp_path / "in")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+    # products[160:180] were only in the delta and the merged output, both replaced now
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    (tmp_path / "in" / "prod_delta.json").write_text(json.dumps(products[140:160], indent=2), encoding="utf-8")
+    _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / "out")
+
+    con = sqlite3.connect(str(tmp_path / "out" / dk.CACHE_DIRNAME / "catalog.sqlite"))
+    try:
+        stored = {h for (h,) in con.execute("SELECT prod_hash FROM products")}
+        assert stored == {dk._product_hash(p) for p in products[:160]}
+        for table in ("parts", "mfr_parts", "source_parts", "source_products"):
+            assert {h for (h,) in con.execute(f"SELECT prod_hash FROM {table}")} <= stored
+    finally:
+        con.close()
+
+
+@pytest.mark.parametrize("mutations", [None, dk.SchemaMutations(
+    drop_output_columns=["series"], promote_other_params={"Package / Case": "package_case"}, numeric_columns=True)])
+def test_build_frame_matches_build_rows(mutations):
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    prod_by_dk = dk.build_prod_by_dk(products[:150], products[140:])
+    new_keys = set(dk.iter_detail_keys(invoices[150:])) - set(dk.iter_detail_keys(invoices[:150]))
+    frame = dk.build_frame(invoices, prod_by_dk, new_keys)
+    rows = pd.DataFrame(dk.build_rows(invoices, prod_by_dk, new_keys))
+    assert 0 < frame["_is_new"].sum() < len(frame)
+    frame, schema = dk.apply_schema_mutations(dk.declare_dtypes(frame), dk.FUTURE_FULL_SCHEMA.copy(), mutations)
+    rows, _ = dk.apply_schema_mutations(dk.declare_dtypes(rows), dk.FUTURE_FULL_SCHEMA.copy(), mutations)
+    # compared by value: the frame's blobs are categorical, build_rows' plain strings
+    frame, rows = (f.astype({"other_parameters": object}) for f in (frame, rows))
+    pd.testing.assert_frame_equal(frame, rows)
+    assert set(schema) <= set(frame.columns)
+
+
+def test_numeric_columns_are_the_raw_fields(tmp_path):
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    frame = dk.declare_dtypes(dk.build_frame(invoices, dk.build_prod_by_dk(products, [])))
+    assert {c: str(frame[c].dtype) for c in dk.NUMERIC_COLUMNS} == dk.NUMERIC_COLUMNS
+    raw = {dk.detail_key_id(d): d for o in invoices for d in o.get("invoiceDetails", [])}
+    for kid, qty, unit, ext in frame[["_detail_key", *dk.NUMERIC_COLUMNS]].astype(object).itertuples(index=False):
+        d = raw[kid]
+        assert (qty, unit, ext) == (d["quantityShipped"], d["unitPrice"], d["extendedPrice"])
+        assert dk._parse_money(d["formattedUnitPrice"]) * 100000 == unit
+        assert dk._parse_money(d["formattedExtendedPrice"]) * 100 == ext
+
+    frame, schema = dk.apply_schema_mutations(frame, dk.FUTURE_FULL_SCHEMA.copy(),
+                                              dk.SchemaMutations(numeric_columns=True))
+    frame[schema].to_csv(tmp_path / "full.csv", index=False)
+    back = pd.read_csv(tmp_path / "full.csv", dtype=str, keep_default_na=False)
+    for c in dk.NUMERIC_COLUMNS:
+        assert back[c].tolist() == [str(v) for v in frame[c]]  # plain integers, no ".0"
+
+
+def _drop_numbers(p: Path, order: int) -> None:
+    """Removes the raw quantity and prices from the first line of p's order-th order."""
+    doc = json.loads(p.read_text(encoding="utf-8"))
+    for k in ("quantityShipped", "unitPrice", "extendedPrice"):
+        doc[order]["invoiceDetails"][0].pop(k)
+    p.write_text(json.dumps(doc, indent=2), encoding="utf-8")
+
+
+@pytest.mark.parametrize("run", [_incremental_run, _append_run], ids=["incremental", "append_outputs"])
+def test_numeric_columns_of_a_line_without_price_or_quantity(tmp_path, run):
+    mutations = dk.SchemaMutations(numeric_columns=True)
+    d = _incremental_setup(tmp_path, schema_mutations=mutations, append_outputs=run is _append_run)
+    _drop_numbers(d / "inv_delta2.json", 0)
+    summary = run(d, schema_mutations=mutations)
+    assert "MODE: incremental" in summary or "appended to the full/mini CSVs" in summary
+
+    fresh = tmp_path / "fresh"
+    _archive(fresh, inv_delta=slice(150, None), prod_delta=slice(140, None))
+    _drop_numbers(fresh / "inv_delta.json", 20)
+    _run(IN_DIR=fresh, OUT_DIR=fresh, schema_mutations=mutations)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv"):
+        assert (d / name).read_bytes() == (fresh / name).read_bytes()
+
+    frame = pd.DataFrame({"n": pd.array([1, None], dtype="Int64"), "s": ["x", None]})
+    back = pd.read_csv(io.StringIO(frame.to_csv(index=False)), dtype=str, keep_default_na=False)
+    assert (dk._row_hashes(frame, ["n", "s"]) == dk._row_hashes(back, ["n", "s"])).all()
+
+
+def test_promoted_columns_are_the_other_parameters_values():
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    frame = dk.build_frame(invoices, dk.build_prod_by_dk(products, []))
+    blobs = frame["other_parameters"].tolist()
+    promote = {"Interface": "interface", "Mounting Type": "mounting", "No Such Parameter": "missing"}
+    mut = dk.SchemaMutations(promote_other_params=promote)
+    frame, schema = dk.apply_schema_mutations(frame, dk.FUTURE_FULL_SCHEMA.copy(), mut)
+
+    at = schema.index("other_parameters")
+    assert schema[at - 3:at] == list(promote.values())
+    for i, blob in enumerate(blobs):
+        params = json.loads(blob) if blob else {}
+        for src, col in promote.items():
+            assert frame[col].iat[i] == params.get(src, "")
+        assert json.loads(frame["other_parameters"].iat[i]) == {k: v for k, v in params.items() if k not in promote}
+    assert (frame["interface"] != "").any() and (frame["mounting"] != "").any()
+    assert (frame["missing"] == "").all()
+
+    empty, _ = dk.apply_schema_mutations(frame.iloc[:0].copy(), dk.FUTURE_FULL_SCHEMA.copy(), mut)
+    assert set(promote.values()) <= set(empty.columns)
+
+
+def test_rows_share_one_other_parameters_blob_per_part():
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    prod_by_dk = dk.build_prod_by_dk(products, [])
+    rebought = copy.deepcopy(invoices)  # every line bought again, under other invoice ids
+    for order in rebought:
+        for d in order.get("invoiceDetails", []):
+            d["invoiceId"] += 1
+    with dk.make_build_pool(prod_by_dk, 2, None) as pool:
+        for build in (lambda docs: dk.build_frame(docs, prod_by_dk),
+                      lambda docs: dk.build_parallel(pool, docs, shard_size=7)):
+            once, twice = build(invoices), build(invoices + rebought)
+            assert len(twice) == 2 * len(once)
+            col = twice["other_parameters"]
+            for part, blob in zip(twice["dk_pn"], col):
+                assert blob == json.dumps(dk.build_other_params_dict(prod_by_dk.get(part)), ensure_ascii=False)
+            assert len(col.cat.categories) == col.nunique()  # each distinct blob held once
+            # the second purchase of every line adds a code per row, not another copy of its blob
+            grown = col.memory_usage(deep=True, index=False) - once["other_parameters"].memory_usage(deep=True, index=False)
+            assert grown <= 8 * len(once)
+
+def _base_and_merged():
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    prod_by_dk = dk.build_prod_by_dk(products, [])
+    new_keys = set(dk.iter_detail_keys(invoices[150:])) - set(dk.iter_detail_keys(invoices[:150]))
+    base = dk.declare_dtypes(dk.build_frame(invoices[:150], prod_by_dk))
+    merged = dk.declare_dtypes(dk.build_frame(invoices, prod_by_dk, new_keys))
+    return base, merged
+
+
+def test_assert_old_rows_identical_accepts_reordered_and_retyped_rows():
+    base, merged = _base_and_merged()
+    cols = dk.FUTURE_FULL_SCHEMA
+    dk.assert_old_rows_identical(base, merged, cols)
+    shuffled = merged.sample(frac=1, random_state=0)
+    shuffled["qty_shipped"] = shuffled["qty_shipped"].astype(str)  # same CSV text, other dtype
+    dk.assert_old_rows_identical(base, shuffled, cols)
+    with pytest.raises(AssertionError, match="Key sets differ"):
+        dk.assert_old_rows_identical(base, merged.drop(index=merged.index[~merged["_is_new"]][:1]), cols)
+
+
+def test_assert_old_rows_identical_reports_first_column_then_first_key():
+    base, merged = _base_and_merged()
+    at = {int(k): i for i, k in enumerate(merged["_detail_key"])}
+    late, early = (at[int(base["_detail_key"].iat[i])] for i in (9, 4))
+    merged.loc[late, "description"] = "EDITED"  # earlier column, later row
+    merged.loc[early, "mfr"] = "EDITED"  # later column, earlier row
+    merged.loc[at[int(base["_detail_key"].iat[2])], "other_parameters"] = "{}"
+    key = dk.decode_detail_key(base["_detail_key"].iat[9])
+    with pytest.raises(AssertionError, match=rf"Column 'description' differs for key \({key[0]}, {key[1]}\): "
+                                             rf"base='{re.escape(base['description'].iat[9])}' merged='EDITED'"):
+        dk.assert_old_rows_identical(base, merged, dk.FUTURE_FULL_SCHEMA)
+    merged.loc[late, "description"] = base["description"].iat[9]
+    merged.loc[at[int(base["_detail_key"].iat[7])], "mfr"] = "EDITED TOO"
+    key = dk.decode_detail_key(base["_detail_key"].iat[4])
+    with pytest.raises(AssertionError, match=rf"Column 'mfr' differs for key \({key[0]}, {key[1]}\)"):
+        dk.assert_old_rows_identical(base, merged, dk.FUTURE_FULL_SCHEMA)
+
+
+def test_parallel_build_matches_single_process(tmp_path):
+    invoices = json.loads((HERE / "merged_invoices_out.json").read_text(encoding="utf-8"))
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    prod_by_dk = dk.build_prod_by_dk(products, [])
+    new_keys = set(dk.iter_detail_keys(invoices[150:])) - set(dk.iter_detail_keys(invoices[:150]))
+    docs = invoices + invoices[140:160]  # repeated orders land in later shards and must be dropped
+    with dk.make_build_pool(prod_by_dk, 3, new_keys) as pool:
+        merged = dk.build_parallel(pool, docs, mark_new=True, shard_size=7)
+        base = dk.build_parallel(pool, invoices[:150], shard_size=7)
+    pd.testing.assert_frame_equal(merged, dk.build_frame(docs, prod_by_dk, new_keys))
+    pd.testing.assert_frame_equal(base, dk.build_frame(invoices[:150], prod_by_dk))
+
+    _archive(tmp_path / "in")
+    for workers in (1, 3):
+        _run(IN_DIR=tmp_path / "in", OUT_DIR=tmp_path / f"out{workers}", workers=workers)
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv", "new_purchases_enriched.csv",
+                 "merged_products_out.json", "merged_invoices_out.json"):
+        assert (tmp_path / "out1" / name).read_bytes() == (tmp_path / "out3" / name).read_bytes()
+
+
+def test_detail_key_ids_round_trip():
+    packed = [(0, 0), (118610462, 1), (118610462, (1 << 20) - 1), ((1 << 42) - 1, 7)]
+    for key in packed:
+        kid = dk.encode_detail_key(key)
+        assert kid >= 0 and dk.decode_detail_key(kid) == key
+    # detailId == 1 << 20 no longer fits the packed layout, nor do big or non-int ids / 5-tuples
+    fallback = [(118610462, 1 << 20), (1 << 42, 1), ("118610462", 1), (118610462, None, "296-1-ND", 5, 100)]
+    with dk.detail_key_scope():
+        ids = [dk.encode_detail_key(k) for k in fallback]
+        assert all(kid < 0 for kid in ids) and len(set(ids)) == len(ids)
+        assert [dk.decode_detail_key(kid) for kid in ids] == fallback
+        assert dk.detail_key_id({"invoiceId": 118610462, "detailId": 1 << 20}) == ids[0]
+    assert [dk.encode_detail_key(k) for k in fallback] == ids  # stable outside the scope too
+    with pytest.raises(KeyError):
+        dk.decode_detail_key(ids[0])  # ... but only remembered inside it
+    assert list(dk.detail_key_ids(packed[:2] + fallback[:1])) == [dk.encode_detail_key(k) for k in packed[:2]] + ids[:1]
+
+
+# Elements whose strings hold brackets, commas, escaped quotes/backslashes and unicode
+# escapes, plus bare scalars that a chunk edge could cut short ("12" of "123").
+_TRICKY_JSON = [
+    {"a": "x]y[", "b": "quote \" and \\ backslash ]", "c": [1, [2, "]"], {}], "d": "é 😀"},
+    123, -4.5e3, "str,]", [], [[], {"k": []}], None, True, {"": "}{,\n\t"}, 0,
+]
+
+
+@pytest.mark.parametrize("indent", [2, None])
+def test_iter_json_array_survives_every_chunk_boundary(tmp_path, indent):
+    p = tmp_path / "doc.json"
+    p.write_text(json.dumps(_TRICKY_JSON, indent=indent, ensure_ascii=False), encoding="utf-8")
+    for chunk_size in [*range(1, 40), 1 << 20]:
+        assert list(dk._iter_json_array(p, chunk_size=chunk_size)) == _TRICKY_JSON, chunk_size
+    stream = dk.JsonArrayStream(p)
+    assert list(stream) == list(stream) == _TRICKY_JSON
+
+
+@pytest.mark.parametrize("text", ['{"a": 1}', "[1, 2", "[1 2]", '[{"a": "]"}, '],
+                         ids=["not_array", "unterminated", "no_comma", "cut_element"])
+def test_iter_json_array_rejects_malformed_arrays(tmp_path, text):
+    p = tmp_path / "bad.json"
+    p.write_text(text, encoding="utf-8")
+    for chunk_size in (1, 3, 1 << 20):
+        with pytest.raises(ValueError):
+            list(dk._iter_json_array(p, chunk_size=chunk_size))
+
+
+def test_write_json_array_matches_json_dump(tmp_path):
+    base, extra = _TRICKY_JSON[:4], _TRICKY_JSON[4:]
+    for items in ([], base, _TRICKY_JSON):
+        out = tmp_path / "out.json"
+        n, sha = dk._write_json_array(out, iter(items), indent=2)
+        assert out.read_text(encoding="utf-8") == json.dumps(items, indent=2)
+        assert (n, sha) == (len(items), dk._file_sha256(out))
+        dk._write_json_array(out, iter(items), indent=None)
+        assert out.read_text(encoding="utf-8") == json.dumps(items, separators=(",", ":"))
+    for indent, dump in ((2, {"indent": 2}), (None, {"separators": (",", ":")})):
+        dk._write_json_array(tmp_path / "base.json", base, indent=indent)
+        n, _ = dk._write_json_array(tmp_path / "base.json", extra, indent=indent, splice_from=tmp_path / "base.json")
+        assert n == len(extra)
+        assert (tmp_path / "base.json").read_text(encoding="utf-8") == json.dumps(_TRICKY_JSON, **dump)
+
+
+@pytest.mark.parametrize("text", [
+    'a,b\n1,"two\nlines"\n3,"say ""hi""\n"\n',  # quoted newlines, "" escapes
+    'a,b\r\n1,2\r\n"x\r\ny",4\r\n',            # CRLF, also inside quotes
+    'a,b\n1,2\n3,"4\n5"',                         # no trailing newline after a quoted field
+    'a,b\n1,2\n3,4',                               # no trailing newline
+    'a,b\n',                                        # header only
+], ids=["quoted_newlines", "crlf", "unterminated_quoted", "unterminated", "header_only"])
+def test_csv_record_count_matches_csv_reader(tmp_path, text):
+    p = tmp_path / "t.csv"
+    p.write_bytes(text.encode("utf-8"))
+    with p.open(newline="", encoding="utf-8") as f:
+        records = sum(1 for _ in csv.reader(f))
+    for chunk_size in [*range(1, len(text) + 2), 1 << 20]:  # every quote and newline lands on a chunk edge
+        assert dk._csv_record_count(p, chunk_size=chunk_size) == records, chunk_size
+    assert dk._csv_fingerprint(p) == (2, records - 1)
+
+
+def test_csv_fingerprint_matches_pandas_on_the_checked_in_csvs():
+    for name in ("updated_full_future_schema.csv", "updated_mini.csv"):
+        df = pd.read_csv(HERE / name, dtype=str, keep_default_na=False)
+        assert dk._csv_fingerprint(HERE / name) == (len(df.columns), len(df))
+        assert dk._csv_record_count(HERE / name, chunk_size=4096) == len(df) + 1
+
+
+def test_category_index_matches_direct_classification():
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    renamed = copy.deepcopy(products[0])
+    renamed["category"]["childCategories"][0]["name"] = "Renamed"
+    branching = copy.deepcopy(products[0])
+    branching["category"]["childCategories"].append({"categoryId": 1, "name": "Microcontrollers"})
+    products += [renamed, branching, {"category": {}}, {"category": {"name": "X", "childCategories": [{}]}}, {}, None]
+    idx = dk.CategoryIndex(p for p in products if p)
+    for prod in products:
+        assert idx.classify(prod) == (dk.category_t2(prod), dk.is_mcu_product(prod))
+    table = idx.frame()
+    assert list(table.columns) == dk.CATEGORY_TABLE_COLUMNS
+    assert table["category_id"].is_unique
+
+
+@pytest.mark.parametrize("text, expected", [
+    # valueText strings from merged_products_out.json
+    ("-40°C ~ 85°C (TA)", (-40.0, 85.0, "°C")),
+    ("1.71V ~ 3.6V", (1.71, 3.6, "V")),
+    ("2.4GHz ~ 2.4835GHz", (2.4e9, 2.4835e9, "Hz")),
+    ("100µA @ 2.7V ~ 5.5V", (1e-4, 1e-4, "A")),
+    ("512KB (512K x 8)", (524288.0, 524288.0, "B")),
+    ("SC-74A, SOT-753", None),
+    ("SOD-123F", None),
+    ("ARM® Cortex®-M33F", None),
+    ("LFE5U-85F", None),
+    ("UL94 V-0", None),
+    ("XC7A100T", None),
+    ("USB104 A7 Artix 7 FPGA PC/104", None),
+])
+def test_parse_quantity(text, expected):
+    q = dk.parse_quantity(text)
+    if expected is None:
+        assert q is None
+    else:
+        assert q[:2] == pytest.approx(expected[:2]) and q[2] == expected[2]
+
+
+@pytest.mark.parametrize("name, unit", [
+    ("Operating Temperature", "°C"),
+    ("Voltage - Supply (Vcc/Vdd)", "V"),
+    ("Core Processor", None),
+    ("Package / Case", None),
+    ("Utilized IC / Part", None),
+])
+def test_param_index_units(name, unit):
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    assert dk.ParamIndex(products).unit(name) == unit
+
+
+def _scan_catalog(products, filters):
+    """ParamIndex.query's answer by brute force: every product's parameters checked one by one."""
+    def norm(v):
+        return " ".join(str(v).replace("®", "").replace("™", "").lower().split())
+
+    def num(v):
+        return dk.parse_quantity(v)[0]
+
+    checks = {">=": lambda lo, hi, t: hi >= num(t), ">": lambda lo, hi, t: hi > num(t),
+              "<=": lambda lo, hi, t: lo <= num(t), "<": lambda lo, hi, t: lo < num(t),
+              "between": lambda lo, hi, t: hi >= num(t[0]) and lo <= num(t[1]),
+              "covers": lambda lo, hi, t: lo <= num(t) <= hi}
+    units = {name: dk.ParamIndex(products).unit(name) for name, _, _ in filters}
+    seen, hits = set(), []
+    for p in products:
+        dks = [v["digiKeyProductNumber"] for v in p.get("productVariations", []) if v.get("digiKeyProductNumber")]
+        if dks and all(d in seen for d in dks):
+            continue
+        seen.update(dks)
+        params = {}
+        for prm in p.get("parameters") or []:
+            params.setdefault(prm.get("parameterText", ""), prm.get("valueText", ""))
+        ok = True
+        for name, op, value in filters:
+            if name not in params:
+                ok = False
+            elif op == "==":
+                ok = norm(params[name]) == norm(value)
+            elif op == "in":
+                ok = norm(params[name]) in {norm(v) for v in value}
+            elif op == "contains":
+                ok = norm(value) in norm(params[name])
+            else:
+                q = dk.parse_quantity(params[name])
+                ok = q is not None and q[2] == units[name] and checks[op](q[0], q[1], value)
+            if not ok:
+                break
+        if ok:
+            hits.append(dks)
+    return hits
+
+
+@pytest.mark.parametrize("filters", [
+    [("Speed", ">=", "48MHz")],
+    [("Speed", ">", "48MHz")],
+    [("Speed", "<=", "48MHz")],
+    [("Speed", "<", 48e6)],
+    [("Program Memory Size", ">=", "512KB")],
+    [("Tolerance", "<=", "1%")],
+    [("Operating Temperature", "<=", "-55°C")],
+    [("Voltage - Supply (Vcc/Vdd)", "between", ("1.8V", "2V"))],
+    [("Voltage - Supply (Vcc/Vdd)", "covers", "5V")],
+    [("Mounting Type", "==", "SURFACE MOUNT")],
+    [("Core Processor", "==", "arm® CORTEX®-m33")],
+    [("Core Processor", "in", ["ARM® Cortex®-M0+", "avr", "no such core"])],
+    [("Package / Case", "contains", "Soic")],
+    [("Core Processor", "contains", "Cortex®-M")],
+    [("Core Processor", "contains", "Cortex-M"), ("Speed", ">=", "48MHz"), ("Program Memory Size", ">=", "64KB")],
+    [("Mounting Type", "==", "surface mount"), ("Operating Temperature", "covers", "100°C"),
+     ("Tolerance", "<", "5%")],
+], ids=lambda f: " & ".join(f"{name} {op} {value}" for name, op, value in f))
+def test_param_index_query_matches_a_catalog_scan(filters):
+    products = json.loads((HERE / "merged_products_out.json").read_text(encoding="utf-8"))
+    expected = _scan_catalog(products, filters)
+    assert expected  # each case selects something
+    assert [part["dk_pns"] for part in dk.ParamIndex(products).query(*filters)] == expected
+    if len(filters) > 1:
+        assert all(len(_scan_catalog(products, [f])) > len(expected) for f in filters)  # ANDed, not ORed
+
+
+def test_bench_smoke(tmp_path):
+    # dk_bench drives the pipeline through its public API; keep it runnable.
+    import dk_bench
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = dk_bench.bench_size(300, tmp_path, repeat=1)
+    assert set(dk_bench.BENCH_NAMES) <= set(results)
+
+
+def test_bench_compare_fails_on_gaps_in_the_baseline():
+    import dk_bench
+    gen = {"mcu_share": 0.15, "delta_ratio": 0.05, "seed": 0}
+    baseline = {"generator": gen, "results": {"1000": {"discover": {"wall_s": 0.5}, "build_rows": {"wall_s": 1.0}}}}
+    results = {"1000": {"discover": {"wall_s": 0.52}, "build_rows": {"wall_s": 2.0},
+                        "run_pipeline_warm": {"wall_s": 1.0}},
+               "10000": {"discover": {"wall_s": 1.0}}}
+    problems = dk_bench.compare(results, baseline, 1.5, gen)
+    assert problems == ["build_rows @ 1000 items: regressed to 2.000s vs baseline 1.000s (> x1.5)",
+                        "run_pipeline_warm @ 1000 items: no baseline entry; re-record it with --update",
+                        "discover @ 10000 items: no baseline entry; re-record it with --update"]
+    assert "generator settings" in dk_bench.compare({}, baseline, 1.5, {**gen, "seed": 1})[0]
+    assert dk_bench.compare({"1000": {"discover": {"wall_s": 0.52}}}, baseline, 1.5, gen) == []